@@ -0,0 +1,180 @@
+import hashlib
+import array
+import math
+import os
+
+from shared import eprint, convert_to_neighbors
+
+'''
+Hop distances between the nodes of a topology. A row of distances
+is calculated by a breadth-first search over an integer adjacency
+list when it is needed first. The rows are kept in an int16 matrix
+(-1 if unreachable) that is stored on disk by a hash of the topology
+and loaded again next time (see get_distances and save).
+'''
+
+# all-pairs distance matrices by topology hash
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'meshnet-lab', 'distances')
+# max. number of nodes for a matrix (n * n * 2 bytes), larger topologies keep single rows in memory
+max_matrix_nodes = 5000
+
+# marks rows that were not calculated yet (the distance to itself is 0 otherwise)
+_UNKNOWN = -2
+
+class Distances:
+    def __init__(self, network):
+        neighbors = convert_to_neighbors(network)
+
+        # in order of appearance
+        self.nodes = list(neighbors.keys())
+        # sorted for the same index in every run
+        self.ids = sorted(self.nodes)
+        self.index = {id: i for i, id in enumerate(self.ids)}
+        self.adjacency = [array.array('i', sorted(self.index[neighbor] for neighbor in neighbors[id])) for id in self.ids]
+
+        key = hashlib.sha256()
+        key.update('\0'.join(self.ids).encode())
+        for adjacent in self.adjacency:
+            key.update(len(adjacent).to_bytes(4, 'little'))
+            key.update(adjacent.tobytes())
+        self.key = key.hexdigest()
+
+        self.typecode = 'h' if len(self.ids) <= 32767 else 'i'
+        # all rows (see load), otherwise rows by index
+        self.matrix = None
+        self.rows = {}
+        self.changed = False
+
+    def _path(self):
+        return os.path.join(cache_dir, f'{self.key}.bin')
+
+    # load the matrix from disk or start an empty one
+    def load(self):
+        n = len(self.ids)
+        if n > max_matrix_nodes:
+            return
+
+        try:
+            matrix = array.array('h')
+            with open(self._path(), 'rb') as file:
+                matrix.fromfile(file, n * n)
+            self.matrix = matrix
+        except (OSError, EOFError):
+            self.matrix = array.array('h', [_UNKNOWN]) * (n * n)
+        self.rows = {}
+
+    # store the matrix on disk if rows were added
+    def save(self):
+        if self.matrix is None or not self.changed:
+            return
+
+        path = self._path()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(f'{path}.tmp', 'wb') as file:
+                self.matrix.tofile(file)
+            os.replace(f'{path}.tmp', path)
+            self.changed = False
+        except OSError as e:
+            eprint(f'Cannot write {path}: {e.strerror}')
+
+    def _known(self, i):
+        if self.matrix is None:
+            return i in self.rows
+        return self.matrix[i * len(self.ids) + i] != _UNKNOWN
+
+    def _bfs(self, source):
+        adjacency = self.adjacency
+        row = array.array(self.typecode, [-1]) * len(self.ids)
+        row[source] = 0
+        frontier = [source]
+        distance = 0
+        while len(frontier) > 0:
+            distance += 1
+            reached = []
+            for u in frontier:
+                for v in adjacency[u]:
+                    if row[v] < 0:
+                        row[v] = distance
+                        reached.append(v)
+            frontier = reached
+        return row
+
+    # distances from node index i to all other nodes
+    def _row(self, i):
+        n = len(self.ids)
+        if self.matrix is None:
+            row = self.rows.get(i)
+            if row is None:
+                row = self._bfs(i)
+                self.rows[i] = row
+            return row
+
+        if not self._known(i):
+            self.matrix[i * n:(i + 1) * n] = self._bfs(i)
+            self.changed = True
+        return self.matrix[i * n:(i + 1) * n]
+
+    def _get(self, i, j):
+        if self.matrix is None:
+            return self._row(i)[j]
+
+        n = len(self.ids)
+        if not self._known(i):
+            self._row(i)
+        return self.matrix[i * n + j]
+
+    # number of hops between two nodes, math.inf if unreachable
+    def get_distance(self, source, target):
+        i = self.index[str(source)]
+        j = self.index[str(target)]
+
+        # the distances are symmetric, use a row we have already
+        if not self._known(i) and self._known(j):
+            (i, j) = (j, i)
+
+        distance = self._get(i, j)
+        return math.inf if distance < 0 else distance
+
+    # a shortest path as list of nodes (source and target included), None if unreachable
+    def get_path(self, source, target):
+        i = self.index[str(source)]
+        j = self.index[str(target)]
+
+        # walk downhill on the distances to target
+        row = self._row(j)
+        if row[i] < 0:
+            return None
+
+        path = [self.ids[i]]
+        while i != j:
+            i = next(v for v in self.adjacency[i] if row[v] == row[i] - 1)
+            path.append(self.ids[i])
+        return path
+
+    # calculate all rows (all-pairs) and store them on disk
+    def compute_all(self):
+        for i in range(len(self.ids)):
+            self._row(i)
+        self.save()
+
+# distances of recently used topologies
+_recent = {}
+_recent_max = 8
+
+'''
+Get the distances of a topology. Rows that were calculated
+before (in this process or stored on disk) are reused. Call
+save() to store newly calculated rows on disk.
+'''
+def get_distances(network):
+    distances = Distances(network)
+    if distances.key in _recent:
+        return _recent[distances.key]
+
+    distances.load()
+    _recent[distances.key] = distances
+    if len(_recent) > _recent_max:
+        del _recent[next(iter(_recent))]
+
+    return distances
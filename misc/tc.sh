@@ -3,6 +3,8 @@
 # A script to use a link command to change link properties. The variables
 # in the link command are enclosed with curly braces and are take from the
 # link objects in the graph.json file.
+# Note: network.py configures the link attributes latency_ms, jitter_ms, loss_pc
+# and rate_mbit itself, this script is an example for custom settings.
 # E.g. ./network.py --verbosity verbose --link-command './misc/tc.sh "{direction}" "{action}" "{ifname}" "{latency_ms}" "{loss_pc}" "{bandwidth_mbit}"' apply graph.json
 
 direction="$1"
@@ -0,0 +1,456 @@
+import threading
+import ctypes
+import socket
+import struct
+import os
+
+'''
+Minimal rtnetlink client to create and configure bridges and
+veth interfaces in network namespaces without starting ip/bridge
+processes. Only the subset of ip/bridge commands used by
+network.py is supported (see parse()).
+'''
+
+CLONE_NEWNET = 0x40000000
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLA_F_NESTED = 0x8000
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_SETLINK = 19
+RTM_GETADDR = 22
+
+AF_UNSPEC = 0
+AF_BRIDGE = 7
+
+IFF_UP = 0x1
+IFF_NOARP = 0x80
+IFF_MULTICAST = 0x1000
+
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_MASTER = 10
+IFLA_PROTINFO = 12
+IFLA_LINKINFO = 18
+IFLA_STATS64 = 23
+IFLA_NET_NS_FD = 28
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+
+VETH_INFO_PEER = 1
+
+IFLA_BR_FORWARD_DELAY = 1
+IFLA_BR_AGEING_TIME = 4
+IFLA_BR_STP_STATE = 5
+
+IFLA_BRPORT_ISOLATED = 33
+
+# struct rtnl_link_stats64 (first fields, all u64)
+_stats64_fields = [
+    'rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+    'rx_errors', 'tx_errors', 'rx_dropped', 'tx_dropped',
+    'multicast', 'collisions', 'rx_length_errors', 'rx_over_errors',
+    'rx_crc_errors', 'rx_frame_errors', 'rx_fifo_errors', 'rx_missed_errors',
+    'tx_aborted_errors', 'tx_carrier_errors', 'tx_fifo_errors', 'tx_heartbeat_errors',
+    'tx_window_errors', 'rx_compressed', 'tx_compressed'
+]
+
+# address scopes as named by ip
+_scopes = {0: 'global', 200: 'site', 253: 'link', 254: 'host'}
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def _setns(fd):
+    if _libc.setns(fd, CLONE_NEWNET) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+# named namespace or PID of a process in the namespace (like ip)
+def _netns_path(nsname):
+    if nsname.isdigit():
+        return f'/proc/{nsname}/ns/net'
+    return f'/run/netns/{nsname}'
+
+def _attr(kind, data):
+    length = 4 + len(data)
+    return struct.pack('HH', length, kind) + data + b'\0' * ((4 - length % 4) % 4)
+
+def _attr_str(kind, value):
+    return _attr(kind, value.encode() + b'\0')
+
+def _attr_u32(kind, value):
+    return _attr(kind, struct.pack('I', value))
+
+def _attr_u8(kind, value):
+    return _attr(kind, struct.pack('B', value))
+
+def _attr_nested(kind, *attrs):
+    return _attr(kind | NLA_F_NESTED, b''.join(attrs))
+
+# attribute type => payload
+def _parse_attrs(data, offset, end):
+    attrs = {}
+    while offset + 4 <= end:
+        (length, kind) = struct.unpack_from('HH', data, offset)
+        if length < 4:
+            break
+        attrs[kind & ~NLA_F_NESTED] = data[offset + 4:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+def _ifinfomsg(family=AF_UNSPEC, index=0, flags=0, change=0):
+    return struct.pack('BxHiII', family, 0, index, flags, change)
+
+'''
+Route netlink socket bound to a network namespace
+'''
+class Netlink:
+    def __init__(self, nsname=None):
+        self.seq = 0
+        self.indexes = {}
+
+        if nsname is None:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        else:
+            # a netlink socket belongs to the namespace it was created in
+            own = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+            target = os.open(_netns_path(nsname), os.O_RDONLY)
+            try:
+                _setns(target)
+                try:
+                    self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+                finally:
+                    _setns(own)
+            finally:
+                os.close(target)
+                os.close(own)
+
+        self.sock.bind((0, 0))
+
+    def close(self):
+        self.sock.close()
+
+    def _request(self, msg_type, flags, payload):
+        self.seq += 1
+        header = struct.pack('IHHII', 16 + len(payload), msg_type, flags | NLM_F_REQUEST | NLM_F_ACK, self.seq, 0)
+        self.sock.send(header + payload)
+
+        reply = None
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                (length, type, _, seq, _) = struct.unpack_from('IHHII', data, offset)
+                if seq == self.seq:
+                    if type == NLMSG_ERROR:
+                        error = struct.unpack_from('i', data, offset + 16)[0]
+                        if error != 0:
+                            raise OSError(-error, os.strerror(-error))
+                        return reply
+                    reply = data[offset:offset + length]
+                offset += (length + 3) & ~3
+
+    # returns all messages of a dump request
+    def _dump(self, msg_type, payload):
+        self.seq += 1
+        header = struct.pack('IHHII', 16 + len(payload), msg_type, NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0)
+        self.sock.send(header + payload)
+
+        messages = []
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                (length, type, _, seq, _) = struct.unpack_from('IHHII', data, offset)
+                if seq == self.seq:
+                    if type == NLMSG_DONE:
+                        return messages
+                    if type == NLMSG_ERROR:
+                        error = struct.unpack_from('i', data, offset + 16)[0]
+                        raise OSError(-error, os.strerror(-error))
+                    messages.append(data[offset:offset + length])
+                offset += (length + 3) & ~3
+
+    # returns (index, attributes) of an interface
+    def _get_link(self, ifname):
+        reply = self._request(RTM_GETLINK, 0, _ifinfomsg() + _attr_str(IFLA_IFNAME, ifname))
+        index = struct.unpack_from('i', reply, 16 + 4)[0]
+        return (index, _parse_attrs(reply, 16 + 16, len(reply)))
+
+    # interface statistics (as in /sys/class/net/<ifname>/statistics/)
+    def get_link_stats(self, ifname):
+        (_, attrs) = self._get_link(ifname)
+        data = attrs[IFLA_STATS64]
+        values = struct.unpack_from(f'{len(_stats64_fields)}Q', data)
+        return dict(zip(_stats64_fields, values))
+
+    # returns (interface index, address) of all addresses
+    def _dump_addresses(self):
+        addresses = []
+        for msg in self._dump(RTM_GETADDR, struct.pack('BBBBI', AF_UNSPEC, 0, 0, 0, 0)):
+            (family, prefixlen, _, scope, ifa_index) = struct.unpack_from('BBBBI', msg, 16)
+            attrs = _parse_attrs(msg, 16 + 8, len(msg))
+            local = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if local is None:
+                continue
+            addresses.append((ifa_index, {
+                'family': 'inet' if family == socket.AF_INET else 'inet6',
+                'local': socket.inet_ntop(family, local),
+                'prefixlen': prefixlen,
+                'scope': _scopes.get(scope, str(scope)),
+            }))
+        return addresses
+
+    # addresses of an interface as in the addr_info of "ip -j addr list dev <ifname>"
+    def get_addresses(self, ifname):
+        (index, _) = self._get_link(ifname)
+        return [address for ifa_index, address in self._dump_addresses() if ifa_index == index]
+
+    # addresses of all interfaces by interface name (as "ip -j addr list")
+    def get_all_addresses(self):
+        names = {}
+        for msg in self._dump(RTM_GETLINK, _ifinfomsg()):
+            index = struct.unpack_from('i', msg, 16 + 4)[0]
+            attrs = _parse_attrs(msg, 16 + 16, len(msg))
+            names[index] = attrs[IFLA_IFNAME].rstrip(b'\0').decode()
+
+        addresses = {name: [] for name in names.values()}
+        for ifa_index, address in self._dump_addresses():
+            if ifa_index in names:
+                addresses[names[ifa_index]].append(address)
+        return addresses
+
+    def get_index(self, ifname):
+        index = self.indexes.get(ifname)
+        if index is None:
+            reply = self._request(RTM_GETLINK, 0, _ifinfomsg() + _attr_str(IFLA_IFNAME, ifname))
+            # skip nlmsghdr, ifi_family, pad and ifi_type
+            index = struct.unpack_from('i', reply, 16 + 4)[0]
+            self.indexes[ifname] = index
+        return index
+
+    def add_bridge(self, ifname, options):
+        data = b''
+        for key, value in options.items():
+            data += _attr_u32(key, value)
+
+        self._request(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, _ifinfomsg()
+            + _attr_str(IFLA_IFNAME, ifname)
+            + _attr_nested(IFLA_LINKINFO,
+                _attr_str(IFLA_INFO_KIND, 'bridge'),
+                _attr_nested(IFLA_INFO_DATA, data)
+            )
+        )
+
+    def add_veth(self, ifname, peer, peer_nsname=None):
+        fd = None
+        try:
+            peer_attrs = _attr_str(IFLA_IFNAME, peer)
+            if peer_nsname is not None:
+                fd = os.open(_netns_path(peer_nsname), os.O_RDONLY)
+                peer_attrs += _attr_u32(IFLA_NET_NS_FD, fd)
+
+            self._request(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, _ifinfomsg()
+                + _attr_str(IFLA_IFNAME, ifname)
+                + _attr_nested(IFLA_LINKINFO,
+                    _attr_str(IFLA_INFO_KIND, 'veth'),
+                    _attr_nested(IFLA_INFO_DATA,
+                        _attr(VETH_INFO_PEER, _ifinfomsg() + peer_attrs)
+                    )
+                )
+            )
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def set_link(self, ifname, flags=0, change=0, mtu=None, master=None):
+        attrs = _attr_str(IFLA_IFNAME, ifname)
+        if mtu is not None:
+            attrs += _attr_u32(IFLA_MTU, mtu)
+        if master is not None:
+            attrs += _attr_u32(IFLA_MASTER, self.get_index(master))
+
+        self._request(RTM_NEWLINK, 0, _ifinfomsg(flags=flags, change=change) + attrs)
+
+    def del_link(self, ifname):
+        self.indexes.pop(ifname, None)
+        self._request(RTM_DELLINK, 0, _ifinfomsg() + _attr_str(IFLA_IFNAME, ifname))
+
+    def set_bridge_port(self, ifname, isolated):
+        # same as "bridge link set dev <ifname> isolated on/off"
+        self._request(RTM_SETLINK, 0, _ifinfomsg(family=AF_BRIDGE, index=self.get_index(ifname))
+            + _attr_nested(IFLA_PROTINFO, _attr_u8(IFLA_BRPORT_ISOLATED, 1 if isolated else 0))
+        )
+
+_bridge_options = {
+    'forward_delay': IFLA_BR_FORWARD_DELAY,
+    'ageing_time': IFLA_BR_AGEING_TIME,
+    'stp_state': IFLA_BR_STP_STATE,
+}
+
+_link_flags = {
+    'arp': IFF_NOARP,
+    'multicast': IFF_MULTICAST,
+}
+
+'''
+Translate an ip/bridge batch file line into a netlink
+operation. Returns None if the line is not supported.
+'''
+def parse(tool, line):
+    args = line.split()
+
+    try:
+        if tool == 'ip' and args[:2] == ['link', 'add']:
+            args = args[2:]
+            if args[0] == 'name':
+                args = args[1:]
+            ifname = args[0]
+            if args[1] != 'type':
+                return None
+
+            if args[2] == 'bridge':
+                options = {}
+                rest = args[3:]
+                for key, value in zip(rest[0::2], rest[1::2]):
+                    if key not in _bridge_options:
+                        return None
+                    options[_bridge_options[key]] = int(value)
+                if len(rest) % 2 != 0:
+                    return None
+                return lambda nl: nl.add_bridge(ifname, options)
+
+            if args[2] == 'veth' and args[3:5] == ['peer', 'name']:
+                peer = args[5]
+                if len(args) == 6:
+                    return lambda nl: nl.add_veth(ifname, peer)
+                if len(args) == 8 and args[6] == 'netns':
+                    peer_nsname = args[7]
+                    return lambda nl: nl.add_veth(ifname, peer, peer_nsname)
+            return None
+
+        if tool == 'ip' and args[:2] == ['link', 'set']:
+            args = args[2:]
+            if args[0] == 'dev':
+                args = args[1:]
+            ifname = args[0]
+            flags = 0
+            change = 0
+            mtu = None
+            master = None
+
+            i = 1
+            while i < len(args):
+                if args[i] in ['up', 'down']:
+                    change |= IFF_UP
+                    flags |= IFF_UP if args[i] == 'up' else 0
+                    i += 1
+                elif args[i] == 'mtu':
+                    mtu = int(args[i + 1])
+                    i += 2
+                elif args[i] == 'master':
+                    master = args[i + 1]
+                    i += 2
+                elif args[i] in _link_flags and args[i + 1] in ['on', 'off']:
+                    flag = _link_flags[args[i]]
+                    change |= flag
+                    # the arp flag is inverted (IFF_NOARP)
+                    if (args[i + 1] == 'on') != (flag == IFF_NOARP):
+                        flags |= flag
+                    i += 2
+                else:
+                    return None
+
+            return lambda nl: nl.set_link(ifname, flags, change, mtu, master)
+
+        if tool == 'ip' and args[:2] in [['link', 'del'], ['link', 'delete']]:
+            ifname = args[2]
+            # "type <kind> ..." after the name does not matter for deletion
+            if len(args) > 3 and args[3] != 'type':
+                return None
+            return lambda nl: nl.del_link(ifname)
+
+        if tool == 'bridge' and args[:3] == ['link', 'set', 'dev'] and len(args) == 6:
+            ifname = args[3]
+            if args[4] == 'isolated' and args[5] in ['on', 'off']:
+                isolated = (args[5] == 'on')
+                return lambda nl: nl.set_bridge_port(ifname, isolated)
+    except (IndexError, ValueError):
+        pass
+
+    return None
+
+'''
+Execute batch file lines in a namespace. All lines
+need to be supported (see parse()).
+Raises OSError on failure.
+'''
+def execute(nsname, tool, lines):
+    operations = [(line, parse(tool, line)) for line in lines]
+    nl = Netlink(nsname)
+    try:
+        for line, operation in operations:
+            try:
+                operation(nl)
+            except OSError as e:
+                raise OSError(e.errno, f'{e.strerror}: {tool} {line}')
+    finally:
+        nl.close()
+
+'''
+Netlink sockets for queries that stay open between calls,
+one per namespace. Reading interface statistics or addresses
+this way does not start any processes (unlike ip netns exec).
+A socket keeps its namespace alive, so network.py closes the
+readers of removed nodes (close_readers) and a socket is opened
+again if the namespace was recreated.
+'''
+_readers = {} # nsname => (namespace inode, Netlink)
+_readers_lock = threading.Lock()
+
+def _get_reader(nsname):
+    inode = os.stat(_netns_path(nsname)).st_ino
+    entry = _readers.get(nsname)
+    if entry is None or entry[0] != inode:
+        if entry is not None:
+            entry[1].close()
+        entry = (inode, Netlink(nsname))
+        _readers[nsname] = entry
+    return entry[1]
+
+# Raises OSError if the namespace or interface does not exist
+def get_link_stats(nsname, ifname):
+    with _readers_lock:
+        return _get_reader(nsname).get_link_stats(ifname)
+
+# Raises OSError if the namespace or interface does not exist
+def get_addresses(nsname, ifname):
+    with _readers_lock:
+        return _get_reader(nsname).get_addresses(ifname)
+
+# Raises OSError if the namespace does not exist
+def get_all_addresses(nsname):
+    with _readers_lock:
+        return _get_reader(nsname).get_all_addresses()
+
+# close the readers of the namespaces (all if None)
+def close_readers(nsnames=None):
+    with _readers_lock:
+        if nsnames is None:
+            nsnames = list(_readers.keys())
+        for nsname in nsnames:
+            entry = _readers.pop(nsname, None)
+            if entry is not None:
+                entry[1].close()
@@ -3,9 +3,9 @@
 import subprocess
 import argparse
 import hashlib
-import random
+import threading
+import queue
 import time
-import math
 import json
 import sys
 import re
@@ -14,12 +14,47 @@ import os
 from shared import (
     eprint, exec, default_remotes, convert_to_neighbors, check_access,
     stop_all_terminals, format_duration, millis, wait_for_completion,
-    get_current_state, link_id, Remote, get_thread_id, globalTerminalGroup
+    get_current_state, link_id, Remote, get_thread_id, globalTerminalGroup,
+    start_trace, exec_async, gather, holder_dir, get_holder_pid, set_holder_pid,
+    netns_exec, clear_addresses, local_netns, CommandError
 )
 
+import partition
+import netlink
+
 disable_layer3 = False
 verbosity = 'normal'
 mtu = 1500
+batch = True
+# run the phases one after another instead of as dependency graph
+phase_barriers = False
+backend = 'iproute2'
+# link attribute to weight links for the node placement
+link_weight = None
+# links between remotes: l2tp session per link or VLAN on a VXLAN device per remote pair
+interconnect = 'l2tp'
+vxlan_port = 4789
+# set links down/up instead of removing/creating them again
+toggle_links = False
+# link attribute => minimum change to update a link (e.g. {'latency_ms': 1})
+update_thresholds = {}
+# node namespaces: named (ip netns add) or held by a process (unshare, no bind mounts)
+namespaces = 'netns'
+
+# link_id => link attributes last applied by this process
+_applied_links = {}
+
+# PID of the holder process if nsname is a node namespace created in holder mode
+def _holder_pid(remote, nsname):
+    if nsname is None or not nsname.startswith('ns-'):
+        return None
+    return get_holder_pid(remote, nsname[3:])
+
+# shell command prefix to execute a command in a namespace
+def _netns_exec(remote, nsname):
+    if nsname.startswith('ns-'):
+        return netns_exec(remote, nsname[3:])
+    return f'ip netns exec "{nsname}"'
 
 
 # deterministic link id
@@ -29,17 +64,173 @@ def link_num(source, target, min, max):
     n = int.from_bytes(digest, byteorder='little', signed=False)
     return int(min + ((float(n - 0) / float(2**64)) * (max - min)))
 
+'''
+Collect iproute2 commands (ip, bridge, tc) per remote and
+namespace and execute each collection with a single process
+in batch mode. Shell commands (e.g. node/link commands) are
+run before or after the batch files. If batching is disabled,
+every command is executed on its own. With dry, the commands
+are only counted (see plan).
+'''
+class _Commands:
+    def __init__(self, batched=True, dry=False):
+        self.batched = batched
+        self.dry = dry
+        # (remote, nsname, tool) => [args]
+        self.files = {}
+        self.pre = []
+        self.post = []
+        self.command_count = 0
+        self.process_count = 0
+        # current phase for counts
+        self.phase = None
+        # (phase, remote, tool) => number of commands
+        self.counts = {}
+        # (phase, remote) => number of processes
+        self.process_counts = {}
+
+    def _count(self, remote, tool):
+        key = (self.phase, remote, tool)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _count_process(self, remote):
+        self.process_count += 1
+        key = (self.phase, remote)
+        self.process_counts[key] = self.process_counts.get(key, 0) + 1
+
+    def ip(self, tid, remote, nsname, args, tool='ip'):
+        self.command_count += 1
+        self._count(remote, tool)
+        if self.batched:
+            self.files.setdefault((remote, nsname, tool), []).append(args)
+        else:
+            self._count_process(remote)
+            if self.dry:
+                return
+            if nsname is None:
+                exec(tid, remote, f'{tool} {args}')
+            else:
+                exec(tid, remote, f'{_netns_exec(remote, nsname)} {tool} {args}')
+
+    def bridge(self, tid, remote, nsname, args):
+        self.ip(tid, remote, nsname, args, tool='bridge')
+
+    def tc(self, tid, remote, nsname, args):
+        self.ip(tid, remote, nsname, args, tool='tc')
+
+    def shell(self, tid, remote, command, before=False):
+        self.command_count += 1
+        self._count(remote, 'shell')
+        self._count_process(remote)
+        if self.batched:
+            if before:
+                self.pre.append((tid, remote, command))
+            else:
+                self.post.append((tid, remote, command))
+        elif not self.dry:
+            exec(tid, remote, command)
+
+    def _run_shell(self, commands):
+        if self.dry:
+            return
+        for tid, remote, command in commands:
+            exec(tid, remote, command)
+        wait_for_completion()
+
+    def _run_files(self):
+        # Files are grouped by namespace kind. The groups are executed
+        # in a fixed order: root namespace, "switch" namespace and node
+        # namespaces (e.g. a l2tp/VXLAN device is created in the root
+        # namespace and moved to "switch" before it is configured there).
+        # Removals run in reverse order (e.g. the veth pair of a node is
+        # deleted in "switch" before its namespace is deleted).
+        groups = {}
+        for (remote, nsname, tool), lines in self.files.items():
+            kind = nsname if nsname in [None, 'switch'] else 'node'
+            groups.setdefault(kind, []).append((remote, nsname, tool, lines))
+
+        order = [None, 'switch', 'node']
+        if self.phase is not None and self.phase.startswith('remove'):
+            order.reverse()
+
+        for files in [groups[kind] for kind in order if kind in groups]:
+            # same remote and namespace => same terminal and order
+            tids = {}
+            for remote, nsname, tool, lines in files:
+                key = (remote, nsname)
+                if self.dry:
+                    self._count_process(remote)
+                    continue
+                if key not in tids and self._run_netlink(remote, nsname, tool, lines):
+                    continue
+                self._run_file(tids.setdefault(key, get_thread_id()), remote, nsname, tool, lines)
+            wait_for_completion()
+
+    # execute a batch file with a single process
+    def _run_file(self, tid, remote, nsname, tool, lines):
+        pid = _holder_pid(remote, nsname)
+        if pid is not None:
+            prefix = f'nsenter -t {pid} -n {tool} '
+        elif nsname is not None:
+            prefix = f'{tool} -n "{nsname}" '
+        else:
+            prefix = f'{tool} '
+        content = '\n'.join(lines)
+        self._count_process(remote)
+        exec(tid, remote, f"{prefix}-batch - <<'EOF'\n{content}\nEOF")
+
+    # execute batch file via netlink if possible (local only)
+    def _run_netlink(self, remote, nsname, tool, lines):
+        if backend != 'netlink' or remote.address is not None:
+            return False
+
+        for line in lines:
+            if netlink.parse(tool, line) is None:
+                return False
+
+        pid = _holder_pid(remote, nsname)
+        try:
+            netlink.execute(nsname if pid is None else str(pid), tool, lines)
+        except OSError as e:
+            eprint(f'Abort, netlink command failed in namespace {nsname or "root"}: {e.strerror}')
+            eprint('Network might be in an undefined state!')
+            stop_all_terminals()
+            exit(1)
+
+        return True
+
+    # execute all collected commands and wait for completion
+    def flush(self):
+        # commands not batched
+        wait_for_completion()
+
+        self._run_shell(self.pre)
+        self._run_files()
+        self._run_shell(self.post)
+
+        self.take()
+
+    # remove the collected commands, returns (files, pre, post)
+    def take(self):
+        collected = (self.files, self.pre, self.post)
+        self.files = {}
+        self.pre = []
+        self.post = []
+        return collected
+
+_commands = _Commands(batched=False)
+
 def configure_interface(tid, remote, nsname, ifname):
     # up interface
-    exec(tid, remote, f'ip netns exec "{nsname}" ip link set dev "{ifname}" up mtu {mtu}')
+    _commands.ip(tid, remote, nsname, f'link set dev {ifname} up mtu {mtu}')
 
     # Configure mesh interface for layer 2 use.
     # - no IP address assigned
     # - no IP packets (Ethernet only)
     if disable_layer3:
-        exec(tid, remote, f'ip netns exec "{nsname}" ip link set dev "{ifname}" arp off') # probably not needed
-        exec(tid, remote, f'ip netns exec "{nsname}" ip link set dev "{ifname}" multicast off') # probably not needed
-        exec(tid, remote, f'ip netns exec "{nsname}" sysctl -q -w net.ipv6.conf.{ifname}.disable_ipv6=1')
+        _commands.ip(tid, remote, nsname, f'link set dev {ifname} arp off') # probably not needed
+        _commands.ip(tid, remote, nsname, f'link set dev {ifname} multicast off') # probably not needed
+        _commands.shell(tid, remote, f'{_netns_exec(remote, nsname)} sysctl -q -w net.ipv6.conf.{ifname}.disable_ipv6=1')
 
 def format_command(command, item, extra):
     if not isinstance(command, str):
@@ -58,27 +249,36 @@ def format_command(command, item, extra):
 
         return command
 
-def remove_node(node, node_command, rmap={}):
+def remove_node(node, node_command, rmap={}, tid=None):
     name = str(node['id'])
     remote = rmap.get(name)
-    tid = get_thread_id()
+    nsname = f'ns-{name}'
+    if tid is None:
+        tid = get_thread_id()
 
     if node_command is not None:
         extra = {'action': 'remove', 'ifname': 'uplink'}
         command = format_command(node_command, node, extra)
         if command is not None:
-            exec(tid, remote, f'ip netns exec "{nsname}" {command}')
+            _commands.shell(tid, remote, f'{_netns_exec(remote, nsname)} {command}', before=True)
 
     # remove veth pair upname/downname (removes both)
-    exec(tid, remote, f'ip netns exec "switch" ip link delete "dl-{name}"')
+    _commands.ip(tid, remote, 'switch', f'link delete dl-{name}')
 
     # remove bridge (assume that it does not have an interfaces anymore)
-    exec(tid, remote, f'ip netns exec "switch" ip link delete "br-{name}" type bridge')
+    _commands.ip(tid, remote, 'switch', f'link delete br-{name} type bridge')
 
     # remove network namespace
-    exec(tid, remote, f'ip netns del "ns-{name}"')
+    pid = _holder_pid(remote, nsname)
+    if pid is None:
+        _commands.ip(tid, remote, None, f'netns del {nsname}')
+    else:
+        # the namespace is gone when the last process has left
+        _commands.shell(tid, remote, f'kill {pid}; rm -f {holder_dir}/{nsname}')
+        if not _commands.dry:
+            set_holder_pid(remote, name, None)
 
-def create_node(node, node_command=None, rmap={}):
+def create_node(node, node_command=None, rmap={}, tid=None):
     name = str(node['id'])
     remote = rmap.get(name)
 
@@ -86,41 +286,37 @@ def create_node(node, node_command=None, rmap={}):
     brname = f'br-{name}'
     upname = 'uplink'
     downname = f'dl-{name}'
-    tid = get_thread_id()
-
-    exec(tid, remote, f'ip netns add "{nsname}"')
+    if tid is None:
+        tid = get_thread_id()
 
-    # up localhost
-    exec(tid, remote, f'ip netns exec "{nsname}" ip link set dev "lo" up')
+    # namespace already held by a process (see _start_holders)
+    pid = get_holder_pid(remote, name)
+    if namespaces == 'netns':
+        _commands.ip(tid, remote, None, f'netns add {nsname}')
 
     # create bridge
-    exec(tid, remote, f'ip netns exec "switch" ip link add name "{brname}" type bridge')
-    configure_interface(tid, remote, "switch", brname)
-
-    # disable spanning tree protocol (should be off by default anyway)
-    exec(tid, remote, f'ip netns exec "switch" ip link set "{brname}" type bridge stp_state 0')
+    # - disable spanning tree protocol (should be off by default anyway)
+    # - make the bridge to act as a hub
+    _commands.ip(tid, remote, 'switch', f'link add name {brname} type bridge stp_state 0 ageing_time 0 forward_delay 0')
+    configure_interface(tid, remote, 'switch', brname)
 
-    # make the bridge to act as a hub
-    exec(tid, remote, f'ip netns exec "switch" ip link set "{brname}" type bridge ageing_time 0')
-    exec(tid, remote, f'ip netns exec "switch" ip link set "{brname}" type bridge forward_delay 0')
-
-    # create interface pair in node namespace
-    exec(tid, remote, f'ip netns exec "{nsname}" ip link add name "{upname}" type veth peer name "{downname}"')
-
-    # move downlink from node namespace to namespace 'switch'
-    exec(tid, remote, f'ip netns exec "{nsname}" ip link set "{downname}" netns "switch"')
+    # create interface pair with the uplink in the node namespace
+    peerns = nsname if pid is None else pid
+    _commands.ip(tid, remote, 'switch', f'link add name {downname} type veth peer name {upname} netns {peerns}')
 
     # put uplinkport into bridge
-    exec(tid, remote, f'ip netns exec "switch" ip link set "{downname}" master "{brname}"')
-
+    _commands.ip(tid, remote, 'switch', f'link set dev {downname} master {brname}')
     configure_interface(tid, remote, 'switch', downname)
+
+    # up localhost
+    _commands.ip(tid, remote, nsname, 'link set dev lo up')
     configure_interface(tid, remote, nsname, upname)
 
     if node_command is not None:
         extra = {'action': 'create', 'ifname': 'uplink'}
         command = format_command(node_command, node, extra)
         if command is not None:
-            exec(tid, remote, f'ip netns exec "{nsname}" {command}')
+            _commands.shell(tid, remote, f'{_netns_exec(remote, nsname)} {command}')
 
 # apply useful system defaults
 def system_setup(remotes):
@@ -138,7 +334,52 @@ def system_setup(remotes):
         exec(tid, remote, 'sysctl -w net.ipv6.neigh.default.gc_thresh3=4096')
     wait_for_completion()
 
-def update_node(node, node_command=None, rmap={}):
+'''
+Start a holder process for each new node namespace (holder mode).
+unshare creates the network and mount namespace (to mount a /sys
+of the network namespace like ip netns exec does). The holder
+writes its PID to holder_dir when the namespace is ready.
+'''
+def _start_holders(nodes, rmap):
+    names = {}
+    for node in nodes:
+        name = str(node['id'])
+        names.setdefault(rmap.get(name), []).append(name)
+
+    futures = []
+    for remote, remote_names in names.items():
+        nsnames = ' '.join(f'ns-{name}' for name in remote_names)
+        script = (
+            f'mkdir -p {holder_dir} && (cd {holder_dir} && rm -f {nsnames})\n'
+            f'pids=""\n'
+            f'for nsname in {nsnames}; do\n'
+            f'  unshare --net --mount --propagation slave sh -c "mount -t sysfs sysfs /sys && echo \\$\\$ > {holder_dir}/$nsname && exec sleep infinity" < /dev/null > /dev/null 2>&1 &\n'
+            f'  pids="$pids $!"\n'
+            f'done\n'
+            f'set -- $pids\n'
+            f'for nsname in {nsnames}; do\n'
+            f'  while [ ! -s {holder_dir}/$nsname ] && kill -0 $1 2> /dev/null; do sleep 0.01; done\n'
+            f'  [ -s {holder_dir}/$nsname ] && echo "$nsname $1"\n'
+            f'  shift\n'
+            f'done; true'
+        )
+        futures.append(exec_async(get_thread_id(), remote, script))
+
+    for remote, (stdout, _, _) in zip(names.keys(), gather(futures, 'start holders')):
+        for line in stdout.splitlines():
+            (nsname, pid) = line.split()
+            set_holder_pid(remote, nsname[3:], int(pid))
+
+    for node in nodes:
+        name = str(node['id'])
+        remote = rmap.get(name)
+        if get_holder_pid(remote, name) is None:
+            eprint(f'Abort, failed to start holder process of ns-{name} on {remote.address or "local"}')
+            eprint('Network might be in an undefined state!')
+            stop_all_terminals()
+            exit(1)
+
+def update_node(node, node_command=None, rmap={}, tid=None):
     name = str(node['id'])
     remote = rmap.get(name)
 
@@ -146,13 +387,14 @@ def update_node(node, node_command=None, rmap={}):
         if verbosity == 'normal':
             print(f'  update node {name}')
 
-        tid = get_thread_id()
+        if tid is None:
+            tid = get_thread_id()
         extra = {'action': 'update', 'ifname': 'uplink'}
         command = format_command(node_command, node, extra)
         if command is not None:
-            exec(tid, remote, f'ip netns exec "ns-{name}" {command}')
+            _commands.shell(tid, remote, f'{netns_exec(remote, name)} {command}')
 
-def remove_link(link, link_command=None, rmap={}):
+def remove_link(link, link_command=None, rmap={}, tid=None):
     source = str(link['source'])
     target = str(link['target'])
     remote1 = rmap.get(source)
@@ -161,7 +403,8 @@ def remove_link(link, link_command=None, rmap={}):
     ifname1 = f've-{source}-{target}'
     ifname2 = f've-{target}-{source}'
 
-    tid = get_thread_id()
+    if tid is None:
+        tid = get_thread_id()
 
     if source == target:
         eprint(f'Warning: Cannot remove link with identical source ({source}) and target ({target}) => ignore')
@@ -172,34 +415,68 @@ def remove_link(link, link_command=None, rmap={}):
         extra = {'action': 'remove', 'direction': 'source', 'ifname': ifname1}
         source_command = format_command(link_command, link, extra)
         if source_command is not None:
-            exec(tid, remote1, f'ip netns exec "switch" {source_command}')
+            _commands.shell(tid, remote1, f'ip netns exec "switch" {source_command}', before=True)
 
         # target -> source
         extra = {'action': 'remove', 'direction': 'target', 'ifname': ifname2}
         target_command = format_command(link_command, link, extra)
         if target_command is not None:
-            exec(tid, remote2, f'ip netns exec "switch" {target_command}')
+            _commands.shell(tid, remote2, f'ip netns exec "switch" {target_command}', before=True)
 
     if remote1 == remote2:
-        exec(tid, remote1, f'ip netns exec "switch" ip link del "{ifname1}" type veth peer name "{ifname2}"')
+        _commands.ip(tid, remote1, 'switch', f'link del {ifname1} type veth peer name {ifname2}')
     else:
         # multiple remotes always have address set
         addr1 = remote1.address
         addr2 = remote2.address
 
+        lid = link_id(source, target)
+        device1 = _vxlan.get_device(remote1, lid)
+        device2 = _vxlan.get_device(remote2, lid)
+
+        if device1 is not None or device2 is not None:
+            # VLAN interface on VXLAN device
+            if device1 is not None:
+                _commands.ip(tid, remote1, 'switch', f'link del {ifname1}')
+                if _vxlan.remove_link(remote1, device1, lid):
+                    _commands.ip(tid, remote1, 'switch', f'link del {device1}')
+
+            if device2 is not None:
+                _commands.ip(tid, remote2, 'switch', f'link del {ifname2}')
+                if _vxlan.remove_link(remote2, device2, lid):
+                    _commands.ip(tid, remote2, 'switch', f'link del {device2}')
+            return
+
         # ids do not have to be the same on both remotes - but it is simpler that way
         tunnel_id = link_num(addr1, addr2, min=1, max=2**32)
         session_id = link_num(source, target, min=1, max=2**32)
 
-        exec(tid, remote1, f'ip l2tp del session tunnel_id {tunnel_id} session_id {session_id}')
-        if l2tp_session_count(tid, remote1, tunnel_id) == 0:
-            exec(tid, remote1, f'ip l2tp del tunnel tunnel_id {tunnel_id}')
+        _commands.ip(tid, remote1, None, f'l2tp del session tunnel_id {tunnel_id} session_id {session_id}')
+        if _l2tp.remove_session(remote1, tunnel_id, session_id):
+            _commands.ip(tid, remote1, None, f'l2tp del tunnel tunnel_id {tunnel_id}')
+
+        _commands.ip(tid, remote2, None, f'l2tp del session tunnel_id {tunnel_id} session_id {session_id}')
+        if _l2tp.remove_session(remote2, tunnel_id, session_id):
+            _commands.ip(tid, remote2, None, f'l2tp del tunnel tunnel_id {tunnel_id}')
+
+# set link down/up without removing it
+def set_link_state(link, up, rmap={}, tid=None):
+    source = str(link['source'])
+    target = str(link['target'])
+    remote1 = rmap.get(source)
+    remote2 = rmap.get(target)
+
+    ifname1 = f've-{source}-{target}'
+    ifname2 = f've-{target}-{source}'
+    state = 'up' if up else 'down'
 
-        exec(tid, remote2, f'ip l2tp del session tunnel_id {tunnel_id} session_id {session_id}')
-        if l2tp_session_count(tid, remote2, tunnel_id) == 0:
-            exec(tid, remote2, f'ip l2tp del tunnel tunnel_id {tunnel_id}')
+    if tid is None:
+        tid = get_thread_id()
 
-def update_link(link, link_command=None, rmap={}):
+    _commands.ip(tid, remote1, 'switch', f'link set dev {ifname1} {state}')
+    _commands.ip(tid, remote2, 'switch', f'link set dev {ifname2} {state}')
+
+def update_link(link, link_command=None, rmap={}, tid=None):
     source = str(link['source'])
     target = str(link['target'])
     remote1 = rmap.get(source)
@@ -208,32 +485,278 @@ def update_link(link, link_command=None, rmap={}):
     ifname1 = f've-{source}-{target}'
     ifname2 = f've-{target}-{source}'
 
-    tid = get_thread_id()
+    if tid is None:
+        tid = get_thread_id()
 
     if source == target:
         eprint(f'Warning: Cannot update link with identical source ({source}) and target ({target}) => ignore')
         return
 
+    # only changed qdiscs are touched
+    emulate_link(tid, remote1, ifname1, link)
+    emulate_link(tid, remote2, ifname2, link)
+
     if link_command is not None:
         # source -> target
         extra = {'action': 'update', 'direction': 'source', 'ifname': ifname1}
         source_command = format_command(link_command, link, extra)
         if source_command is not None:
-            exec(tid, remote1, f'ip netns exec "switch" {source_command}')
+            _commands.shell(tid, remote1, f'ip netns exec "switch" {source_command}')
 
         # target -> source
         extra = {'action': 'update', 'direction': 'target', 'ifname': ifname2}
         target_command = format_command(link_command, link, extra)
         if target_command is not None:
-            exec(tid, remote2, f'ip netns exec "switch" {target_command}')
+            _commands.shell(tid, remote2, f'ip netns exec "switch" {target_command}')
 
-def l2tp_session_count(tid, remote, tunnel_id):
-    return int(exec(tid, remote, f'ip l2tp show session | grep -c "tunnel {tunnel_id}" || true', get_output=True)[0])
+'''
+Registry of the l2tp tunnels and sessions on each remote. Loaded
+with a single dump per remote and updated when tunnels and sessions
+are added or removed. This way no probing is needed and the l2tp
+commands can be queued/batched like all other commands.
+'''
+class _L2tpRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # remote => {tunnel_id => set(session_id)}
+        self.tunnels = {}
+
+    # parse output of "ip l2tp show tunnel; ip l2tp show session"
+    def parse(self, remote, output):
+        tunnel_re = re.compile(r'^Tunnel (\d+),', re.MULTILINE)
+        session_re = re.compile(r'^Session (\d+) in tunnel (\d+)', re.MULTILINE)
+
+        tunnels = {}
+        for tunnel_id in tunnel_re.findall(output):
+            tunnels.setdefault(int(tunnel_id), set())
+        for session_id, tunnel_id in session_re.findall(output):
+            tunnels.setdefault(int(tunnel_id), set()).add(int(session_id))
+        self.tunnels[remote] = tunnels
+
+    # returns True if the tunnel needs to be created first
+    def add_session(self, remote, tunnel_id, session_id):
+        with self.lock:
+            tunnels = self.tunnels.setdefault(remote, {})
+            is_new = tunnel_id not in tunnels
+            tunnels.setdefault(tunnel_id, set()).add(session_id)
+            return is_new
+
+    # returns True if the tunnel has no sessions left and can be removed
+    def remove_session(self, remote, tunnel_id, session_id):
+        with self.lock:
+            tunnels = self.tunnels.setdefault(remote, {})
+            sessions = tunnels.get(tunnel_id, set())
+            sessions.discard(session_id)
+            if len(sessions) == 0:
+                tunnels.pop(tunnel_id, None)
+                return True
+            return False
+
+_l2tp = _L2tpRegistry()
+
+'''
+Registry of the VXLAN devices (one per pair of remotes) in the "switch"
+namespace and the VLAN ids of the links carried over them. Each link
+is a VLAN interface on top of the VXLAN device, both remotes use the
+same VLAN id. Loaded with a single dump per remote like the l2tp registry.
+'''
+class _VxlanRegistry:
+    max_vlan_id = 4094
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # remote => {device => {link_id => vlan_id}}
+        self.devices = {}
+        # (remote, device) => {vlan_id} released in this run, the
+        # VLAN interface might not be removed yet
+        self.released = {}
+
+    # parse output of "ip -d -o -n switch link show"
+    def parse(self, remote, output):
+        device_re = re.compile(r'^\d+: (vx-[^:@]+)[:@]', re.MULTILINE)
+        vlan_re = re.compile(r'^\d+: ve-([^@:]+)@(vx-[^:]+):.* vlan protocol 802\.1Q id (\d+)', re.MULTILINE)
+        node_re = re.compile(r'^\d+: ve-[^@:]+@[^:]+:.* master br-([^ ]+)')
+
+        devices = {}
+        for device in device_re.findall(output):
+            devices.setdefault(device, {})
+        for line in output.splitlines():
+            m = vlan_re.search(line)
+            n = node_re.search(line)
+            if m and n:
+                # ve-<source>-<target> in bridge br-<source>
+                (ifname, device, vlan_id) = m.groups()
+                source = n.group(1)
+                target = ifname[len(source) + 1:]
+                devices.setdefault(device, {})[link_id(source, target)] = int(vlan_id)
+        self.devices[remote] = devices
+        self.released = {}
+
+    # returns (vlan_id, is_new1, is_new2), is_new is True if the device needs to be created first
+    def add_link(self, remote1, remote2, device, lid):
+        with self.lock:
+            links1 = self.devices.setdefault(remote1, {}).get(device)
+            links2 = self.devices.setdefault(remote2, {}).get(device)
+            used = set(self.released.get((remote1, device), set())) | set(self.released.get((remote2, device), set()))
+            for links in [links1, links2]:
+                if links is not None:
+                    used |= set(links.values())
+
+            vlan_id = next((i for i in range(1, self.max_vlan_id + 1) if i not in used), None)
+            if vlan_id is None:
+                return (None, False, False)
+
+            self.devices[remote1].setdefault(device, {})[lid] = vlan_id
+            self.devices[remote2].setdefault(device, {})[lid] = vlan_id
+            return (vlan_id, links1 is None, links2 is None)
+
+    # returns the device of a link or None
+    def get_device(self, remote, lid):
+        with self.lock:
+            for device, links in self.devices.get(remote, {}).items():
+                if lid in links:
+                    return device
+            return None
+
+    # returns True if the device has no links left and can be removed
+    def remove_link(self, remote, device, lid):
+        with self.lock:
+            devices = self.devices.setdefault(remote, {})
+            links = devices.get(device, {})
+            vlan_id = links.pop(lid, None)
+            if vlan_id is not None:
+                self.released.setdefault((remote, device), set()).add(vlan_id)
+            if len(links) == 0:
+                devices.pop(device, None)
+                return True
+            return False
+
+_vxlan = _VxlanRegistry()
+
+# load l2tp and VXLAN registries with one dump per remote
+def _load_interconnects(remotes):
+    l2tp_command = 'ip l2tp show tunnel; ip l2tp show session'
+    vxlan_command = 'ip -d -o -n switch link show'
+    separator = '__vxlan__'
+
+    _l2tp.tunnels = {}
+    _vxlan.devices = {}
+    futures = [exec_async(get_thread_id(), remote, f'{l2tp_command}; echo {separator}; {vxlan_command}', ignore_error=True) for remote in remotes]
+    for remote, (stdout, _, _) in zip(remotes, gather(futures)):
+        (l2tp_output, _, vxlan_output) = stdout.partition(separator)
+        _l2tp.parse(remote, l2tp_output)
+        _vxlan.parse(remote, vxlan_output)
 
-def l2tp_tunnel_exists(tid, remote, tunnel_id):
-    return int(exec(tid, remote, f'ip l2tp show tunnel | grep -c "Tunnel {tunnel_id}" || true', get_output=True)[0]) != 0
+# VXLAN device name for a pair of remotes (same on both remotes)
+def vxlan_device(addr1, addr2):
+    return f'vx-{link_num(addr1, addr2, min=0, max=2**32):08x}'
+
+'''
+Registry of the link emulation qdiscs in the "switch" namespace. A
+netem qdisc (root, handle 1:) sets delay, jitter and loss and a tbf
+qdisc (handle 2:, below netem or root on its own) limits the rate.
+Loaded by get_current_state, so that an update only changes the
+qdiscs whose settings differ.
+'''
+class _QdiscRegistry:
+    def __init__(self):
+        # (remote, ifname) => {'root': kind, 'netem': (delay_ms, jitter_ms, loss_pc), 'rate': rate_mbit}
+        self.qdiscs = {}
+
+    def get(self, remote, ifname):
+        return self.qdiscs.get((remote, ifname), {'root': None, 'netem': None, 'rate': None})
+
+    def set(self, remote, ifname, qdisc):
+        self.qdiscs[(remote, ifname)] = qdisc
+
+_qdiscs = _QdiscRegistry()
+
+# get the link emulation settings from the link attributes
+def _get_emulation(link):
+    values = {}
+    for key in ['latency_ms', 'jitter_ms', 'loss_pc', 'rate_mbit']:
+        value = link.get(key)
+        if value is None:
+            continue
+        try:
+            values[key] = float(value)
+        except ValueError:
+            values[key] = -1
+        if values[key] < 0 or (key == 'loss_pc' and values[key] > 100) or (key == 'rate_mbit' and values[key] == 0):
+            eprint(f'Invalid link {key}: {value}')
+            stop_all_terminals()
+            exit(1)
+
+    netem = None
+    if 'latency_ms' in values or 'jitter_ms' in values or 'loss_pc' in values:
+        netem = (values.get('latency_ms', 0), values.get('jitter_ms', 0), values.get('loss_pc', 0))
+
+    rate = values.get('rate_mbit')
+    root = 'netem' if netem is not None else ('tbf' if rate is not None else None)
+    return {'root': root, 'netem': netem, 'rate': rate}
+
+def _netem_args(netem):
+    (delay_ms, jitter_ms, loss_pc) = netem
+    jitter = f' {jitter_ms:g}ms' if jitter_ms > 0 else ''
+    return f'netem delay {delay_ms:g}ms{jitter} loss {loss_pc:g}%'
+
+def _tbf_args(rate_mbit):
+    # at least 10ms of traffic and a few full packets per token bucket
+    burst = max(4 * mtu, int(rate_mbit * 1250))
+    return f'tbf rate {rate_mbit:g}mbit burst {burst} latency 50ms'
+
+def _settings_equal(value1, value2):
+    if value1 is None or value2 is None:
+        return value1 is None and value2 is None
+    if not isinstance(value1, tuple):
+        (value1, value2) = ((value1,), (value2,))
+    # the kernel rounds to its internal units
+    return all(abs(a - b) <= 0.01 * max(abs(a), abs(b)) + 0.001 for a, b in zip(value1, value2))
+
+'''
+Configure the netem/tbf qdiscs of a link interface from the link
+attributes latency_ms, jitter_ms, loss_pc and rate_mbit. Only the
+qdiscs that differ from the current settings are added/changed/removed.
+'''
+def emulate_link(tid, remote, ifname, link, created=False):
+    if created:
+        cur = {'root': None, 'netem': None, 'rate': None}
+    else:
+        cur = _qdiscs.get(remote, ifname)
+    new = _get_emulation(link)
+
+    if new['root'] is None:
+        # keep qdiscs that were not set by us (e.g. by a link command)
+        if cur['root'] in ['netem', 'tbf']:
+            _commands.tc(tid, remote, 'switch', f'qdisc del dev {ifname} root')
+            _qdiscs.set(remote, ifname, new)
+        return
 
-def create_link(link, link_command=None, rmap={}):
+    if cur['root'] != new['root']:
+        # different layout, replace root qdisc (removes child qdiscs)
+        verb = 'add' if cur['root'] is None else 'replace'
+        if new['root'] == 'netem':
+            _commands.tc(tid, remote, 'switch', f'qdisc {verb} dev {ifname} root handle 1: {_netem_args(new["netem"])}')
+            if new['rate'] is not None:
+                _commands.tc(tid, remote, 'switch', f'qdisc add dev {ifname} parent 1: handle 2: {_tbf_args(new["rate"])}')
+        else:
+            _commands.tc(tid, remote, 'switch', f'qdisc {verb} dev {ifname} root handle 2: {_tbf_args(new["rate"])}')
+    elif new['root'] == 'netem':
+        if not _settings_equal(cur['netem'], new['netem']):
+            _commands.tc(tid, remote, 'switch', f'qdisc change dev {ifname} root handle 1: {_netem_args(new["netem"])}')
+
+        if cur['rate'] is None and new['rate'] is not None:
+            _commands.tc(tid, remote, 'switch', f'qdisc add dev {ifname} parent 1: handle 2: {_tbf_args(new["rate"])}')
+        elif cur['rate'] is not None and new['rate'] is None:
+            _commands.tc(tid, remote, 'switch', f'qdisc del dev {ifname} parent 1: handle 2:')
+        elif not _settings_equal(cur['rate'], new['rate']):
+            _commands.tc(tid, remote, 'switch', f'qdisc change dev {ifname} parent 1: handle 2: {_tbf_args(new["rate"])}')
+    elif not _settings_equal(cur['rate'], new['rate']):
+        _commands.tc(tid, remote, 'switch', f'qdisc change dev {ifname} root handle 2: {_tbf_args(new["rate"])}')
+
+    _qdiscs.set(remote, ifname, new)
+
+def create_link(link, link_command=None, rmap={}, tid=None):
     source = str(link['source'])
     target = str(link['target'])
     remote1 = rmap.get(source)
@@ -244,7 +767,8 @@ def create_link(link, link_command=None, rmap={}):
     brname1 = f'br-{source}'
     brname2 = f'br-{target}'
 
-    tid = get_thread_id()
+    if tid is None:
+        tid = get_thread_id()
 
     if source == target:
         eprint(f'Warning: Cannot create link with identical source ({source}) and target ({target}) => ignore')
@@ -252,7 +776,33 @@ def create_link(link, link_command=None, rmap={}):
 
     if remote1 == remote2:
         # create veth interface pair
-        exec(tid, remote1, f'ip netns exec "switch" ip link add "{ifname1}" type veth peer name "{ifname2}"')
+        _commands.ip(tid, remote1, 'switch', f'link add {ifname1} type veth peer name {ifname2}')
+    elif interconnect == 'vxlan':
+        # create VLAN interfaces on the VXLAN device between both remotes
+        addr1 = remote1.address
+        addr2 = remote2.address
+
+        device = vxlan_device(addr1, addr2)
+        vni = link_num(addr1, addr2, min=1, max=2**24)
+
+        (vlan_id, is_new1, is_new2) = _vxlan.add_link(remote1, remote2, device, link_id(source, target))
+        if vlan_id is None:
+            eprint(f'Too many links between {addr1} and {addr2} (max {_vxlan.max_vlan_id}), use --interconnect l2tp')
+            stop_all_terminals()
+            exit(1)
+
+        # the root namespace batch runs before the switch namespace batch (see _Commands._run_files)
+        if is_new1:
+            _commands.ip(tid, remote1, None, f'link add {device} type vxlan id {vni} local {addr1} remote {addr2} dstport {vxlan_port}')
+            _commands.ip(tid, remote1, None, f'link set {device} netns switch')
+            configure_interface(tid, remote1, 'switch', device)
+        _commands.ip(tid, remote1, 'switch', f'link add link {device} name {ifname1} type vlan id {vlan_id}')
+
+        if is_new2:
+            _commands.ip(tid, remote2, None, f'link add {device} type vxlan id {vni} local {addr2} remote {addr1} dstport {vxlan_port}')
+            _commands.ip(tid, remote2, None, f'link set {device} netns switch')
+            configure_interface(tid, remote2, 'switch', device)
+        _commands.ip(tid, remote2, 'switch', f'link add link {device} name {ifname2} type vlan id {vlan_id}')
     else:
         # create l2tp connection
         addr1 = remote1.address
@@ -263,26 +813,31 @@ def create_link(link, link_command=None, rmap={}):
         session_id = link_num(source, target, min=1, max=2**32)
         port = link_num(addr1, addr2, min=1024, max=2**16)
 
-        if not l2tp_tunnel_exists(tid, remote1, tunnel_id):
-            exec(tid, remote1, f'ip l2tp add tunnel tunnel_id {tunnel_id} peer_tunnel_id {tunnel_id} encap udp local {addr1} remote {addr2} udp_sport {port} udp_dport {port}')
-        exec(tid, remote1, f'ip l2tp add session name {ifname1} tunnel_id {tunnel_id} session_id {session_id} peer_session_id {session_id}')
-        exec(tid, remote1, f'ip link set "{ifname1}" netns "switch"')
+        # the root namespace batch runs before the switch namespace batch (see _Commands._run_files)
+        if _l2tp.add_session(remote1, tunnel_id, session_id):
+            _commands.ip(tid, remote1, None, f'l2tp add tunnel tunnel_id {tunnel_id} peer_tunnel_id {tunnel_id} encap udp local {addr1} remote {addr2} udp_sport {port} udp_dport {port}')
+        _commands.ip(tid, remote1, None, f'l2tp add session name {ifname1} tunnel_id {tunnel_id} session_id {session_id} peer_session_id {session_id}')
+        _commands.ip(tid, remote1, None, f'link set {ifname1} netns switch')
 
-        if not l2tp_tunnel_exists(tid, remote2, tunnel_id):
-            exec(tid, remote2, f'ip l2tp add tunnel tunnel_id {tunnel_id} peer_tunnel_id {tunnel_id} encap udp local {addr2} remote {addr1} udp_sport {port} udp_dport {port}')
-        exec(tid, remote2, f'ip l2tp add session name {ifname2} tunnel_id {tunnel_id} session_id {session_id} peer_session_id {session_id}')
-        exec(tid, remote2, f'ip link set "{ifname2}" netns "switch"')
+        if _l2tp.add_session(remote2, tunnel_id, session_id):
+            _commands.ip(tid, remote2, None, f'l2tp add tunnel tunnel_id {tunnel_id} peer_tunnel_id {tunnel_id} encap udp local {addr2} remote {addr1} udp_sport {port} udp_dport {port}')
+        _commands.ip(tid, remote2, None, f'l2tp add session name {ifname2} tunnel_id {tunnel_id} session_id {session_id} peer_session_id {session_id}')
+        _commands.ip(tid, remote2, None, f'link set {ifname2} netns switch')
 
     configure_interface(tid, remote1, 'switch', ifname1)
     configure_interface(tid, remote2, 'switch', ifname2)
 
     # put into bridge
-    exec(tid, remote1, f'ip netns exec "switch" ip link set "{ifname1}" master "{brname1}"')
-    exec(tid, remote2, f'ip netns exec "switch" ip link set "{ifname2}" master "{brname2}"')
+    _commands.ip(tid, remote1, 'switch', f'link set dev {ifname1} master {brname1}')
+    _commands.ip(tid, remote2, 'switch', f'link set dev {ifname2} master {brname2}')
 
     # isolate interfaces (they can only speak to the downlink interface in the bridge they are)
-    exec(tid, remote1, f'ip netns exec "switch" bridge link set dev "{ifname1}" isolated on')
-    exec(tid, remote2, f'ip netns exec "switch" bridge link set dev "{ifname2}" isolated on')
+    _commands.bridge(tid, remote1, 'switch', f'link set dev {ifname1} isolated on')
+    _commands.bridge(tid, remote2, 'switch', f'link set dev {ifname2} isolated on')
+
+    # delay/loss/rate of both directions
+    emulate_link(tid, remote1, ifname1, link, created=True)
+    emulate_link(tid, remote2, ifname2, link, created=True)
 
     # e.g. execute tc command on link
     if link_command is not None:
@@ -290,23 +845,326 @@ def create_link(link, link_command=None, rmap={}):
         extra = {'action': 'create', 'direction': 'source', 'ifname': ifname1}
         source_command = format_command(link_command, link, extra)
         if source_command is not None:
-            exec(tid, remote1, f'ip netns exec "switch" {source_command}')
+            _commands.shell(tid, remote1, f'ip netns exec "switch" {source_command}')
 
         # target -> source
         extra = {'action': 'create', 'direction': 'target', 'ifname': ifname2}
         target_command = format_command(link_command, link, extra)
         if target_command is not None:
-            exec(tid, remote2, f'ip netns exec "switch" {target_command}')
+            _commands.shell(tid, remote2, f'ip netns exec "switch" {target_command}')
 
 class _Task:
     def __init__(self):
         self.links_create = []
         self.links_update = []
         self.links_remove = []
+        self.links_up = []
+        self.links_down = []
+        # links with changes below the update thresholds (old link)
+        self.links_suppressed = []
         self.nodes_create = []
         self.nodes_update = []
         self.nodes_remove = []
 
+class _Unit:
+    def __init__(self, phase, remotes, func):
+        self.phase = phase
+        # all remotes the unit executes commands on
+        self.remotes = set(remotes)
+        # func(tid) emits the commands (None for a unit that only joins its dependencies)
+        self.func = func
+        self.deps = []
+        self.dependents = []
+        self.markers = 0
+        self.beg_ms = 0
+        self.end_ms = 0
+        # longest chain of dependencies including this unit
+        self.path_ms = 0
+
+'''
+Execute the node/link changes as a dependency graph. Every unit
+(e.g. a node creation) is started as soon as all units it depends
+on are finished. A finished unit is detected by a marker command
+that is queued after its commands on each remote it uses.
+'''
+class _Scheduler:
+    def __init__(self):
+        self.units = {}
+
+    def add(self, key, phase, remotes, func):
+        self.units[key] = _Unit(phase, remotes, func)
+
+    # unit key depends on unit dep_key (if it exists)
+    def depends(self, key, dep_key):
+        unit = self.units[key]
+        dep = self.units.get(dep_key)
+        if dep is not None:
+            unit.deps.append(dep)
+            dep.dependents.append(unit)
+
+    def run(self):
+        events = queue.Queue()
+        waiting = {}
+        ready = []
+
+        for unit in self.units.values():
+            waiting[unit] = len(unit.deps)
+            if len(unit.deps) == 0:
+                ready.append(unit)
+
+        def start(unit):
+            unit.beg_ms = millis()
+            tid = get_thread_id()
+            _commands.phase = unit.phase
+            if unit.func is not None:
+                unit.func(tid)
+            for remote in unit.remotes:
+                unit.markers += 1
+                exec(tid, remote, 'true', onResultCallBack=lambda rc, stdout, stderr: events.put(unit))
+            if unit.markers == 0:
+                # no commands, finished
+                unit.markers = 1
+                events.put(unit)
+
+        left = len(self.units)
+        while left > 0:
+            while len(ready) > 0:
+                start(ready.pop())
+
+            # called from the terminal threads
+            unit = events.get()
+            unit.markers -= 1
+            if unit.markers > 0:
+                continue
+
+            unit.end_ms = millis()
+            unit.path_ms = (unit.end_ms - unit.beg_ms) + max([dep.path_ms for dep in unit.deps], default=0)
+            left -= 1
+
+            for dependent in unit.dependents:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+
+    # phase => (duration_ms, critical_path_ms)
+    def get_timing(self):
+        timing = {}
+        for unit in self.units.values():
+            (beg_ms, end_ms, path_ms) = timing.get(unit.phase, (unit.beg_ms, unit.end_ms, unit.path_ms))
+            timing[unit.phase] = (min(beg_ms, unit.beg_ms), max(end_ms, unit.end_ms), max(path_ms, unit.path_ms))
+
+        return {phase: (end_ms - beg_ms, path_ms) for phase, (beg_ms, end_ms, path_ms) in timing.items()}
+
+def _get_phases(data, node_command, link_command, rmap):
+    def node_remotes(node):
+        return [rmap.get(str(node['id']))]
+
+    def link_remotes(link):
+        return [rmap.get(str(link['source'])), rmap.get(str(link['target']))]
+
+    return [
+        ('update nodes', data.nodes_update if node_command else [], node_remotes,
+            lambda node, tid: update_node(node, node_command, rmap, tid)),
+        ('update links', data.links_update, link_remotes,
+            lambda link, tid: update_link(link, link_command, rmap, tid)),
+        ('down links', data.links_down, link_remotes,
+            lambda link, tid: set_link_state(link, False, rmap, tid)),
+        ('up links', data.links_up, link_remotes,
+            lambda link, tid: set_link_state(link, True, rmap, tid)),
+        ('create nodes', data.nodes_create, node_remotes,
+            lambda node, tid: create_node(node, node_command, rmap, tid)),
+        ('create links', data.links_create, link_remotes,
+            lambda link, tid: create_link(link, link_command, rmap, tid)),
+        ('remove links', data.links_remove, link_remotes,
+            lambda link, tid: remove_link(link, link_command, rmap, tid)),
+        ('remove nodes', data.nodes_remove, node_remotes,
+            lambda node, tid: remove_node(node, node_command, rmap, tid)),
+    ]
+
+# execute one phase after another, returns timing
+def _run_phases(data, node_command, link_command, rmap):
+    timing = {}
+    path_ms = 0
+
+    for phase, items, _, func in _get_phases(data, node_command, link_command, rmap):
+        beg_ms = millis()
+        _commands.phase = phase
+
+        for item in items:
+            func(item, get_thread_id())
+
+        _commands.flush()
+
+        if len(items) > 0:
+            duration_ms = millis() - beg_ms
+            # every phase waits for the previous phase
+            path_ms += duration_ms
+            timing[phase] = (duration_ms, path_ms)
+
+    return timing
+
+# execute all phases as dependency graph, returns timing
+def _run_graph(data, node_command, link_command, rmap):
+    scheduler = _Scheduler()
+
+    for phase, items, get_remotes, func in _get_phases(data, node_command, link_command, rmap):
+        for item in items:
+            if 'id' in item:
+                key = (phase, str(item['id']))
+            else:
+                key = (phase, link_id(str(item['source']), str(item['target'])))
+            scheduler.add(key, phase, get_remotes(item), lambda tid, item=item, func=func: func(item, tid))
+
+    # links need both nodes
+    for link in data.links_create:
+        source = str(link['source'])
+        target = str(link['target'])
+        key = ('create links', link_id(source, target))
+        scheduler.depends(key, ('create nodes', source))
+        scheduler.depends(key, ('create nodes', target))
+
+    # nodes need to be removed after their links
+    for link in data.links_remove:
+        source = str(link['source'])
+        target = str(link['target'])
+        dep_key = ('remove links', link_id(source, target))
+        for node in [source, target]:
+            if ('remove nodes', node) in scheduler.units:
+                scheduler.depends(('remove nodes', node), dep_key)
+
+    # links between the same remotes share a l2tp tunnel or VXLAN device: the first
+    # created link creates it and the last removed link removes it (see registries)
+    def get_tunnel(link):
+        remote1 = rmap.get(str(link['source']))
+        remote2 = rmap.get(str(link['target']))
+        return frozenset([remote1, remote2]) if remote1 != remote2 else None
+
+    tunnel_creates = {}
+    for link in data.links_create:
+        tunnel = get_tunnel(link)
+        if tunnel is not None:
+            key = ('create links', link_id(str(link['source']), str(link['target'])))
+            tunnel_creates.setdefault(tunnel, []).append(key)
+
+    for keys in tunnel_creates.values():
+        for key in keys[1:]:
+            scheduler.depends(key, keys[0])
+
+    tunnel_removes = {}
+    for link in data.links_remove:
+        tunnel = get_tunnel(link)
+        if tunnel is not None:
+            key = ('remove links', link_id(str(link['source']), str(link['target'])))
+            tunnel_removes.setdefault(tunnel, []).append(key)
+
+    for tunnel, keys in tunnel_removes.items():
+        for key in keys[:-1] + tunnel_creates.get(tunnel, []):
+            scheduler.depends(keys[-1], key)
+
+    scheduler.run()
+    wait_for_completion()
+
+    return scheduler.get_timing()
+
+'''
+Execute the node/link changes in batch mode as dependency graph.
+The commands of all phases are collected first. Every batch file
+(per phase, remote, namespace and tool) and shell command becomes
+a unit. On each remote, a phase runs the shell commands that come
+before the batch files, the batch files of the root namespace, the
+"switch" namespace and the node namespaces (reverse for removals)
+and then the other shell commands. A phase only waits for phases
+it depends on and on the same remote (e.g. links need the bridges
+of their nodes), so a slow remote does not stall the other remotes.
+'''
+def _run_batch_graph(data, node_command, link_command, rmap):
+    scheduler = _Scheduler()
+    # (phase, remote) => key of first/last unit
+    starts = {}
+    ends = {}
+
+    def file_unit(remote, nsname, tool, lines):
+        def run(tid):
+            if not _commands._run_netlink(remote, nsname, tool, lines):
+                _commands._run_file(tid, remote, nsname, tool, lines)
+        return run
+
+    def shell_unit(remote, command):
+        def run(tid):
+            _commands._count_process(remote)
+            exec(tid, remote, command)
+        return run
+
+    for phase, items, _, func in _get_phases(data, node_command, link_command, rmap):
+        _commands.phase = phase
+        for item in items:
+            func(item, get_thread_id())
+
+        (files, pre, post) = _commands.take()
+
+        # remote => [stage], stage: [chain], chain: [func]
+        stages = {}
+        def get_stages(remote):
+            return stages.setdefault(remote, {'pre': [], None: {}, 'switch': {}, 'node': {}, 'post': []})
+
+        for _, remote, command in pre:
+            get_stages(remote)['pre'].append([shell_unit(remote, command)])
+        for (remote, nsname, tool), lines in files.items():
+            kind = nsname if nsname in [None, 'switch'] else 'node'
+            # batch files of the same namespace run in order of their first command
+            get_stages(remote)[kind].setdefault(nsname, []).append(file_unit(remote, nsname, tool, lines))
+        for _, remote, command in post:
+            get_stages(remote)['post'].append([shell_unit(remote, command)])
+
+        order = [None, 'switch', 'node']
+        if phase.startswith('remove'):
+            order.reverse()
+
+        for remote, remote_stages in stages.items():
+            prev = (phase, remote, 'start')
+            scheduler.add(prev, phase, [], None)
+            starts[(phase, remote)] = prev
+
+            for kind in ['pre'] + order + ['post']:
+                chains = remote_stages[kind]
+                if isinstance(chains, dict):
+                    chains = list(chains.values())
+                if len(chains) == 0:
+                    continue
+
+                # join all chains of the stage
+                join = (phase, remote, kind, 'end')
+                for i, chain in enumerate(chains):
+                    last = prev
+                    for j, run in enumerate(chain):
+                        key = (phase, remote, kind, i, j)
+                        scheduler.add(key, phase, [remote], run)
+                        scheduler.depends(key, last)
+                        last = key
+                    chains[i] = last
+                scheduler.add(join, phase, [], None)
+                for last in chains:
+                    scheduler.depends(join, last)
+                prev = join
+
+            ends[(phase, remote)] = prev
+
+    # Links need the bridges of their nodes. Removed links might share a l2tp
+    # tunnel or VXLAN device with created links. Nodes are removed after their
+    # links. Updates and link states do not touch created/removed nodes/links.
+    phase_deps = {'create links': 'create nodes', 'remove links': 'create links', 'remove nodes': 'remove links'}
+    for (phase, remote), start in starts.items():
+        dep = phase_deps.get(phase)
+        while dep is not None and (dep, remote) not in ends:
+            dep = phase_deps.get(dep)
+        if dep is not None:
+            scheduler.depends(start, ends[(dep, remote)])
+
+    scheduler.run()
+    wait_for_completion()
+
+    return scheduler.get_timing()
+
 def _process_json(json_data):
     # in reality, only '@', ':', '/' and whitespace should cause problems
     name_re = re.compile(r'^[\w-]{1,6}$')
@@ -347,9 +1205,13 @@ def _process_json(json_data):
     return (links, nodes)
 
 '''
-Decide what nodex/links need to be changed
+Decide what nodex/links need to be changed. Links in down_links
+are set down. With toggle, links that disappear are set down
+instead of removed and set up again when they reappear. Link
+attribute changes below thresholds ({attribute => minimum change})
+do not cause an update, these links are in links_suppressed.
 '''
-def _get_task(old_state, new_state):
+def _get_task(old_state, new_state, down_links=set(), toggle=False, thresholds={}):
     (links_old, nodes_old) = _process_json(old_state)
     (links_new, nodes_new) = _process_json(new_state)
 
@@ -365,6 +1227,26 @@ def _get_task(old_state, new_state):
 
         return True
 
+    # if some link property has changed (by at least its threshold)
+    def link_changed(old, new, thresholds):
+        for key in set(old.keys()) | set(new.keys()):
+            # source/target might be swapped or of a different type
+            if key in ['source', 'target']:
+                continue
+            value1 = old.get(key)
+            value2 = new.get(key)
+            if value1 == value2:
+                continue
+            if value1 is None or value2 is None:
+                return True
+            try:
+                # compare numbers, e.g. "10" and 10.0
+                if abs(float(value1) - float(value2)) >= thresholds.get(key, sys.float_info.min):
+                    return True
+            except ValueError:
+                return True
+        return False
+
     task = _Task()
 
     for key in links_new:
@@ -373,14 +1255,26 @@ def _get_task(old_state, new_state):
 
     for key in links_old:
         if key not in links_new:
-            task.links_remove.append(links_old[key])
+            old = links_old[key]
+            if toggle and str(old['source']) in nodes_new and str(old['target']) in nodes_new:
+                # keep link for later
+                if key not in down_links:
+                    task.links_down.append(old)
+            else:
+                task.links_remove.append(old)
+
+    for key in links_new:
+        if key in links_old and key in down_links:
+            task.links_up.append(links_new[key])
 
     for key in links_new:
         if key in links_old:
             new = links_new[key]
             old = links_old[key]
-            if not obj_equal(new, old):
+            if link_changed(old, new, thresholds):
                 task.links_update.append(new)
+            elif link_changed(old, new, {}):
+                task.links_suppressed.append(old)
 
     for key in nodes_new:
         if key in nodes_old:
@@ -402,13 +1296,24 @@ def _get_task(old_state, new_state):
 def show(remotes=default_remotes):
     check_access(remotes)
 
-    for remote_id, remote in enumerate(remotes):
-        tid = get_thread_id()
-        nodes = exec(tid, remote, 'ip netns list', get_output=True)[0].count('ns-')
-        veth = int(exec(tid, remote, 'ip netns exec switch ip addr list | grep -c "@ve-" || true', get_output=True)[0]) // 2
-        l2tp = int(exec(tid, remote, 'ip l2tp show session | grep -c "ve-" || true', get_output=True)[0])
+    commands = [
+        f'ip netns list; ls {holder_dir} 2> /dev/null; true',
+        'ip netns exec switch ip addr list | grep -c "@ve-" || true',
+        'ip l2tp show session | grep -c "ve-" || true',
+        'ip netns exec switch ip addr list | grep -c "@vx-" || true',
+    ]
+
+    # query all remotes at once
+    futures = [[exec_async(get_thread_id(), remote, command) for command in commands] for remote in remotes]
+
+    for remote, remote_futures in zip(remotes, futures):
+        results = [stdout for (stdout, _, _) in gather(remote_futures)]
+        nodes = results[0].count('ns-')
+        veth = int(results[1]) // 2
+        l2tp = int(results[2])
+        vxlan = int(results[3])
         label = remote.address or 'local'
-        print(f'{label}: {nodes} nodes, {veth} veth links, {l2tp} l2tp links')
+        print(f'{label}: {nodes} nodes, {veth} veth links, {l2tp} l2tp links, {vxlan} vxlan links')
 
 def clear(remotes=default_remotes):
     check_access(remotes)
@@ -416,147 +1321,203 @@ def clear(remotes=default_remotes):
     for remote in remotes:
         tid = get_thread_id()
         exec(tid, remote, 'ip -all netns delete || true')
+        # node namespaces of holder processes
+        exec(tid, remote, f'cat {holder_dir}/ns-* 2> /dev/null | xargs -r kill; rm -rf {holder_dir}')
         # removal of all l2tp tunnels - removes all sessions as well
         exec(tid, remote, 'ip l2tp show tunnel | grep Tunnel | tr "," " " | cut -d" " -f2 | xargs -r -n1 ip l2tp del tunnel tunnel_id')
 
+    clear_addresses()
+
 '''
-Get a dict to map nodes to remote computers
+Get the relative capacity of each remote for the node placement.
+An explicit weight is used first, then the CPU count and memory
+size (the scarcer one limits). Attributes are only used if given
+for every remote. Equal capacities otherwise.
 '''
-def _get_remote_mapping(cur_state, new_state, remotes, cur_state_rmap):
-    def partition_into_subgraph_nodes(neighbor_map, nodes, rmap, remotes):
-        random.shuffle(nodes)
-        # remote_id => [<node_ids>]
-        partitions = {}
-
-        # keep running nodes on the same partition
-        for node_id, remote in rmap.items():
-            remote_id = remotes.index(remote)
-            partitions.setdefault(remote_id, []).append(node_id)
-            if node_id not in nodes:
-                eprint(f'Node {node_id} not in previous state!')
+def _get_capacities(remotes):
+    for remote in remotes:
+        for key in ['weight', 'cpus', 'memory_mb']:
+            value = getattr(remote, key)
+            if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+                eprint(f'Invalid remote {key}: {value}')
                 stop_all_terminals()
                 exit(1)
-            nodes.remove(node_id)
-
-        for remote_id in range(len(remotes)):
-            if len(nodes) == 0:
-                break
-            if remote_id not in partitions:
-                partitions[remote_id] = [nodes.pop()]
-
-        # find neighbor node of cluster
-        def grow_cluster(cluster, nodes):
-            for node in nodes:
-                for cluster_node in cluster:
-                    if node in neighbor_map[cluster_node]:
-                        cluster.append(node)
-                        nodes.remove(node)
-                        return
-            # cannot extend cluster via neighbor => use left over node
-            cluster.append(nodes.pop())
-
-        while len(nodes) > 0:
-            # get smallest cluster (remote) key
-            key = min(partitions.keys(), key=lambda k: len(partitions[k]))
-            grow_cluster(partitions[key], nodes)
-
-        return partitions
-
-    # get node distribution balance
-    def get_variance(partition):
-        median = 0
-        for remote_id, cluster in partition.items():
-            median += len(cluster)
-        median /= len(partition)
-
-        q = 0
-        for remote_id, cluster in partition.items():
-            q = (len(cluster) - median) ** 2
-
-        return math.sqrt(q / len(partition))
-
-    def partition_to_map(partition, remotes):
-        node_to_remote_map = {}
-        for remote_id, node_ids in partition.items():
-            for node_id in node_ids:
-                node_to_remote_map[node_id] = remotes[remote_id]
-        return node_to_remote_map
-
-    '''
-    # debug output
-    def debug_partition(partition, remotes):
-        print('partitioning:')
 
-        for remote_id, cluster in partition.items():
-            print('  {}: {} nodes'.format(remotes[remote_id].get('address', 'local'), len(cluster)))
+    def get_shares(key):
+        values = [getattr(remote, key) for remote in remotes]
+        if None in values:
+            return None
+        return [value / sum(values) for value in values]
+
+    weights = get_shares('weight')
+    if weights is not None:
+        return weights
+
+    shares = [s for s in [get_shares('cpus'), get_shares('memory_mb')] if s is not None]
+    if len(shares) > 0:
+        return [min(values) for values in zip(*shares)]
+
+    return [1] * len(remotes)
+
+'''
+Get link weights from a numeric link attribute (e.g. bandwidth_mbit)
+so that heavy links are kept on the same remote.
+'''
+def _get_link_weights(state, attribute):
+    link_weights = {}
+    if attribute is None:
+        return link_weights
+
+    for link in state.get('links', []):
+        value = link.get(attribute)
+        if value is None:
+            continue
+        try:
+            # at least 1 to keep the link relevant for the partitioning
+            link_weights[link_id(str(link['source']), str(link['target']))] = max(1.0, float(value))
+        except ValueError:
+            eprint(f'Invalid link {attribute}: {value}')
+            stop_all_terminals()
+            exit(1)
 
-        interconnects = 0
-        node_to_remote_map = partition_to_map(partition, remotes)
-        for link in new_state.get('links', []):
-            if node_to_remote_map[str(link['source'])] is not node_to_remote_map[str(link['target'])]:
-                interconnects += 1
-        print(f'  l2tp links: {interconnects}')
-    '''
+    return link_weights
 
-    # try multiple random (connected) partitions and select the best
+'''
+Get a dict to map nodes to remote computers
+'''
+def _get_remote_mapping(cur_state, new_state, remotes, cur_state_rmap):
     neighbor_map = convert_to_neighbors(cur_state, new_state)
-    tries = 20
-    lowest_variance = math.inf
-    best_partition = []
 
     # shortcut: if no mapping on multiple remotes is needed
     if len(remotes) == 1 and len(cur_state_rmap) == 0:
-        return partition_to_map({0: neighbor_map.keys()}, remotes)
-
-    for _ in range(tries):
-        partition = partition_into_subgraph_nodes(neighbor_map, list(neighbor_map.keys()), cur_state_rmap, remotes)
-        if partition:
-            variance = get_variance(partition)
-            if variance < lowest_variance:
-                lowest_variance = variance
-                best_partition = partition
-
-    if len(best_partition) == 0:
-        eprint('No network partition found.')
-        stop_all_terminals()
-        exit(1)
+        return {node_id: remotes[0] for node_id in neighbor_map}
+
+    # keep running nodes on the same remote
+    fixed = {}
+    for node_id, remote in cur_state_rmap.items():
+        if node_id not in neighbor_map:
+            eprint(f'Node {node_id} not in previous state!')
+            stop_all_terminals()
+            exit(1)
+        fixed[node_id] = remotes.index(remote)
+
+    capacities = _get_capacities(remotes)
+    link_weights = _get_link_weights(new_state, link_weight)
+
+    # node_id => remote_id
+    mapping = partition.partition(neighbor_map, capacities, fixed, link_weights)
 
-    #if verbosity in ['verbose', 'normal']:
-    #    debug_partition(best_partition, remotes)
+    if verbosity != 'quiet' and len(remotes) > 1:
+        sizes = [0] * len(remotes)
+        for remote_id in mapping.values():
+            sizes[remote_id] += 1
+        targets = [len(mapping) * capacity / sum(capacities) for capacity in capacities]
+
+        print('partitioning:')
+        for remote_id, size in enumerate(sizes):
+            print(f'  {remotes[remote_id].address or "local"}: {size} nodes (target {targets[remote_id]:.0f})')
+        balance = max(size / target for size, target in zip(sizes, targets)) if len(mapping) > 0 else 1.0
+        print(f'  l2tp links: {partition.get_cut(neighbor_map, mapping)}, balance: {balance:.2f}')
+        if link_weight is not None:
+            print(f'  l2tp {link_weight}: {partition.get_cut(neighbor_map, mapping, link_weights):g}')
 
     # node_id => remote
-    return partition_to_map(best_partition, remotes)
+    return {node_id: remotes[remote_id] for node_id, remote_id in mapping.items()}
+
+'''
+Get the union of all nodes and links of multiple states (e.g. of a
+mobility trace). Can be used to create all links once and then only
+set them up/down using toggle_links.
+'''
+def get_union(states):
+    nodes = {}
+    links = {}
+    for state in states:
+        for node in state.get('nodes', []):
+            nodes.setdefault(str(node['id']), node)
+        for link in state.get('links', []):
+            links.setdefault(link_id(str(link['source']), str(link['target'])), link)
+    return {'nodes': list(nodes.values()), 'links': list(links.values())}
 
 def state_empty(state):
     return (len(state.get('links', []))) == 0 and (len(state.get('nodes', [])) == 0)
 
+# handle different new_state types
+def _load_state(new_state):
+    if isinstance(new_state, str):
+        if new_state == 'none':
+            return {}
+
+        if not os.path.isfile(new_state):
+            eprint(f'File not found: {new_state}')
+            stop_all_terminals()
+            exit(1)
+
+        with open(new_state) as file:
+            return json.load(file)
+
+    return new_state
+
+# get remote mapping and task to change cur_state into new_state
+def _get_changes(cur_state, new_state, remotes, cur_state_rmap, down_links, qdiscs):
+    # map each node to a remote or local computer
+    # distribute evenly with minimized interconnects
+    rmap = _get_remote_mapping(cur_state, new_state, remotes, cur_state_rmap)
+
+    # current link emulation settings (the links of cur_state have them
+    # as attributes already), so that only changed qdiscs are updated
+    _qdiscs.qdiscs = qdiscs
+
+    # compare with the attributes we applied last (if known)
+    for link in cur_state.get('links', []):
+        applied = _applied_links.get(link_id(str(link['source']), str(link['target'])))
+        if applied is not None:
+            link.update({key: value for key, value in applied.items() if key not in ['source', 'target']})
+
+    data = _get_task(cur_state, new_state, down_links, toggle_links, update_thresholds)
+
+    return (rmap, data)
+
 def apply(state={}, node_command=None, link_command=None, remotes=default_remotes):
     check_access(remotes)
 
-    new_state = state
-    (cur_state, cur_state_rmap) = get_current_state(remotes)
+    down_links = set()
+    qdiscs = {}
+    (cur_state, cur_state_rmap) = get_current_state(remotes, down_links, qdiscs)
 
+    (new_state, _, _) = apply_changes(cur_state, cur_state_rmap, down_links, qdiscs, state, node_command, link_command, remotes)
+
+    return new_state
+
+'''
+Apply state on top of a known current state (see get_current_state)
+without querying it first. Used by NetworkSession (session.py) that
+keeps the current state in memory. The l2tp/VXLAN registries are only
+reloaded if load_interconnects is set.
+Returns (new_state, rmap, task).
+'''
+def apply_changes(cur_state, cur_state_rmap, down_links, qdiscs, state={}, node_command=None, link_command=None, remotes=default_remotes, load_interconnects=True):
     # Only needs to be execute once
     if len(cur_state_rmap) == 0:
         system_setup(remotes)
 
-    # handle different new_state types
-    if isinstance(new_state, str):
-        if new_state == 'none':
-            new_state = {}
-        else:
-            if not os.path.isfile(new_state):
-                eprint(f'File not found: {new_state}')
-                stop_all_terminals()
-                exit(1)
+    new_state = _load_state(state)
+    (rmap, data) = _get_changes(cur_state, new_state, remotes, cur_state_rmap, down_links, qdiscs)
 
-            with open(new_state) as file:
-                new_state = json.load(file)
+    # keep the old values of suppressed updates as reference for the next change
+    _applied_links.clear()
+    for link in new_state.get('links', []):
+        _applied_links[link_id(str(link['source']), str(link['target']))] = link
+    for link in data.links_suppressed:
+        _applied_links[link_id(str(link['source']), str(link['target']))] = link
 
-    # map each node to a remote or local computer
-    # distribute evenly with minimized interconnects
-    rmap = _get_remote_mapping(cur_state, new_state, remotes, cur_state_rmap)
-    data = _get_task(cur_state, new_state)
+    # l2tp tunnels/sessions and VXLAN devices are only used between remotes
+    if len(remotes) > 1 and load_interconnects:
+        _load_interconnects(remotes)
+
+    global _commands
+    # the netlink backend works on batch files
+    _commands = _Commands(batched=_is_batched())
 
     beg_ms = millis()
 
@@ -567,38 +1528,29 @@ def apply(state={}, node_command=None, link_command=None, remotes=default_remote
             # add switch if it does not exist yet
             exec(tid, remote, 'ip netns add "switch" || true')
             # disable IPv6 in switch namespace (no need, less overhead)
-            exec(tid, remote, 'ip netns exec "switch" sysctl -q -w net.ipv6.conf.all.disable_ipv6=1')
-
-    for node in data.nodes_update:
-        if node_command:
-            update_node(node, node_command, rmap)
-
-    wait_for_completion()
-
-    for link in data.links_update:
-        update_link(link, link_command, rmap)
-
-    wait_for_completion()
-
-    for node in data.nodes_create:
-        create_node(node, node_command, rmap)
+            # default also covers the interfaces that are created later
+            exec(tid, remote, 'ip netns exec "switch" sysctl -q -w net.ipv6.conf.all.disable_ipv6=1 net.ipv6.conf.default.disable_ipv6=1')
 
-    wait_for_completion()
-
-    for link in data.links_create:
-        create_link(link, link_command, rmap)
-
-    wait_for_completion()
-
-    for link in data.links_remove:
-        remove_link(link, link_command, rmap)
+    if namespaces == 'holder' and len(data.nodes_create) > 0:
+        _start_holders(data.nodes_create, rmap)
 
-    wait_for_completion()
+    # namespaces of removed nodes that might have a netlink reader (before the holder PIDs are removed)
+    removed_netns = [local_netns(rmap.get(str(node['id'])), node['id']) for node in data.nodes_remove]
 
-    for node in data.nodes_remove:
-        remove_node(node, node_command, rmap)
+    if phase_barriers:
+        timing = _run_phases(data, node_command, link_command, rmap)
+    else:
+        # switch namespace needs to exist
+        wait_for_completion()
+        if _commands.batched:
+            timing = _run_batch_graph(data, node_command, link_command, rmap)
+        else:
+            timing = _run_graph(data, node_command, link_command, rmap)
 
-    wait_for_completion()
+    # addresses of these nodes need to be read again
+    clear_addresses(node['id'] for node in data.nodes_create + data.nodes_update + data.nodes_remove)
+    # an open netlink socket keeps the namespace alive
+    netlink.close_readers(nsname for nsname in removed_netns if nsname is not None)
 
     # remove "switch" namespace
     if state_empty(new_state):
@@ -610,12 +1562,199 @@ def apply(state={}, node_command=None, link_command=None, remotes=default_remote
     wait_for_completion()
     end_ms = millis()
 
+    # calibration of the plan estimate
+    _record_timing(timing)
+
     if verbosity != 'quiet':
         print('network setup in {}:'.format(format_duration(end_ms - beg_ms)))
         print(f'  nodes: {len(data.nodes_create)} created, {len(data.nodes_remove)} removed, {len(data.nodes_update)} updated')
         print(f'  links: {len(data.links_create)} created, {len(data.links_remove)} removed, {len(data.links_update)} updated')
+        if len(data.links_up) > 0 or len(data.links_down) > 0:
+            print(f'  links: {len(data.links_up)} set up, {len(data.links_down)} set down')
+        if len(data.links_suppressed) > 0:
+            print(f'  links: {len(data.links_suppressed)} updates suppressed (below update thresholds)')
+        print(f'  commands: {_commands.command_count} in {_commands.process_count} processes')
+        for phase, (duration_ms, path_ms) in timing.items():
+            print(f'  {phase}: {format_duration(duration_ms)} (critical path {format_duration(path_ms)})')
+        comparison = _compare_timing(timing)
+        if comparison is not None:
+            (other_ms, measurements) = comparison
+            duration_ms = sum(duration_ms for duration_ms, _ in timing.values())
+            mode = 'without batch mode' if _commands.batched else 'in batch mode'
+            print(f'  speedup: {other_ms / max(1, duration_ms):.1f}x (~{format_duration(other_ms)} {mode}, from {measurements} earlier measurements)')
+
+    return (new_state, rmap, data)
+
+# the netlink backend works on batch files
+def _is_batched():
+    return batch or backend == 'netlink'
+
+# measured durations of earlier applies
+timing_file = os.path.join(os.path.expanduser('~'), '.cache', 'meshnet-lab', 'apply-timing.json')
+# number of phase measurements to keep
+timing_records = 200
+# per command, used until a phase was measured
+default_ms_per_command = {True: 0.5, False: 5.0}
+
+def _load_timing():
+    try:
+        with open(timing_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return []
+
+# max. number of commands/processes on a single remote per phase
+def _get_phase_counts(commands):
+    counts = {}
+    for (phase, remote, _), count in commands.counts.items():
+        counts.setdefault(phase, {})
+        counts[phase][remote] = counts[phase].get(remote, 0) + count
+    return {phase: max(remote_counts.values()) for phase, remote_counts in counts.items()}
+
+def _record_timing(timing):
+    counts = _get_phase_counts(_commands)
+    records = _load_timing()
+    for phase, (duration_ms, _) in timing.items():
+        if counts.get(phase, 0) > 0:
+            records.append({'batched': _commands.batched, 'phase': phase, 'commands': counts[phase], 'duration_ms': duration_ms})
+
+    try:
+        os.makedirs(os.path.dirname(timing_file), exist_ok=True)
+        with open(timing_file, 'w') as file:
+            json.dump(records[-timing_records:], file)
+    except OSError as e:
+        eprint(f'Cannot write {timing_file}: {e.strerror}')
+
+# Duration of the phases in the other mode (batched or not) based on earlier
+# applies, returns (duration_ms, number of measurements) or None if not measured
+def _compare_timing(timing):
+    counts = _get_phase_counts(_commands)
+    records = _load_timing()
+    other_ms = 0
+    measurements = 0
+    for phase in timing.keys():
+        if counts.get(phase, 0) == 0:
+            continue
+        (estimate_ms, n) = _estimate_ms(records, not _commands.batched, phase, counts[phase])
+        if n == 0:
+            return None
+        other_ms += estimate_ms
+        measurements += n
+    return (other_ms, measurements) if measurements > 0 else None
+
+# returns (estimate_ms, number of measurements used)
+def _estimate_ms(records, batched, phase, commands):
+    matching = [r for r in records if r['batched'] == batched and r['phase'] == phase]
+    total_commands = sum(r['commands'] for r in matching)
+    if total_commands == 0:
+        return (commands * default_ms_per_command[batched], 0)
+    return (commands * sum(r['duration_ms'] for r in matching) / total_commands, len(matching))
+
+# count the commands of all phases without executing them (see plan)
+def _plan(state, node_command, link_command, remotes, from_empty):
+    global _commands
+
+    down_links = set()
+    qdiscs = {}
+    if from_empty:
+        (cur_state, cur_state_rmap) = ({}, {})
+    else:
+        (cur_state, cur_state_rmap) = get_current_state(remotes, down_links, qdiscs)
 
-    return new_state
+    new_state = _load_state(state)
+    (rmap, data) = _get_changes(cur_state, new_state, remotes, cur_state_rmap, down_links, qdiscs)
+
+    if len(remotes) > 1 and not from_empty:
+        _load_interconnects(remotes)
+    else:
+        _l2tp.tunnels = {}
+        _vxlan.devices = {}
+
+    # only count the commands
+    _commands = _Commands(batched=_is_batched(), dry=True)
+    for phase, items, _, func in _get_phases(data, node_command, link_command, rmap):
+        _commands.phase = phase
+        for item in items:
+            func(item, get_thread_id())
+        _commands.flush()
+
+    records = _load_timing()
+    phases = []
+    for phase, commands in _get_phase_counts(_commands).items():
+        (estimate_ms, measurements) = _estimate_ms(records, _commands.batched, phase, commands)
+        phases.append({'phase': phase, 'commands': commands, 'estimate_ms': round(estimate_ms), 'measurements': measurements})
+
+    remote_plans = []
+    for remote in remotes:
+        commands = {}
+        for (_, r, tool), count in _commands.counts.items():
+            if r == remote:
+                commands[tool] = commands.get(tool, 0) + count
+        processes = sum(count for (_, r), count in _commands.process_counts.items() if r == remote)
+        nodes = sum(1 for node_id in convert_to_neighbors(new_state) if rmap.get(node_id) == remote)
+        remote_plans.append({'address': remote.address or 'local', 'nodes': nodes, 'commands': commands, 'processes': processes})
+
+    def is_cross_remote(link):
+        return rmap.get(str(link['source'])) != rmap.get(str(link['target']))
+
+    result = {
+        'batched': _commands.batched,
+        'nodes': {'create': len(data.nodes_create), 'remove': len(data.nodes_remove), 'update': len(data.nodes_update)},
+        'links': {'create': len(data.links_create), 'remove': len(data.links_remove), 'update': len(data.links_update),
+            'up': len(data.links_up), 'down': len(data.links_down), 'suppressed': len(data.links_suppressed)},
+        'cross_remote_links': sum(1 for link in new_state.get('links', []) if is_cross_remote(link)),
+        'cross_remote_links_create': sum(1 for link in data.links_create if is_cross_remote(link)),
+        'remotes': remote_plans,
+        'phases': phases,
+        # phases run one after another (batch mode) or overlap (upper bound)
+        'estimate_ms': sum(p['estimate_ms'] for p in phases),
+    }
+
+    return result
+
+'''
+Show what apply would do without changing anything: number of
+changes, commands per remote and type, links between remotes and
+the estimated duration (based on the measured durations of earlier
+applies). Returns the plan as dict.
+'''
+def plan(state={}, node_command=None, link_command=None, remotes=default_remotes, from_empty=False, as_json=False):
+    global verbosity, _commands, _l2tp, _vxlan, _qdiscs
+    check_access(remotes)
+
+    # The dry run updates the interconnect and qdisc registries like
+    # apply does. Restore them afterwards, so nothing is changed.
+    saved = (verbosity, _commands, _l2tp, _vxlan, _qdiscs)
+    (_l2tp, _vxlan, _qdiscs) = (_L2tpRegistry(), _VxlanRegistry(), _QdiscRegistry())
+    if as_json:
+        # only print the JSON (e.g. not the partitioning)
+        verbosity = 'quiet'
+
+    try:
+        result = _plan(state, node_command, link_command, remotes, from_empty)
+    finally:
+        (verbosity, _commands, _l2tp, _vxlan, _qdiscs) = saved
+
+    if as_json:
+        print(json.dumps(result, indent=2))
+    elif verbosity != 'quiet':
+        (nodes, phases) = (result['nodes'], result['phases'])
+        links = result['links']
+        print(f'plan ({"batch mode" if result["batched"] else "no batch mode"}):')
+        print(f'  nodes: {nodes["create"]} create, {nodes["remove"]} remove, {nodes["update"]} update')
+        print(f'  links: {links["create"]} create, {links["remove"]} remove, {links["update"]} update, {links["up"]} up, {links["down"]} down')
+        if links['suppressed'] > 0:
+            print(f'  links: {links["suppressed"]} updates suppressed (below update thresholds)')
+        print(f'  links between remotes: {result["cross_remote_links"]} ({result["cross_remote_links_create"]} to create)')
+        for r in result['remotes']:
+            commands = ', '.join(f'{tool} {count}' for tool, count in sorted(r['commands'].items())) or 'none'
+            print(f'  {r["address"]}: {r["nodes"]} nodes, commands: {commands} ({r["processes"]} processes)')
+        for p in phases:
+            calibration = f'{p["measurements"]} measurements' if p['measurements'] > 0 else 'not calibrated'
+            print(f'  {p["phase"]}: {p["commands"]} commands, ~{format_duration(p["estimate_ms"])} ({calibration})')
+        print(f'  estimated time: ~{format_duration(result["estimate_ms"])}')
+
+    return result
 
 
 def main():
@@ -629,11 +1768,31 @@ def main():
     parser.add_argument('--disable-layer3', action='store_true', help='Disable IP addresses on mesh interface.')
     parser.add_argument('--remotes', help='Distribute nodes and links on remotes described in the JSON file.')
     parser.add_argument('--mtu', type=int, default=1500, help='Set Maximum Transfer Unit (MTU) on each interface.')
+    parser.add_argument('--no-batch', action='store_true', help='Execute each ip/bridge/tc command on its own instead of in batch mode.')
+    parser.add_argument('--phase-barriers', action='store_true', help='Execute the phases (e.g. create nodes, create links) one after another instead of as dependency graph.')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace (JSON) of all executed commands to FILE.')
 
     subparsers = parser.add_subparsers(dest='action', required=True)
 
     parser_change = subparsers.add_parser('apply', help='Create or change a virtual network.')
-    parser_change.add_argument('new_state', help='JSON file that describes the target topology. Use "none" to remove all network namespaces.')
+    parser_plan = subparsers.add_parser('plan', help='Show what apply would do and estimate how long it takes, without changing anything.')
+    parser_plan.add_argument('--json', action='store_true', help='Print the plan as JSON.')
+    parser_plan.add_argument('--from-empty', action='store_true', help='Plan against an empty network instead of the current network.')
+
+    for subparser in [parser_change, parser_plan]:
+        subparser.add_argument('--backend', choices=['iproute2', 'netlink'], default='iproute2',
+            help='Create bridges and veth interfaces using the ip/bridge commands or directly via netlink (local only).')
+        subparser.add_argument('--interconnect', choices=['l2tp', 'vxlan'], default='l2tp',
+            help='Connect links between remotes with a l2tp session each or with VLANs on a single VXLAN device per pair of remotes.')
+        subparser.add_argument('--toggle-links', action='store_true',
+            help='Set links down that are not in the new state (instead of removing them) and set them up again when they reappear.')
+        subparser.add_argument('--link-weight', metavar='ATTRIBUTE',
+            help='Keep links with a high value of this numeric link attribute (e.g. bandwidth_mbit) on the same remote.')
+        subparser.add_argument('--update-threshold', metavar='ATTRIBUTE=VALUE', action='append', default=[],
+            help='Ignore changes of a numeric link attribute below VALUE, e.g. latency_ms=1. Can be given multiple times.')
+        subparser.add_argument('--namespaces', choices=['netns', 'holder'], default='netns',
+            help='Create node namespaces with "ip netns add" or hold them by a process (unshare) without bind mounts, for large networks.')
+        subparser.add_argument('new_state', help='JSON file that describes the target topology. Use "none" to remove all network namespaces.')
     subparsers.add_parser('show', help='List all Linux network namespaces. Namespace "switch" is the special cable cabinet namespace.')
     subparsers.add_parser('clear', help='Remove all Linux network namespaces. Processes still might need to be killed.')
 
@@ -642,13 +1801,20 @@ def main():
     global disable_layer3
     global verbosity
     global mtu
+    global batch
+    global phase_barriers
 
     disable_layer3 = args.disable_layer3
     verbosity = args.verbosity
     mtu = args.mtu
+    batch = not args.no_batch
+    phase_barriers = args.phase_barriers
 
     globalTerminalGroup.setVerbosity(args.verbosity)
 
+    if args.trace:
+        start_trace(args.trace)
+
     if args.remotes:
         if not os.path.isfile(args.remotes):
             eprint(f'File not found: {args.remotes}')
@@ -664,12 +1830,42 @@ def main():
         clear(args.remotes)
     elif args.action == 'show':
         show(args.remotes)
-    elif args.action == 'apply':
-        apply(args.new_state, args.node_command, args.link_command, args.remotes)
+    elif args.action in ['apply', 'plan']:
+        global backend
+        global link_weight
+        global interconnect
+        global toggle_links
+        global namespaces
+        for threshold in args.update_threshold:
+            (key, _, value) = threshold.partition('=')
+            try:
+                update_thresholds[key] = float(value)
+            except ValueError:
+                eprint(f'Invalid update threshold: {threshold}')
+                stop_all_terminals()
+                exit(1)
+        backend = args.backend
+        toggle_links = args.toggle_links
+        link_weight = args.link_weight
+        interconnect = args.interconnect
+        namespaces = args.namespaces
+        if args.action == 'apply':
+            apply(args.new_state, args.node_command, args.link_command, args.remotes)
+        else:
+            plan(args.new_state, args.node_command, args.link_command, args.remotes, args.from_empty, args.json)
     else:
         eprint(f'Invalid command: {args.action}')
         exit(1)
     stop_all_terminals()
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except CommandError as e:
+        # the terminals would keep the program alive
+        eprint(e.stdout)
+        eprint(e.stderr)
+        eprint(f'Abort, {e}')
+        eprint('Network might be in an undefined state!')
+        stop_all_terminals()
+        exit(1)
@@ -0,0 +1,335 @@
+import heapq
+import math
+
+from shared import link_id
+
+'''
+Multilevel graph partitioning (in the style of METIS) to
+distribute nodes on remotes with a minimal number of links
+between remotes (edge-cut) under a balance constraint.
+
+1. coarsen the graph by merging heavy edges
+2. partition the coarsest graph by greedy graph growing
+3. project back level by level and refine the partition
+   by moving boundary nodes (greedy k-way refinement)
+
+The result is deterministic.
+'''
+
+# allowed imbalance of a part relative to its target size
+imbalance = 0.03
+
+class _Graph:
+    def __init__(self, adj, vwgt, fixed):
+        # vertex => {vertex => edge weight}
+        self.adj = adj
+        # vertex weight (number of original nodes)
+        self.vwgt = vwgt
+        # fixed part of vertex or -1
+        self.fixed = fixed
+
+def _coarsen(graph, max_vwgt):
+    adj = graph.adj
+    vwgt = graph.vwgt
+    fixed = graph.fixed
+    n = len(adj)
+
+    def can_merge(u, v):
+        if fixed[u] != -1 and fixed[v] != -1 and fixed[u] != fixed[v]:
+            return False
+        return (vwgt[u] + vwgt[v]) <= max_vwgt
+
+    # heavy edge matching, visit low degree vertices first
+    match = [-1] * n
+    for u in sorted(range(n), key=lambda v: (len(adj[v]), v)):
+        if match[u] != -1:
+            continue
+
+        best = -1
+        best_weight = 0
+        for v, weight in adj[u].items():
+            if match[v] == -1 and v != u and can_merge(u, v):
+                if weight > best_weight or (weight == best_weight and v < best):
+                    best = v
+                    best_weight = weight
+
+        if best != -1:
+            match[u] = best
+            match[best] = u
+
+    # match isolated vertices with each other
+    isolated = -1
+    for u in range(n):
+        if match[u] == -1 and len(adj[u]) == 0:
+            if isolated != -1 and can_merge(isolated, u):
+                match[isolated] = u
+                match[u] = isolated
+                isolated = -1
+            else:
+                isolated = u
+
+    # vertex => coarse vertex
+    cmap = [-1] * n
+    cn = 0
+    for u in range(n):
+        if cmap[u] == -1:
+            cmap[u] = cn
+            if match[u] != -1:
+                cmap[match[u]] = cn
+            cn += 1
+
+    cadj = [{} for _ in range(cn)]
+    cvwgt = [0] * cn
+    cfixed = [-1] * cn
+    for u in range(n):
+        cu = cmap[u]
+        cvwgt[cu] += vwgt[u]
+        if fixed[u] != -1:
+            cfixed[cu] = fixed[u]
+        cneighbors = cadj[cu]
+        for v, weight in adj[u].items():
+            cv = cmap[v]
+            if cv != cu:
+                cneighbors[cv] = cneighbors.get(cv, 0) + weight
+
+    return (_Graph(cadj, cvwgt, cfixed), cmap)
+
+# greedy graph growing: grow one part after another from a seed
+def _grow_partition(graph, targets, seed):
+    adj = graph.adj
+    vwgt = graph.vwgt
+    n = len(adj)
+    k = len(targets)
+
+    part = list(graph.fixed)
+    part_weight = [0] * k
+    for v in range(n):
+        if part[v] != -1:
+            part_weight[part[v]] += vwgt[v]
+
+    # connectivity of unassigned vertices to assigned vertices
+    assigned_conn = [0] * n
+    for v in range(n):
+        if part[v] != -1:
+            for u, weight in adj[v].items():
+                assigned_conn[u] += weight
+
+    def next_seed():
+        # continue next to the already assigned region
+        best = -1
+        for v in range(n):
+            if part[v] == -1 and (best == -1 or assigned_conn[v] > assigned_conn[best]):
+                best = v
+        return best
+
+    for p in range(k):
+        # max heap of (-connectivity, vertex) with lazy deletion
+        heap = []
+        conn = {}
+
+        def add_neighbors(v):
+            for u, weight in adj[v].items():
+                if part[u] == -1:
+                    conn[u] = conn.get(u, 0) + weight
+                    heapq.heappush(heap, (-conn[u], u))
+
+        for v in range(n):
+            if part[v] == p:
+                add_neighbors(v)
+
+        while p == (k - 1) or part_weight[p] < targets[p]:
+            v = -1
+            while len(heap) > 0:
+                (_, u) = heapq.heappop(heap)
+                if part[u] == -1:
+                    v = u
+                    break
+
+            if v == -1:
+                if p == 0 and part[seed] == -1:
+                    v = seed
+                else:
+                    v = next_seed()
+                if v == -1:
+                    # all vertices assigned
+                    break
+
+            part[v] = p
+            part_weight[p] += vwgt[v]
+            for u, weight in adj[v].items():
+                assigned_conn[u] += weight
+            add_neighbors(v)
+
+    return part
+
+def _get_edge_cut(graph, part):
+    cut = 0
+    for v in range(len(graph.adj)):
+        for u, weight in graph.adj[v].items():
+            if part[u] != part[v]:
+                cut += weight
+    return cut / 2
+
+def _initial_partition(graph, targets, tries=8):
+    n = len(graph.adj)
+
+    # start from different (low degree) vertices and keep the best
+    candidates = sorted(range(n), key=lambda v: (len(graph.adj[v]), v))
+    seeds = sorted(set(candidates[(i * n) // tries] for i in range(tries)))
+
+    best_part = None
+    best_cut = None
+    for seed in seeds:
+        part = _grow_partition(graph, targets, seed)
+        _refine(graph, part, targets)
+        cut = _get_edge_cut(graph, part)
+        if best_cut is None or cut < best_cut:
+            best_part = part
+            best_cut = cut
+
+    return best_part
+
+def _get_connectivity(adj, part, v):
+    conn = {}
+    for u, weight in adj[v].items():
+        p = part[u]
+        conn[p] = conn.get(p, 0) + weight
+    return conn
+
+# move vertices out of parts that exceed their maximum size
+def _balance(graph, part, part_weight, max_weight):
+    adj = graph.adj
+    vwgt = graph.vwgt
+    k = len(part_weight)
+
+    for p in range(k):
+        if part_weight[p] <= max_weight[p]:
+            continue
+
+        # best gain first
+        candidates = []
+        for v in range(len(adj)):
+            if part[v] == p and graph.fixed[v] == -1:
+                conn = _get_connectivity(adj, part, v)
+                own = conn.get(p, 0)
+                for q in range(k):
+                    if q != p:
+                        candidates.append((own - conn.get(q, 0), v, q))
+        candidates.sort()
+
+        for (_, v, q) in candidates:
+            if part_weight[p] <= max_weight[p]:
+                break
+            if part[v] != p or (part_weight[q] + vwgt[v]) > max_weight[q]:
+                continue
+            part[v] = q
+            part_weight[p] -= vwgt[v]
+            part_weight[q] += vwgt[v]
+
+def _refine(graph, part, targets, passes=8):
+    adj = graph.adj
+    vwgt = graph.vwgt
+    k = len(targets)
+
+    max_vwgt = max(vwgt)
+    max_weight = [math.ceil(t * (1.0 + imbalance)) + max_vwgt - 1 for t in targets]
+    part_weight = [0] * k
+    for v in range(len(adj)):
+        part_weight[part[v]] += vwgt[v]
+
+    _balance(graph, part, part_weight, max_weight)
+
+    for _ in range(passes):
+        moved = 0
+        for v in range(len(adj)):
+            if graph.fixed[v] != -1:
+                continue
+
+            p = part[v]
+            conn = _get_connectivity(adj, part, v)
+            if len(conn) == 0 or (len(conn) == 1 and p in conn):
+                # not on the boundary
+                continue
+
+            own = conn.get(p, 0)
+            best = p
+            best_gain = 0
+            # weight of the heavier part after the move
+            best_weight = part_weight[p]
+            for q, c in conn.items():
+                if q == p or (part_weight[q] + vwgt[v]) > max_weight[q]:
+                    continue
+                gain = c - own
+                weight = part_weight[q] + vwgt[v]
+                if gain > best_gain or (gain == best_gain and weight < best_weight):
+                    # better cut or same cut with better balance
+                    best = q
+                    best_gain = gain
+                    best_weight = weight
+
+            if best != p:
+                part[v] = best
+                part_weight[p] -= vwgt[v]
+                part_weight[best] += vwgt[v]
+                moved += 1
+
+        if moved == 0:
+            break
+
+'''
+Partition the nodes of a neighbor dict ({node => [node..]}) into
+parts with sizes proportional to capacities ([number..]).
+Nodes in fixed ({node => part}) keep their part. Links get
+a weight of 1 unless set in link_weights ({link_id => number}).
+Returns {node => part}.
+'''
+def partition(neighbors, capacities, fixed={}, link_weights={}):
+    if len(neighbors) == 0:
+        return {}
+
+    nodes = sorted(neighbors.keys())
+    index = {node: i for i, node in enumerate(nodes)}
+
+    adj = [{} for _ in nodes]
+    for node, neighs in neighbors.items():
+        v = index[node]
+        # sorted for a deterministic result
+        for neigh in sorted(neighs):
+            u = index[neigh]
+            if u != v:
+                adj[v][u] = link_weights.get(link_id(node, neigh), 1)
+
+    graph = _Graph(adj, [1] * len(nodes), [fixed.get(node, -1) for node in nodes])
+    total = len(nodes)
+    part_count = len(capacities)
+    targets = [total * capacity / sum(capacities) for capacity in capacities]
+
+    # coarsen until the graph is small enough
+    coarsen_to = max(20 * part_count, 100)
+    max_vwgt = max(1, int(1.5 * total / coarsen_to))
+    levels = []
+    while len(graph.adj) > coarsen_to:
+        (coarse, cmap) = _coarsen(graph, max_vwgt)
+        if len(coarse.adj) > 0.95 * len(graph.adj):
+            break
+        levels.append((graph, cmap))
+        graph = coarse
+
+    part = _initial_partition(graph, targets)
+
+    # project partition back to the finer graphs
+    while len(levels) > 0:
+        (graph, cmap) = levels.pop()
+        part = [part[cmap[v]] for v in range(len(graph.adj))]
+        _refine(graph, part, targets)
+
+    return {node: part[index[node]] for node in nodes}
+
+# sum of link weights between different parts (number of links by default)
+def get_cut(neighbors, mapping, link_weights={}):
+    cut = 0
+    for node, neighs in neighbors.items():
+        for neigh in neighs:
+            if node < neigh and mapping[node] != mapping[neigh]:
+                cut += link_weights.get(link_id(node, neigh), 1)
+    return cut
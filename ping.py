@@ -3,6 +3,10 @@
 from cmath import pi
 import random
 import argparse
+import subprocess
+import threading
+import collections
+import atexit
 import json
 import math
 import time
@@ -14,118 +18,16 @@ import shared
 from shared import (
     eprint,
     create_process,
-    exec,
     get_remote_mapping,
-    millis,
     default_remotes,
     convert_to_neighbors,
     stop_all_terminals,
     format_size,
     Remote,
-    get_thread_id
+    netns_exec_args,
+    netns_path,
 )
-
-"""
-Dijkstra shortest path algorithm
-"""
-
-
-class Dijkstra:
-    def __init__(self, network):
-        self.dists_cache = {}
-        self.prevs_cache = {}
-        self.nodes = convert_to_neighbors(network)
-
-    def find_shortest_distance(self, source, target):
-        source = str(source)
-        target = str(target)
-
-        # try cache
-        dists = self.dists_cache.get(source)
-        if dists is not None:
-            return dists[target]
-
-        # calculate
-        self._calculate_shortest_paths(source)
-
-        # try again
-        dists = self.dists_cache.get(source)
-        if dists is not None:
-            return dists[target]
-
-        # should not happen...
-        return None
-
-    def get_shortest_path(self, source, target):
-        source = str(source)
-        target = str(target)
-
-        # calculate
-        self._calculate_shortest_paths(source)
-
-        prevs = self.prevs_cache.get(source)
-        if prevs is None:
-            return None
-
-        path = [target]
-        next = target
-
-        while True:
-            prev = prevs[next]
-            if prev is not None:
-                next = prev
-                path.append(next)
-            else:
-                break
-
-        path.reverse()
-        return path
-
-    """
-    Calculate shortest path from source to every other node
-    """
-
-    def _calculate_shortest_paths(self, initial):
-        initial = str(initial)
-
-        dists = {}
-        prevs = {}
-        q = {}
-
-        for id in self.nodes:
-            dists[id] = math.inf
-            prevs[id] = None
-            q[id] = None
-
-        dists[initial] = 0
-
-        def get_smallest(q, dists):
-            dist = math.inf
-            idx = None
-
-            for k in q:
-                d = dists[k]
-                if d < dist:
-                    idx = k
-                    dist = d
-            return idx
-
-        for _ in range(len(self.nodes)):
-            u = get_smallest(q, dists)
-            if u is None:
-                break
-            del q[u]
-            for v in self.nodes[u]:
-                if v in q:
-                    # distance update
-                    alt = dists[u] + 1
-                    if alt < dists[v]:
-                        dists[v] = alt
-                        prevs[v] = u
-
-        self.dists_cache[initial] = dists
-        self.prevs_cache[initial] = prevs
-
+from distances import get_distances
 
 """
 Get list of random pairs (but no path to self).
@@ -153,10 +55,11 @@ def _random_paths_generator(nodes, sample_without_replacement=False):
                 stop_all_terminals()
                 exit(1)
 
-        a = random.choice(s[:-1])
-        a_index = s.index(a)
-        b = random.choice(s[(a_index + 1) :])
-        b_index = s.index(b)
+        # same as random.choice(), without copying s
+        a_index = random.randrange(len(s) - 1)
+        a = s[a_index]
+        b_index = a_index + 1 + random.randrange(len(s) - a_index - 1)
+        b = s[b_index]
 
         if sample_without_replacement:
             s = s[:a_index] + s[(a_index + 1) : b_index] + s[(b_index + 1) :]
@@ -188,7 +91,7 @@ def get_random_paths_filtered(
     seed=None,
     sample_without_replacement=False,
 ):
-    dijkstra = Dijkstra(network)
+    distances = get_distances(network)
 
     if min_hops is None:
         min_hops = 1
@@ -197,16 +100,17 @@ def get_random_paths_filtered(
         max_hops = math.inf
 
     paths = []
-    all_nodes = list(convert_to_neighbors(network).keys())
     for path in _random_paths_generator(
-        nodes=all_nodes, sample_without_replacement=sample_without_replacement
+        nodes=distances.nodes, sample_without_replacement=sample_without_replacement
     ):
-        d = dijkstra.find_shortest_distance(path[0], path[1])
+        d = distances.get_distance(path[0], path[1])
         if d >= min_hops and d <= max_hops and d != math.inf:
             paths.append(path)
         if len(paths) >= path_count:
             break
 
+    distances.save()
+
     return paths
 
 
@@ -219,7 +123,7 @@ def get_random_nodes(network, count):
 def get_paths_to_gateways(network, gateways):
     nodes = list(convert_to_neighbors(network).keys())
 
-    dijkstra = Dijkstra(network)
+    distances = get_distances(network)
 
     paths = []
 
@@ -231,7 +135,7 @@ def get_paths_to_gateways(network, gateways):
         distance_min = math.inf
         gateway_min = None
         for gateway in gateways:
-            d = dijkstra.find_shortest_distance(gateway, node)
+            d = distances.get_distance(gateway, node)
             if distance_min == math.inf or d <= distance_min:
                 distance_min = d
                 gateway_min = gateway
@@ -239,6 +143,8 @@ def get_paths_to_gateways(network, gateways):
         if gateway_min is not None:
             paths.append((node, gateway))
 
+    distances.save()
+
     return paths
 
 
@@ -252,22 +158,29 @@ Return an IP address of the interface in this preference order:
 
 
 def _get_ip_address(remote, id, interface, address_type=None):
+    return _get_ip_addresses([(remote, id, interface)], address_type)[0]
+
+
+"""
+Get the addresses of many (remote, id, interface) at once
+(from the address table, see shared.get_addresses).
+"""
+
+
+def _get_ip_addresses(queries, address_type=None):
+    rmap = {str(id): remote for remote, id, _ in queries}
+    table = shared.get_addresses(rmap, rmap.keys())
+    return [
+        _select_address(table[str(id)].get(interface, []), address_type)
+        for _, id, interface in queries
+    ]
+
+
+def _select_address(addr_info, address_type):
     lladdr6 = None
     lladdr4 = None
     addr6 = None
     addr4 = None
-    tid = get_thread_id()
-
-    stdout, stderr, rcode = exec(
-        tid,
-        remote,
-        f'ip netns exec "ns-{id}" ip -j addr list dev {interface}',
-        get_output=True,
-        ignore_error=True,
-    )
-
-    js = json.loads(stdout)
-    addr_info = js[0]['addr_info']
 
     for addr in addr_info:
         if addr['family'] == 'inet':
@@ -308,14 +221,93 @@ def _get_ip_address(remote, id, interface, address_type=None):
     return None
 
 
+"""
+Send times of pings on the monotonic clock. The arrival process is
+"constant" (equal gaps), "poisson" (random gaps with the same mean
+rate) or "bursty" (burst_size pings at once, equal gaps between the
+bursts). With a count, poisson spreads exactly count pings over
+count / rate seconds. The lateness of each ping (actual minus
+scheduled start) is recorded to tell if the host was too busy.
+"""
+
+
+class _Schedule:
+    def __init__(self, rate, arrival="constant", burst_size=10, count=None):
+        if arrival not in ("constant", "poisson", "bursty"):
+            raise ValueError(f"Unknown arrival process: {arrival}")
+
+        self.rate = rate
+        self.arrival = arrival
+        self.burst_size = max(1, burst_size)
+        self.start = time.monotonic()
+        self.count = 0
+        # offset of the next ping in seconds
+        self.offset = 0.0
+        self.lateness_sum = 0.0
+        self.lateness_max = 0.0
+        self.late = 0
+
+        self.offsets = None
+        if arrival == "poisson" and count is not None and count > 0:
+            # a poisson process with count arrivals in a time frame
+            duration = count / rate
+            self.offsets = sorted(random.uniform(0, duration) for _ in range(count))
+            self.offset = self.offsets[0]
+
+    # seconds until the next ping is due (<= 0 if due)
+    def remaining(self):
+        return self.start + self.offset - time.monotonic()
+
+    # wait until the next ping is due, returns False if stop was set
+    def wait(self, stop=None):
+        remaining = self.remaining()
+        while remaining > 0:
+            if stop is None:
+                time.sleep(remaining)
+            elif stop.wait(remaining):
+                return False
+            remaining = self.remaining()
+        return True
+
+    # record that the next ping was started now, returns its scheduled offset
+    def sent(self):
+        offset = self.offset
+        lateness = time.monotonic() - (self.start + offset)
+        self.lateness_sum += lateness
+        self.lateness_max = max(self.lateness_max, lateness)
+        if lateness > 0.001:
+            self.late += 1
+
+        self.count += 1
+        if self.offsets is not None:
+            self.offset = self.offsets[min(self.count, len(self.offsets) - 1)]
+        elif self.arrival == "poisson":
+            self.offset += random.expovariate(self.rate)
+        elif self.arrival == "bursty":
+            self.offset = (self.count // self.burst_size) * self.burst_size / self.rate
+        else:
+            self.offset = self.count / self.rate
+
+        return offset
+
+    def lateness_avg_ms(self):
+        return 0.0 if self.count == 0 else 1000 * self.lateness_sum / self.count
+
+    def lateness_max_ms(self):
+        return 1000 * self.lateness_max
+
+
 class _PingStats:
     send = 0
     received = 0
     rtt_avg_ms = 0.0
+    # delay of the ping starts (see _Schedule)
+    lateness_avg_ms = 0.0
+    lateness_max_ms = 0.0
 
     def getData(self):
-        titles = ["packets_send", "packets_received", "rtt_avg_ms"]
-        values = [self.send, self.received, self.rtt_avg_ms]
+        titles = ["packets_send", "packets_received", "rtt_avg_ms", "lateness_avg_ms", "lateness_max_ms"]
+        values = [self.send, self.received, self.rtt_avg_ms, round(self.lateness_avg_ms, 3), round(self.lateness_max_ms, 3)]
         return (titles, values)
 
 
@@ -357,22 +349,256 @@ def _parse_ping(result, output):
             # result.rtt_mdev = float(toks[4])
 
 
+"""
+Prober agents (prober.py), one per remote. An agent sends the pings
+from raw ICMP sockets that are opened once per node namespace,
+instead of starting a ping process for every path. Falls back to
+ping processes if the agent cannot be started (e.g. no python3 on
+a remote).
+"""
+
+# send pings via the prober agents
+use_prober = True
+
+# remote => _Prober
+_probers = {}
+
+
+# a single ping sent by a prober agent, used like a ping process
+class _Probe:
+    def __init__(self):
+        self.event = threading.Event()
+        self.received = False
+        self.rtt_ms = None
+        self.error = None
+
+    def finish(self, received, rtt_ms=None, error=None):
+        self.received = received
+        self.rtt_ms = rtt_ms
+        self.error = error
+        self.event.set()
+
+    def poll(self):
+        return 0 if self.event.is_set() else None
+
+    def wait(self):
+        self.event.wait()
+
+    def fill(self, result):
+        result.transmitted = 1
+        if self.received:
+            result.received = 1
+            result.packet_loss = 0.0
+            result.rtt_min = self.rtt_ms
+            result.rtt_avg = self.rtt_ms
+            result.rtt_max = self.rtt_ms
+        else:
+            result.received = 0
+            result.packet_loss = 100.0
+
+
+class _Prober:
+    def __init__(self, remote):
+        self.remote = remote
+        self.lock = threading.Lock()
+        # request id => _Probe
+        self.probes = {}
+        self.counter = 0
+        self.ready = threading.Event()
+        self.failed = False
+        self.stopped = False
+        # last lines of the agent error output
+        self.errors = collections.deque(maxlen=10)
+
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "prober.py")
+        if remote.address:
+            # the remote does not need a copy of prober.py
+            with open(path) as file:
+                command = ["python3", "-c", file.read()]
+        else:
+            command = [sys.executable, path]
+
+        self.process = create_process(remote, command, stdin=subprocess.PIPE)
+        # a full pipe would block the agent
+        self.error_reader = threading.Thread(target=self._read_errors, daemon=True)
+        self.error_reader.start()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read_errors(self):
+        for line in self.process.stderr:
+            self.errors.append(line.decode(errors="replace").rstrip())
+
+    def _read(self):
+        for line in self.process.stdout:
+            try:
+                js = json.loads(line)
+            except ValueError:
+                continue
+
+            if js.get("ready"):
+                self.ready.set()
+                continue
+
+            with self.lock:
+                probe = self.probes.pop(js["id"], None)
+            if probe is not None:
+                probe.finish(js["received"], js.get("rtt_ms"), js.get("error"))
+
+        # the agent has exited
+        self._fail()
+        if self.ready.is_set() and not self.stopped:
+            self.error_reader.join(1)
+            eprint(f"Prober on {self.remote.address or 'local'} exited")
+            for line in list(self.errors):
+                eprint(f"  {line}")
+        self.ready.set()
+
+    def _fail(self):
+        with self.lock:
+            self.failed = True
+            probes = list(self.probes.values())
+            self.probes = {}
+        for probe in probes:
+            probe.finish(False, error="prober exited")
+
+    def send(self, request):
+        probe = _Probe()
+        with self.lock:
+            if self.failed:
+                probe.finish(False, error="prober exited")
+                return probe
+
+            self.counter += 1
+            self.probes[self.counter] = probe
+            line = json.dumps(dict(request, id=self.counter)) + "\n"
+            try:
+                self.process.stdin.write(line.encode())
+                self.process.stdin.flush()
+                return probe
+            except OSError:
+                del self.probes[self.counter]
+
+        probe.finish(False, error="prober exited")
+        return probe
+
+    def stop(self):
+        self.stopped = True
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+# get the prober agent of a remote, None if not available
+def _get_prober(remote):
+    prober = _probers.get(remote)
+    if prober is None:
+        prober = _Prober(remote)
+        if not prober.ready.wait(10) or prober.failed:
+            prober.process.kill()
+            prober.failed = True
+            prober.error_reader.join(1)
+            eprint(f"Prober not available on {remote.address or 'local'}, use ping processes")
+            for line in prober.errors:
+                eprint(f"  {line}")
+        _probers[remote] = prober
+
+    return None if prober.failed else prober
+
+
+def stop_probers():
+    for prober in _probers.values():
+        if not prober.failed:
+            prober.stop()
+    _probers.clear()
+
+
+# also if ping is used as library
+atexit.register(stop_probers)
+
+
 def _get_interface(remote, source):
     # batman-adv uses bat0 as default entry interface
-    for interface in ["tun0", "bat0"]:
-        tid = get_thread_id()
-        rcode = exec(
-            tid,
-            remote,
-            f"ip netns exec ns-{source} ip addr list dev {interface}",
-            get_output=True,
-            ignore_error=True,
-        )[2]
-        if rcode == 0:
+    interfaces = ["tun0", "bat0"]
+
+    addresses = shared.get_addresses({str(source): remote}, [source])[str(source)]
+    for interface in interfaces:
+        if interface in addresses:
             return interface
     return "uplink"
 
 
+"""
+Create a (remote, command, debug) task for each path. The command
+is a request for the prober agent of the remote or an argv list
+for a ping process (None if the target address is unknown).
+"""
+
+
+def _get_tasks(paths, rmap, interface, addresses, ping_count=1, ping_deadline=1, ping_timeout=1):
+    # wait time for a reply of the prober agents
+    probe_timeout = min([t for t in (ping_deadline, ping_timeout) if t is not None], default=10)
+
+    tasks = []
+    for source, target in paths:
+        source_remote = rmap[source]
+        target_addr = addresses[target]
+
+        if target_addr is None:
+            tasks.append((source_remote, None, f"ping {source:>4} => {target:>4} (no address / {interface})"))
+            continue
+
+        debug = f"ping {source:>4} => {target:>4} ({target_addr:<18} / {interface})"
+        if use_prober and _get_prober(source_remote) is not None:
+            # request for the prober agent
+            command = {
+                "netns": netns_path(source_remote, source),
+                "ifname": interface,
+                "address": target_addr,
+                "timeout": probe_timeout,
+            }
+            tasks.append((source_remote, command, debug))
+            continue
+
+        # argv list, executed without shell
+        command = netns_exec_args(source_remote, source) + ["ping", "-c", str(ping_count)]
+        if ping_deadline is not None:
+            command += ["-w", str(ping_deadline)]
+        if ping_timeout is not None:
+            command += ["-W", str(ping_timeout)]
+        command += ["-D", "-I", interface, target_addr]
+        tasks.append((source_remote, command, debug))
+
+    return tasks
+
+
+# start a task, returns a _Probe or ping process
+def _start_task(remote, command):
+    if command is None:
+        probe = _Probe()
+        probe.finish(False, error="no address")
+        return probe
+    if isinstance(command, dict):
+        return _probers[remote].send(command)
+    return create_process(remote, command)
+
+
+# wait for a _Probe or ping process and set the result
+def _fill_result(process, result):
+    process.wait()
+    if isinstance(process, _Probe):
+        process.fill(result)
+    else:
+        (output, err) = process.communicate()
+        _parse_ping(result, output.decode())
+    result.processed = True
+
+
 def ping(
     paths,
     duration_ms=None,
@@ -382,9 +608,13 @@ def ping(
     address_type=None,
     ping_deadline=1,
     ping_timeout=1,
+    rmap=None,
+    arrival="constant",
+    burst_size=10,
 ):
     ping_count = 1
-    rmap = get_remote_mapping(remotes)
+    if rmap is None:
+        rmap = get_remote_mapping(remotes)
     path_count = len(paths)
 
     if duration_ms is None:
@@ -394,42 +624,32 @@ def ping(
     if duration_ms < 1000 and verbosity != "quiet":
         print("Warning: ping duration < 1000ms")
 
-    # prepare ping tasks
-    tasks = []
-    for source, target in paths:
-        source_remote = rmap[source]
-        target_remote = rmap[target]
-
-        if interface is None:
-            interface = _get_interface(source_remote, source)
+    if interface is None and len(paths) > 0:
+        source = paths[0][0]
+        interface = _get_interface(rmap[source], source)
 
-        target_addr = _get_ip_address(target_remote, target, interface, address_type)
+    # get all target addresses at once
+    targets = list(set(target for _, target in paths))
+    addresses = dict(zip(targets, _get_ip_addresses(
+        [(rmap[target], target, interface) for target in targets], address_type
+    )))
 
-        if target_addr is None:
+    for source, target in paths:
+        if addresses[target] is None:
             eprint(f"Cannot get address of {interface} in ns-{target}")
             stop_all_terminals()
             exit(1)
-        else:
-            debug = f"ping {source:>4} => {target:>4} ({target_addr:<18} / {interface})"
-            command = (
-                f"ip netns exec ns-{source} ping -c {ping_count} "
-                + (f"-w {ping_deadline} " if ping_deadline is not None else "")
-                + (f"-W {ping_timeout} " if ping_timeout is not None else "")
-                + f"-D -I {interface} {target_addr}"
-            )
-            tasks.append((source_remote, command, debug))
+
+    # prepare ping tasks
+    tasks = _get_tasks(paths, rmap, interface, addresses, ping_count, ping_deadline, ping_timeout)
 
     processes = []
-    started = 0
 
     def process_results(do_wait):
         for process, started_ms, debug, result in processes:
             if not result.processed:
                 if do_wait or process.poll() is not None:
-                    process.wait()
-                    (output, err) = process.communicate()
-                    _parse_ping(result, output.decode())
-                    result.processed = True
+                    _fill_result(process, result)
 
     lines_finished_total = 0
     lines_unfinished_prev = 0
@@ -465,37 +685,25 @@ def ping(
         lines_finished_total += finished_consecutive
         lines_unfinished_prev = len(processes) - lines_finished_total
 
-    # start tasks in the given time frame
-    start_ms = millis()
-    last_processed = millis()
-    tasks_count = len(tasks)
-    while started < tasks_count:
-        started_expected = math.ceil(
-            tasks_count * ((millis() - start_ms) / duration_ms)
-        )
-        if started_expected > started:
-            for _ in range(0, started_expected - started):
-                if len(tasks) == 0:
-                    break
-
-                (remote, command, debug) = tasks.pop(0)
-                process = create_process(remote, command)
-                started_ms = millis() - start_ms
-                processes.append((process, started_ms, debug, _PingResult(ping_count)))
-
-                # process results and print updates once per second
-                if (last_processed + 1000) < millis():
-                    last_processed = millis()
-                    process_results(False)
-                    if verbosity != "quiet":
-                        print_processes()
-
-                started += 1
-        else:
-            # sleep a small amount
-            time.sleep(duration_ms / tasks_count / 1000.0 / 10.0)
-
-    stop1_ms = millis()
+    # start tasks at the times of the arrival process in the given time frame
+    schedule = _Schedule(len(tasks) * 1000.0 / duration_ms, arrival, burst_size, count=len(tasks))
+    start = schedule.start
+    last_processed = start
+    for remote, command, debug in tasks:
+        schedule.wait()
+        schedule.sent()
+        process = _start_task(remote, command)
+        started_ms = int(1000 * (time.monotonic() - start))
+        processes.append((process, started_ms, debug, _PingResult(ping_count)))
+
+        # process results and print updates once per second
+        if (last_processed + 1.0) < time.monotonic():
+            last_processed = time.monotonic()
+            process_results(False)
+            if verbosity != "quiet":
+                print_processes()
+
+    stop1 = time.monotonic()
 
     # block until all ping commands finished
     process_results(True)
@@ -503,16 +711,17 @@ def ping(
         print_processes()
 
     # wait until rest fraction of duration_ms is over
-    if (stop1_ms - start_ms) < duration_ms:
-        time.sleep((duration_ms - (stop1_ms - start_ms)) / 1000.0)
+    result_duration_ms = int(1000 * (stop1 - start))
+    if result_duration_ms < duration_ms:
+        time.sleep((duration_ms - result_duration_ms) / 1000.0)
     else:
         print(
             "Measurement took {:.2f}sec too long".format(
-                (stop1_ms - start_ms - duration_ms) / 1000
+                (result_duration_ms - duration_ms) / 1000
             )
         )
 
-    stop2_ms = millis()
+    result_filler_ms = int(1000 * (time.monotonic() - stop1))
 
     # collect results
     rtt_avg_ms_count = 0
@@ -529,8 +738,8 @@ def ping(
     if rtt_avg_ms_count > 0:
         ret.rtt_avg_ms /= float(rtt_avg_ms_count)
 
-    result_duration_ms = stop1_ms - start_ms
-    result_filler_ms = stop2_ms - stop1_ms
+    ret.lateness_avg_ms = schedule.lateness_avg_ms()
+    ret.lateness_max_ms = schedule.lateness_max_ms()
 
     if verbosity != "quiet":
         print(
@@ -543,23 +752,231 @@ def ping(
                 result_duration_ms + result_filler_ms,
             )
         )
+        # pings started more than 1ms after their scheduled time
+        if schedule.late > 0:
+            print(
+                "pings started late: {} (avg: {:.2f}ms, max: {:.2f}ms)".format(
+                    schedule.late, ret.lateness_avg_ms, ret.lateness_max_ms
+                )
+            )
 
     return ret
 
 
+"""
+Continuous reachability measurement, e.g. while the network is
+changed or software is started. A background thread sends pings
+on the paths in turn at a fixed rate (pings per second). The pings
+are counted for the interval in which they were sent. A row per
+interval is written to csvfile (tab separated) and/or jsonfile
+(JSON lines) as soon as all of its pings are finished:
+  time_ms  packets_send  packets_received  packets_arrived_pc  rtt_avg_ms  lateness_max_ms  events
+Events are labels added by mark() (e.g. a topology step). The send
+times follow an arrival process (see _Schedule).
+"""
+
+
+class _Interval:
+    def __init__(self):
+        self.send = 0
+        self.received = 0
+        self.rtt_sum_ms = 0.0
+        self.rtt_count = 0
+        self.pending = 0
+        self.lateness_max_ms = 0.0
+        self.events = []
+
+
+class ContinuousPing:
+    def __init__(
+        self,
+        paths,
+        rate=100,
+        interval_ms=1000,
+        remotes=default_remotes,
+        interface=None,
+        address_type=None,
+        ping_timeout=1,
+        rmap=None,
+        csvfile=None,
+        jsonfile=None,
+        arrival="constant",
+        burst_size=10,
+    ):
+        self.rate = rate
+        self.arrival = arrival
+        self.burst_size = burst_size
+        self.interval_ms = interval_ms
+        self.remotes = remotes
+        self.address_type = address_type
+        self.ping_timeout = ping_timeout
+        self.rmap = rmap
+        self.csvfile = csvfile
+        self.jsonfile = jsonfile
+
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.schedule = None
+        # interval index => _Interval
+        self.intervals = {}
+        # (process, interval index) of pings not finished yet
+        self.running = []
+        # index of the next interval to write
+        self.written = 0
+        self.rows = []
+        self.tasks = []
+
+        self.set_paths(paths, interface)
+
+    """
+    Change the paths (or interface) to ping. The addresses of the
+    targets are read again (e.g. after software was started).
+    """
+
+    def set_paths(self, paths, interface=None):
+        rmap = self.rmap
+        if rmap is None:
+            rmap = get_remote_mapping(self.remotes)
+
+        if interface is None and len(paths) > 0:
+            source = paths[0][0]
+            interface = _get_interface(rmap[source], source)
+
+        targets = list(set(target for _, target in paths))
+        addresses = dict(zip(targets, _get_ip_addresses(
+            [(rmap[target], target, interface) for target in targets], self.address_type
+        )))
+
+        tasks = _get_tasks(paths, rmap, interface, addresses, 1, self.ping_timeout, self.ping_timeout)
+        with self.lock:
+            self.tasks = tasks
+
+    def start(self):
+        self.schedule = _Schedule(self.rate, self.arrival, self.burst_size)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # add a label to the current interval
+    def mark(self, event):
+        with self.lock:
+            self._get_interval(self._current_interval()).events.append(str(event))
+
+    # stop sending, wait for the last pings and return all rows
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+        for process, index in self.running:
+            result = _PingResult(1)
+            _fill_result(process, result)
+            self._add_result(index, result)
+        self.running = []
+
+        with self.lock:
+            last = max(self.intervals.keys(), default=-1)
+        self._write_rows(last + 1)
+
+        return self.rows
+
+    def _current_interval(self):
+        return int((time.monotonic() - self.schedule.start) * 1000 // self.interval_ms)
+
+    def _get_interval(self, index):
+        interval = self.intervals.get(index)
+        if interval is None:
+            interval = _Interval()
+            self.intervals[index] = interval
+        return interval
+
+    def _add_result(self, index, result):
+        with self.lock:
+            interval = self.intervals[index]
+            interval.pending -= 1
+            interval.received += result.received
+            if not math.isnan(result.rtt_avg):
+                interval.rtt_sum_ms += result.rtt_avg
+                interval.rtt_count += 1
+
+    def _collect(self):
+        running = []
+        for process, index in self.running:
+            if process.poll() is None:
+                running.append((process, index))
+            else:
+                result = _PingResult(1)
+                _fill_result(process, result)
+                self._add_result(index, result)
+        self.running = running
+
+        # write intervals that are over and have no pings running
+        # (a late ping still counts for the interval it was scheduled in)
+        end = int(self.schedule.offset * 1000 // self.interval_ms)
+        with self.lock:
+            while self.written < end and self._get_interval(self.written).pending == 0:
+                self._write_rows(self.written + 1)
+
+    def _write_rows(self, end):
+        while self.written < end:
+            interval = self.intervals.pop(self.written, None) or _Interval()
+            row = {
+                "time_ms": self.written * self.interval_ms,
+                "packets_send": interval.send,
+                "packets_received": interval.received,
+                "packets_arrived_pc": None if interval.send == 0 else round(100 * interval.received / interval.send, 2),
+                "rtt_avg_ms": None if interval.rtt_count == 0 else round(interval.rtt_sum_ms / interval.rtt_count, 3),
+                "lateness_max_ms": round(interval.lateness_max_ms, 3),
+                "events": " ".join(interval.events),
+            }
+            self.rows.append(row)
+            self.written += 1
+
+            if self.csvfile is not None:
+                if len(self.rows) == 1:
+                    self.csvfile.write("\t".join(row.keys()) + "\n")
+                self.csvfile.write("\t".join("" if v is None else str(v) for v in row.values()) + "\n")
+                self.csvfile.flush()
+            if self.jsonfile is not None:
+                self.jsonfile.write(json.dumps(row) + "\n")
+                self.jsonfile.flush()
+
+    def _run(self):
+        schedule = self.schedule
+        last_collect = 0.0
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            remaining = schedule.remaining()
+            if remaining > 0:
+                # check for finished pings at least every 10ms
+                self.stopping.wait(min(remaining, 0.01))
+            else:
+                offset = schedule.sent()
+                lateness_ms = 1000 * (time.monotonic() - schedule.start - offset)
+                with self.lock:
+                    tasks = self.tasks
+                    if len(tasks) > 0:
+                        (remote, command, _) = tasks[(schedule.count - 1) % len(tasks)]
+                        # counted for the interval it was scheduled in
+                        index = int(offset * 1000 // self.interval_ms)
+                        interval = self._get_interval(index)
+                        interval.send += 1
+                        interval.pending += 1
+                        interval.lateness_max_ms = max(interval.lateness_max_ms, lateness_ms)
+                if len(tasks) > 0:
+                    self.running.append((_start_task(remote, command), index))
+
+            if now - last_collect >= 0.01:
+                last_collect = now
+                self._collect()
+
+
 def check_access(remotes):
     shared.check_access(remotes)
 
 
 def namespace_exists(remotes, ns):
-    for remote in remotes:
-        tid = get_thread_id()
-        rcode = exec(
-            tid, remote, f"ip netns exec ns-{ns} true", get_output=True, ignore_error=True
-        )[2]
-        if rcode == 0:
-            return True
-    return False
+    # named namespaces and namespaces of holder processes
+    return str(ns) in get_remote_mapping(remotes)
 
 
 def main():
@@ -585,7 +1002,7 @@ def main():
         help="Number of pings. Unique, no self, no reverse paths. (default: 10)",
     )
     parser.add_argument(
-        "--duration", type=int, default=1000, help="Spread pings over duration in milliseconds. (default: 1000)"
+        "--duration", type=int, default=1000, help="Spread pings over duration in milliseconds (total duration with --continuous). (default: 1000)"
     )
     parser.add_argument(
         "--deadline",
@@ -600,6 +1017,34 @@ def main():
         help="Time to wait for a response, in seconds. The option affects only timeout in absence of any responses, otherwise ping waits for two RTTs.",
     )
     parser.add_argument("--path", nargs=2, help="Send pings from a node to another.")
+    parser.add_argument(
+        "--continuous",
+        action="store_true",
+        help="Send pings on the paths in turn at --rate for --duration milliseconds and print the statistics of every --interval.",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=100, help="Pings per second with --continuous. (default: 100)"
+    )
+    parser.add_argument(
+        "--interval", type=int, default=1000, help="Interval in milliseconds with --continuous. (default: 1000)"
+    )
+    parser.add_argument(
+        "--output", help="Write the statistics of --continuous to a file (JSON lines if it ends with .json, CSV otherwise)."
+    )
+    parser.add_argument(
+        "--arrival",
+        choices=["constant", "poisson", "bursty"],
+        default="constant",
+        help="Arrival process of the pings: equal gaps, random (exponential) gaps with the same mean rate or bursts of --burst-size pings. (default: constant)",
+    )
+    parser.add_argument(
+        "--burst-size", type=int, default=10, help="Pings per burst with --arrival bursty. (default: 10)"
+    )
+    parser.add_argument(
+        "--no-prober",
+        action="store_true",
+        help="Start a ping process for every path instead of sending the pings via a prober agent per remote.",
+    )
     parser.add_argument("-4", action="store_true", help="Force use of IPv4 addresses.")
     parser.add_argument("-6", action="store_true", help="Force use of IPv6 addresses.")
 
@@ -651,23 +1096,55 @@ def main():
         all_nodes = list(rmap.keys())
         paths = get_random_paths(nodes=all_nodes, count=args.pings)
 
+    if args.no_prober:
+        global use_prober
+        use_prober = False
+
     address_type = None
     if getattr(args, "4"):
         address_type = "4"
     if getattr(args, "6"):
         address_type = "6"
 
-    ping(
-        paths=paths,
-        remotes=args.remotes,
-        duration_ms=args.duration,
-        interface=args.interface,
-        verbosity="verbose",
-        address_type=address_type,
-        ping_deadline=args.deadline,
-        ping_timeout=args.timeout,
-    )
+    if args.continuous:
+        output = open(args.output, "w") if args.output else sys.stdout
+        is_json = args.output is not None and args.output.endswith(".json")
+        measurement = ContinuousPing(
+            paths=paths,
+            rate=args.rate,
+            interval_ms=args.interval,
+            remotes=args.remotes,
+            interface=args.interface,
+            address_type=address_type,
+            ping_timeout=args.timeout or args.deadline,
+            csvfile=None if is_json else output,
+            jsonfile=output if is_json else None,
+            arrival=args.arrival,
+            burst_size=args.burst_size,
+        )
+        measurement.start()
+        try:
+            time.sleep(args.duration / 1000)
+        except KeyboardInterrupt:
+            pass
+        measurement.stop()
+        if output is not sys.stdout:
+            output.close()
+    else:
+        ping(
+            paths=paths,
+            remotes=args.remotes,
+            duration_ms=args.duration,
+            interface=args.interface,
+            verbosity="verbose",
+            address_type=address_type,
+            ping_deadline=args.deadline,
+            ping_timeout=args.timeout,
+            arrival=args.arrival,
+            burst_size=args.burst_size,
+        )
 
+    stop_probers()
     stop_all_terminals()
 
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import selectors
+import resource
+import socket
+import struct
+import ctypes
+import heapq
+import json
+import time
+import sys
+import os
+
+'''
+Prober agent, started once per remote by ping.py. Reads probe
+requests as JSON lines on stdin, e.g.:
+  {"id": 1, "netns": "/run/netns/ns-1", "ifname": "uplink", "address": "10.0.0.2", "timeout": 1}
+Sends an ICMP echo request from the interface in the namespace
+and writes a JSON line per probe to stdout, e.g.:
+  {"id": 1, "received": true, "rtt_ms": 0.31}
+A raw ICMP socket is opened once per namespace, interface and
+address family (via setns) and used for all later probes.
+Needs only the Python standard library (for remotes).
+'''
+
+CLONE_NEWNET = 0x40000000
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP6_ECHO_REQUEST = 128
+ICMP6_ECHO_REPLY = 129
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def _setns(fd):
+    if _libc.setns(fd, CLONE_NEWNET) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    s = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+class _Socket:
+    def __init__(self, netns, ifname, family):
+        self.family = family
+        self.inode = os.stat(netns).st_ino
+
+        # a socket belongs to the namespace it was created in
+        own = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+        target = os.open(netns, os.O_RDONLY)
+        try:
+            _setns(target)
+            try:
+                if family == socket.AF_INET:
+                    self.sock = socket.socket(family, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+                else:
+                    # the kernel calculates the ICMPv6 checksum
+                    self.sock = socket.socket(family, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, ifname.encode())
+                # replies arrive in bursts
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+                self.sock.setblocking(False)
+                self.ifindex = socket.if_nametoindex(ifname)
+            finally:
+                _setns(own)
+        finally:
+            os.close(target)
+            os.close(own)
+
+    def send(self, address, ident, seq):
+        if self.family == socket.AF_INET:
+            header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+            payload = b'\0' * 56
+            checksum = _checksum(header + payload)
+            packet = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+            self.sock.sendto(packet, (address, 0))
+        else:
+            packet = struct.pack('!BBHHH', ICMP6_ECHO_REQUEST, 0, 0, ident, seq) + b'\0' * 56
+            # link local addresses need the interface
+            self.sock.sendto(packet, (address, 0, 0, self.ifindex))
+
+    # returns (ident, seq, source address) of echo replies
+    def receive(self):
+        replies = []
+        while True:
+            try:
+                (data, sender) = self.sock.recvfrom(2048)
+            except BlockingIOError:
+                return replies
+
+            if self.family == socket.AF_INET:
+                # starts with the IP header
+                offset = (data[0] & 0x0f) * 4
+                reply_type = ICMP_ECHO_REPLY
+            else:
+                offset = 0
+                reply_type = ICMP6_ECHO_REPLY
+
+            if len(data) < offset + 8:
+                continue
+
+            (type, _, _, ident, seq) = struct.unpack_from('!BBHHH', data, offset)
+            if type == reply_type:
+                replies.append((ident, seq, sender[0].partition('%')[0]))
+
+class _Prober:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # (netns, ifname, family) => _Socket
+        self.sockets = {}
+        # (socket, ident, seq) => (id, address, sent)
+        self.pending = {}
+        # (deadline, id, key of pending)
+        self.deadlines = []
+        self.ident = os.getpid() & 0xffff
+        self.seq = 0
+        self.output = []
+
+    def _get_socket(self, netns, ifname, family):
+        key = (netns, ifname, family)
+        sock = self.sockets.get(key)
+        # the namespace might have been recreated
+        if sock is not None and sock.inode != os.stat(netns).st_ino:
+            self.selector.unregister(sock.sock)
+            sock.sock.close()
+            sock = None
+        if sock is None:
+            sock = _Socket(netns, ifname, family)
+            self.selector.register(sock.sock, selectors.EVENT_READ, sock)
+            self.sockets[key] = sock
+        return sock
+
+    def _result(self, id, received, rtt_ms=None, error=None):
+        result = {'id': id, 'received': received}
+        if rtt_ms is not None:
+            result['rtt_ms'] = round(rtt_ms, 3)
+        if error is not None:
+            result['error'] = error
+        self.output.append(json.dumps(result))
+
+    def probe(self, request):
+        id = request['id']
+        address = request['address']
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        try:
+            sock = self._get_socket(request['netns'], request['ifname'], family)
+            self.seq = (self.seq + 1) & 0xffff
+            sent = time.monotonic()
+            sock.send(address, self.ident, self.seq)
+        except OSError as e:
+            self._result(id, False, error=e.strerror or str(e))
+            return
+
+        key = (sock, self.ident, self.seq)
+        self.pending[key] = (id, address, sent)
+        heapq.heappush(self.deadlines, (sent + request.get('timeout', 1), id, key))
+
+    def receive(self, sock):
+        now = time.monotonic()
+        for ident, seq, sender in sock.receive():
+            entry = self.pending.get((sock, ident, seq))
+            if entry is None:
+                continue
+            (id, address, sent) = entry
+            # compare without zero compression differences
+            if socket.inet_pton(sock.family, sender) != socket.inet_pton(sock.family, address):
+                continue
+            del self.pending[(sock, ident, seq)]
+            self._result(id, True, rtt_ms=(now - sent) * 1000)
+
+    def expire(self):
+        now = time.monotonic()
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            (_, id, key) = heapq.heappop(self.deadlines)
+            if self.pending.pop(key, None) is not None:
+                self._result(id, False)
+
+    def run(self, input):
+        os.set_blocking(input, False)
+        self.selector.register(input, selectors.EVENT_READ, None)
+        buffer = b''
+        stdin_open = True
+
+        self.output.append(json.dumps({'ready': True}))
+
+        while stdin_open or len(self.pending) > 0:
+            if len(self.output) > 0:
+                sys.stdout.write('\n'.join(self.output) + '\n')
+                sys.stdout.flush()
+                self.output = []
+
+            timeout = None
+            if len(self.deadlines) > 0:
+                timeout = max(0, self.deadlines[0][0] - time.monotonic())
+
+            for key, _ in self.selector.select(timeout):
+                if key.data is not None:
+                    self.receive(key.data)
+                    continue
+
+                data = os.read(input, 65536)
+                if not data:
+                    # controller has finished
+                    stdin_open = False
+                    self.selector.unregister(input)
+                    continue
+
+                buffer += data
+                (*lines, buffer) = buffer.split(b'\n')
+                for line in lines:
+                    if line.strip():
+                        self.probe(json.loads(line))
+
+            self.expire()
+
+        if len(self.output) > 0:
+            sys.stdout.write('\n'.join(self.output) + '\n')
+            sys.stdout.flush()
+
+def main():
+    # one socket per namespace and interface
+    (_, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    _Prober().run(sys.stdin.fileno())
+
+if __name__ == '__main__':
+    main()
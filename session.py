@@ -0,0 +1,130 @@
+import network
+import software
+import traffic
+import ping
+from shared import (
+    eprint, default_remotes, check_access, get_current_state, link_id,
+    clear_addresses
+)
+
+'''
+A network that is changed and measured again and again by the same
+process (e.g. a mobility test). The state of the "switch" namespace,
+the node to remote mapping, the link emulation settings and the l2tp/VXLAN
+registries are kept in memory instead of being queried from the remotes
+on every call (the node addresses are kept in shared.get_addresses).
+
+Only changes made via the session are known. With verify=True, the
+state is read from the remotes before every apply and differences to
+the cached state are reported (the state of the remotes is used then).
+'''
+class NetworkSession:
+    def __init__(self, remotes=default_remotes, verify=False):
+        self.remotes = remotes
+        self.verify = verify
+        # current state including the links that are set down
+        self.state = None
+        self.rmap = {}
+        self.down_links = set()
+        # (remote, ifname) => link emulation settings
+        self.qdiscs = {}
+        # interface to ping on (e.g. bat0)
+        self.interface = None
+        self.interconnects_loaded = False
+
+        check_access(remotes)
+
+    def _read(self):
+        self.down_links = set()
+        self.qdiscs = {}
+        (self.state, self.rmap) = get_current_state(self.remotes, self.down_links, self.qdiscs)
+
+    # read the current state from the remotes
+    def refresh(self):
+        self._read()
+        clear_addresses()
+        self.interface = None
+        self.interconnects_loaded = False
+
+    def _verify(self):
+        nodes = set(self.rmap.keys())
+        links = set(link_id(link['source'], link['target']) for link in self.state.get('links', []))
+        down_links = self.down_links
+
+        self._read()
+
+        differences = []
+        if nodes != set(self.rmap.keys()):
+            differences.append('nodes')
+        if links != set(link_id(link['source'], link['target']) for link in self.state.get('links', [])):
+            differences.append('links')
+        if down_links != self.down_links:
+            differences.append('links set down')
+        if len(differences) > 0:
+            eprint(f'Warning: session state differs from network ({", ".join(differences)})')
+            clear_addresses()
+            self.interface = None
+            self.interconnects_loaded = False
+
+    def apply(self, state={}, node_command=None, link_command=None):
+        if self.state is None:
+            self.refresh()
+        elif self.verify:
+            self._verify()
+
+        (new_state, rmap, task) = network.apply_changes(self.state, self.rmap, self.down_links, self.qdiscs,
+            state, node_command, link_command, self.remotes, load_interconnects=not self.interconnects_loaded)
+        self.interconnects_loaded = True
+
+        # links that are neither in the new state nor removed were set down
+        removed = set(link_id(str(link['source']), str(link['target'])) for link in task.links_remove)
+        links = {}
+        for link in new_state.get('links', []):
+            links[link_id(str(link['source']), str(link['target']))] = dict(link)
+        down_links = set()
+        for link in self.state.get('links', []):
+            lid = link_id(str(link['source']), str(link['target']))
+            if lid not in links and lid not in removed:
+                links[lid] = link
+                down_links.add(lid)
+
+        nodes = [dict(node) for node in new_state.get('nodes', [])]
+        self.state = {'nodes': nodes, 'links': list(links.values())}
+        self.rmap = {str(node['id']): rmap[str(node['id'])] for node in nodes}
+        self.down_links = down_links
+
+        return new_state
+
+    def ping(self, paths, duration_ms=None, interface=None, verbosity='normal', address_type=None, ping_deadline=1, ping_timeout=1):
+        if self.state is None:
+            self.refresh()
+
+        if interface is None and len(paths) > 0:
+            if self.interface is None:
+                source = paths[0][0]
+                self.interface = ping._get_interface(self.rmap[source], source)
+            interface = self.interface
+
+        return ping.ping(paths, duration_ms, self.remotes, interface, verbosity, address_type,
+            ping_deadline, ping_timeout, rmap=self.rmap)
+
+    def traffic(self, ids=None, interface=None):
+        if self.state is None:
+            self.refresh()
+
+        return traffic.traffic(self.remotes, ids, interface, rmap=self.rmap)
+
+    def start(self, protocol):
+        if self.state is None:
+            self.refresh()
+
+        # the software might add interfaces
+        self.interface = None
+        software.start(protocol, self.remotes, rmap=self.rmap)
+
+    def stop(self, protocol):
+        if self.state is None:
+            self.refresh()
+
+        self.interface = None
+        software.stop(protocol, self.remotes, rmap=self.rmap)
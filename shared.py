@@ -1,5 +1,8 @@
+import concurrent.futures
 import datetime
 import subprocess
+import selectors
+import shlex
 import threading
 import random
 import queue
@@ -10,12 +13,18 @@ import sys
 import re
 import os
 
+import netlink
+
 
 class Remote:
-    def __init__(self, address=None, port=None, identity_file=None):
+    def __init__(self, address=None, port=None, identity_file=None, cpus=None, memory_mb=None, weight=None):
         self.address = address
         self.port = port or 22
         self.ifile = identity_file
+        # optional capacity hints for node placement
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.weight = weight
 
     def __hash__(self):
         return hash((self.address, self.port, self.ifile))
@@ -28,7 +37,8 @@ class Remote:
         )
 
     def from_json(obj):
-        return Remote(obj.get("address"), obj.get("port"), obj.get("identity_file"))
+        return Remote(obj.get("address"), obj.get("port"), obj.get("identity_file"),
+            obj.get("cpus"), obj.get("memory_mb"), obj.get("weight"))
 
 default_remotes = [Remote()] # local
 terminals = {} # terminals (SSH/local)
@@ -200,7 +210,25 @@ def sysload(remotes=default_remotes):
     return (titles, values)
 
 
-def create_process(remote, command, add_quotes=False):
+# ssh command line to execute a command on a remote
+def _ssh_args(remote):
+    args = ['ssh', '-p', str(remote.port)]
+    if remote.ifile:
+        args += ['-i', remote.ifile]
+    return args + [f'root@{remote.address}']
+
+'''
+Start a process. A command string is executed by a shell. A
+command as argv list (e.g. ['ip', 'netns', 'exec', ...]) is
+executed without shell and only quoted for the remote shell
+of SSH.
+'''
+def create_process(remote, command, add_quotes=False, stdin=None):
+    if isinstance(command, list):
+        if remote.address:
+            command = _ssh_args(remote) + [shlex.join(command)]
+        return subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
     # remote terminal
     if remote.address:
         if add_quotes:
@@ -213,38 +241,150 @@ def create_process(remote, command, add_quotes=False):
         else:
             command = f'ssh -p {remote.port} root@{remote.address} {command}'
 
-    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    return subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+
+# max. seconds a command of a session may run (None: no limit)
+command_timeout = None
+
+'''
+A long-lived shell (local sh or sh via SSH) that executes
+commands one after another. Every command is followed by a
+marker on stdout (with the return code) and stderr, so that
+the output of each command can be told apart. A command runs
+in a subshell (e.g. cd, exit or an unbalanced quote do not
+affect the session) and fails if the session ends before the
+command is finished or command_timeout is exceeded.
+'''
+class _Session:
+    def __init__(self, remote):
+        self.remote = remote
+        self.process = None
+        self.token = f'__meshnet_{os.getpid()}_{random.getrandbits(64):016x}'
+        self.counter = 0
+
+    def _start(self):
+        if self.remote.address:
+            # a lost connection ends the session
+            args = _ssh_args(self.remote) + ['-o', 'ServerAliveInterval=5', '-o', 'ServerAliveCountMax=3', 'sh']
+        else:
+            args = ['sh']
+
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+    # end the session, the current command failed
+    def _abort(self, stdout, stderr, reason, returncode=None):
+        self.process.kill()
+        rc = self.process.wait()
+        self.process = None
+        stderr.extend(f'\n{reason}'.encode())
+        return (returncode or rc or 1, stdout.decode(), stderr.decode())
+
+    # returns (returncode, stdout, stderr)
+    def run(self, command):
+        if self.process is None or self.process.poll() is not None:
+            self._start()
+
+        self.counter += 1
+        marker = f'{self.token}_{self.counter}'
+
+        # commands must not read the session input
+        script = (f'( eval {shlex.quote(command)}\n) < /dev/null\n'
+            + f'printf "\\n%s %d\\n" "{marker}" "$?"\n'
+            + f'printf "\\n%s\\n" "{marker}" >&2\n')
+
+        self.process.stdin.write(script.encode())
+        self.process.stdin.flush()
+
+        stdout_end = re.compile(f'\n{marker} (\\d+)\n\\Z'.encode())
+        stderr_end = f'\n{marker}\n'.encode()
+
+        stdout = bytearray()
+        stderr = bytearray()
+        returncode = None
+        stderr_done = False
+
+        beg = time.monotonic()
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stdout, selectors.EVENT_READ, stdout)
+            selector.register(self.process.stderr, selectors.EVENT_READ, stderr)
+
+            while returncode is None or not stderr_done:
+                events = selector.select(timeout=1)
+                if len(events) == 0:
+                    if command_timeout is not None and time.monotonic() - beg > command_timeout:
+                        return self._abort(stdout, stderr, f'timeout after {command_timeout}s', 124)
+                    if self.process.poll() is not None:
+                        # the output is still open (e.g. by a background process)
+                        return self._abort(stdout, stderr, 'shell session ended')
+                    continue
+
+                for key, _ in events:
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        return self._abort(stdout, stderr, 'shell session ended')
+
+                    key.data.extend(data)
+
+                    if key.data is stdout:
+                        m = stdout_end.search(stdout, max(0, len(stdout) - len(data) - len(marker) - 16))
+                        if m:
+                            returncode = int(m.group(1))
+                            selector.unregister(self.process.stdout)
+                            del stdout[m.start():]
+                    elif stderr.endswith(stderr_end):
+                        stderr_done = True
+                        selector.unregister(self.process.stderr)
+                        del stderr[-len(stderr_end):]
+
+        return (returncode, stdout.decode(), stderr.decode())
 
 '''
 Execute a command via SSH or local. All tasks in a
-TerminalThread are executed in sequentional order.
+TerminalThread are executed in sequentional order
+using the same shell session.
 '''
 class TerminalThread(threading.Thread):
-    def __init__(self, num, remote, verbosity='normal'):
+    def __init__(self, num, remote, verbosity='normal', pool=None):
         super(TerminalThread, self).__init__()
         self.num = num
         self.remote = remote
         self.finish = False
         self.tasks = queue.Queue()
+        self.session = _Session(remote)
         self.verbosity = verbosity
+        self.pool = pool
+        # tasks not finished yet (maintained by pool)
+        self.pending = 0
         self.start()
 
     def run(self):
         while True:
             try:
                 # might raise Empty
-                (ignore_error, command, onResultCallBack) = self.tasks.get(block=True, timeout=0.2)
+                (tid, ignore_error, command, onResultCallBack, onErrorCallBack, enqueued) = self.tasks.get(block=True, timeout=0.2)
 
                 if self.verbosity == 'verbose':
                     print(command)
 
-                p = create_process(self.remote, command)
+                if self.pool:
+                    self.pool.taskStart()
 
-                (std, err) = p.communicate()
-                stdout = std.decode()
-                errout = err.decode()
+                beg = time.monotonic()
+                (returncode, stdout, errout) = self.session.run(command)
+                end = time.monotonic()
+                duration = end - beg
 
-                if p.returncode != 0 and not ignore_error:
+                if _tracer is not None:
+                    _tracer.add_command(self, tid, command, enqueued, beg, end, returncode, len(stdout) + len(errout))
+
+                failed = returncode != 0 and not ignore_error
+                if failed and onErrorCallBack is None:
                     label = self.remote.address or 'local'
                     eprint(stdout)
                     eprint(errout)
@@ -258,8 +398,13 @@ class TerminalThread(threading.Thread):
                     if errout:
                         print(errout)
 
-                if onResultCallBack:
-                    onResultCallBack(p.returncode, stdout, errout)
+                if failed:
+                    onErrorCallBack(CommandError(self.remote, command, returncode, stdout, errout))
+                elif onResultCallBack:
+                    onResultCallBack(returncode, stdout, errout)
+
+                if self.pool:
+                    self.pool.taskDone(self, tid, returncode, duration / _get_line_count(command))
 
                 self.tasks.task_done()
             except queue.Empty:
@@ -270,35 +415,170 @@ class TerminalThread(threading.Thread):
                 eprint(e)
                 exit(1)
 
+        self.session.close()
+
+# number of commands of a batch file (here-document) or 1
+def _get_line_count(command):
+    return max(1, command.count('\n') - 1)
+
+def _get_cpu_count(remote):
+    if remote.address is None:
+        return os.cpu_count()
+
+    session = _Session(remote)
+    (returncode, stdout, _) = session.run('nproc')
+    session.close()
+
+    if returncode == 0 and stdout.strip().isdigit():
+        return int(stdout)
+    else:
+        return os.cpu_count()
+
+'''
+Terminals of a single remote. The pool has up to one terminal per
+CPU core of the remote. The number of terminals that execute a
+command at the same time (limit) is adapted to the observed command
+latency (AIMD): it grows by one after a round of commands with a
+normal latency and is halved if the latency doubles compared to the
+baseline or an SSH connection fails. The baseline is the smallest
+latency of a round and follows higher latencies slowly. The latency
+of a batch file is taken per line (command), so that batch files of
+different sizes and single commands compare.
+All tasks with the same tid are executed on the same terminal.
+'''
+class _TerminalPool:
+    def __init__(self, remote, size, verbosity='normal'):
+        self.remote = remote
+        self.verbosity = verbosity
+        self.size = size
+        self.limit = self.size
+        self.terminals = []
+        # tid => [terminal, number of pending tasks]
+        self.tids = {}
+        self.lock = threading.Lock()
+        # signaled when a terminal is not busy anymore
+        self.idle = threading.Condition(self.lock)
+        # number of terminals executing a command
+        self.busy = 0
+        # moving average of the latency, smallest in this round and baseline
+        self.latency = None
+        self.latency_round = None
+        self.latency_min = None
+        self.completed = 0
+
+    def _get_terminal(self):
+        active = self.terminals[:self.limit]
+
+        for terminal in active:
+            if terminal.pending == 0:
+                return terminal
+
+        if len(active) < self.limit:
+            # create another terminal
+            terminal = TerminalThread(len(self.terminals), self.remote, self.verbosity, self)
+            self.terminals.append(terminal)
+            return terminal
+
+        return min(active, key=lambda terminal: terminal.pending)
+
+    def addTask(self, tid, command, ignore_error=False, onResultCallBack=None, onErrorCallBack=None):
+        with self.lock:
+            entry = self.tids.get(tid)
+            if entry is None:
+                entry = [self._get_terminal(), 0]
+                self.tids[tid] = entry
+            entry[1] += 1
+            terminal = entry[0]
+            terminal.pending += 1
+
+        terminal.tasks.put((tid, ignore_error, command, onResultCallBack, onErrorCallBack, time.monotonic()))
+        return terminal
+
+    # called from terminal thread, waits until less than limit terminals are busy
+    def taskStart(self):
+        with self.lock:
+            while self.busy >= self.limit:
+                self.idle.wait()
+            self.busy += 1
+
+    # called from terminal thread
+    def taskDone(self, terminal, tid, returncode, duration):
+        with self.lock:
+            self.busy -= 1
+            self.idle.notify()
+            terminal.pending -= 1
+            entry = self.tids[tid]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.tids[tid]
+
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency = 0.9 * self.latency + 0.1 * duration
+
+            if self.latency_round is None or self.latency < self.latency_round:
+                self.latency_round = self.latency
+
+            # ssh returns 255 on connection errors
+            if self.remote.address and returncode == 255:
+                self.limit = max(1, self.limit // 2)
+                self.completed = 0
+                return
+
+            self.completed += 1
+            if self.completed >= self.limit:
+                self.completed = 0
+                # let the baseline follow a permanent latency change slowly
+                if self.latency_min is None or self.latency_round < self.latency_min:
+                    self.latency_min = self.latency_round
+                else:
+                    self.latency_min = 0.98 * self.latency_min + 0.02 * self.latency_round
+                self.latency_round = None
+
+                if self.latency > 2 * self.latency_min:
+                    self.limit = max(1, self.limit // 2)
+                elif self.limit < self.size:
+                    self.limit += 1
+                    self.idle.notify()
+
 class TerminalGroup():
     def __init__(self, verbosity='normal'):
-        self.terminals = {}
-        self.cpu_count = os.cpu_count()
+        # remote => _TerminalPool
+        self.pools = {}
+        self.lock = threading.Lock()
         self.cpu_counter = 0
         self.verbosity = verbosity
 
     def setVerbosity(self, verbosity):
         self.verbosity = verbosity
 
-    def addTask(self, tid, remote, command, ignore_error=False, onResultCallBack=None):
-        idx = abs(tid) % self.cpu_count
-        terminal = self.terminals.get(idx, None)
-        if not terminal:
-            # create another terminal
-            terminal = TerminalThread(idx, remote, self.verbosity)
-            self.terminals[idx] = terminal
+    def _getTerminals(self):
+        terminals = []
+        for pool in self.pools.values():
+            terminals += pool.terminals
+        return terminals
 
-        terminal.tasks.put((ignore_error, command, onResultCallBack))
-        return terminal
+    def addTask(self, tid, remote, command, ignore_error=False, onResultCallBack=None, onErrorCallBack=None):
+        with self.lock:
+            pool = self.pools.get(remote)
+
+        if pool is None:
+            # not while holding the lock (nproc via SSH)
+            size = max(1, _get_cpu_count(remote))
+            with self.lock:
+                pool = self.pools.setdefault(remote, _TerminalPool(remote, size, self.verbosity))
+
+        return pool.addTask(tid, command, ignore_error, onResultCallBack, onErrorCallBack)
 
     def stopAllTerminals(self):
-        for terminal in self.terminals.values():
+        for terminal in self._getTerminals():
             terminal.finish = True
-        for terminal in self.terminals.values():
+        for terminal in self._getTerminals():
             terminal.join()
 
     def waitForCompletion(self):
-        for terminal in self.terminals.values():
+        for terminal in self._getTerminals():
             terminal.tasks.join()
 
 globalTerminalGroup = TerminalGroup()
@@ -307,35 +587,156 @@ def get_thread_id():
     globalTerminalGroup.cpu_counter += 1
     return globalTerminalGroup.cpu_counter
 
+'''
+Record every executed command and write a Chrome trace file
+(open with https://ui.perfetto.dev or chrome://tracing). Each
+remote is a process and each terminal a thread with a slice
+per command. The time in the terminal queue is shown as async
+slice, the waiting of the calling threads (e.g. exec with
+get_output=True) as slices of the process "caller".
+'''
+class _Tracer:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.beg = time.monotonic()
+        self.events = []
+        # remote label => pid (0 is the caller)
+        self.pids = {}
+        self.threads = set()
+        self.queue_id = 0
+        self.events.append({'name': 'process_name', 'ph': 'M', 'pid': 0, 'args': {'name': 'caller'}})
+
+    def _us(self, t):
+        return round((t - self.beg) * 1000000)
+
+    def _get_pid(self, remote):
+        label = remote.address or 'local'
+        pid = self.pids.get(label)
+        if pid is None:
+            pid = len(self.pids) + 1
+            self.pids[label] = pid
+            self.events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': label}})
+        return pid
+
+    def _set_thread_name(self, pid, tid, name):
+        if (pid, tid) not in self.threads:
+            self.threads.add((pid, tid))
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+
+    # called from terminal threads
+    def add_command(self, terminal, task_id, command, enqueued, started, finished, returncode, output_size):
+        with self.lock:
+            pid = self._get_pid(terminal.remote)
+            self._set_thread_name(pid, terminal.num, f'terminal {terminal.num}')
+            self.queue_id += 1
+            name = command.split(None, 1)[0] if command.strip() else command
+            self.events.append({'name': 'queued', 'cat': 'queue', 'ph': 'b', 'id': self.queue_id,
+                'pid': pid, 'tid': terminal.num, 'ts': self._us(enqueued)})
+            self.events.append({'name': 'queued', 'cat': 'queue', 'ph': 'e', 'id': self.queue_id,
+                'pid': pid, 'tid': terminal.num, 'ts': self._us(started)})
+            self.events.append({'name': name, 'cat': 'command', 'ph': 'X',
+                'pid': pid, 'tid': terminal.num, 'ts': self._us(started), 'dur': self._us(finished) - self._us(started),
+                'args': {'command': command, 'task': task_id, 'returncode': returncode, 'output_bytes': output_size,
+                    'queued_ms': round((started - enqueued) * 1000, 3)}})
+
+    # time spent waiting in the calling thread
+    def add_wait(self, name, beg, end):
+        with self.lock:
+            thread = threading.current_thread()
+            self._set_thread_name(0, thread.ident, thread.name)
+            self.events.append({'name': name, 'cat': 'wait', 'ph': 'X',
+                'pid': 0, 'tid': thread.ident, 'ts': self._us(beg), 'dur': self._us(end) - self._us(beg)})
+
+    def write(self):
+        with self.lock:
+            with open(self.path, 'w') as file:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file)
+
+_tracer = None
+
+# record all commands and write them to a Chrome trace file on exit (or stop_trace)
+def start_trace(path):
+    global _tracer
+    if _tracer is None:
+        atexit.register(stop_trace)
+    _tracer = _Tracer(path)
+
+def stop_trace():
+    global _tracer
+    if _tracer is not None:
+        _tracer.write()
+        _tracer = None
+
 def exec(tid, remote, command, get_output=False, ignore_error=False, onResultCallBack=None):
     if get_output:
-        result = None
-        def onResult(rc, stdout, stderr):
-            nonlocal result
-            result = (stdout, stderr, rc)
-
         if onResultCallBack is not None:
             eprint('onResultCallBack not supported for get_output=True.')
             stop_all_terminals()
             exit(1)
 
-        globalTerminalGroup.addTask(tid, remote, command, ignore_error, onResult)
-
-        while result is None:
-            time.sleep(0.01)
-        return result
+        try:
+            return gather([exec_async(tid, remote, command, ignore_error)], 'exec (get_output)')[0]
+        except CommandError as e:
+            eprint(e.stdout)
+            eprint(e.stderr)
+            eprint(f'Abort, {e}')
+            eprint('Network might be in an undefined state!')
+            stop_all_terminals()
+            exit(1)
     else:
         globalTerminalGroup.addTask(tid, remote, command, ignore_error, onResultCallBack)
 
+# a command failed (see exec_async)
+class CommandError(Exception):
+    def __init__(self, remote, command, returncode, stdout, stderr):
+        super().__init__(f'command failed on {remote.address or "local"} ({returncode}): {command}')
+        self.remote = remote
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+'''
+Queue a command and return a future (concurrent.futures.Future)
+with the result (stdout, stderr, returncode). Start many commands
+(with different tids to run them in parallel) and collect the
+results with gather(). In asyncio code, use asyncio.wrap_future()
+to await the future. The number of commands that run at the same
+time on a remote is limited by its terminal pool. If the command
+fails (and ignore_error is not set), the future raises CommandError.
+'''
+def exec_async(tid, remote, command, ignore_error=False):
+    future = concurrent.futures.Future()
+
+    def onResult(rc, stdout, stderr):
+        future.set_result((stdout, stderr, rc))
+
+    globalTerminalGroup.addTask(tid, remote, command, ignore_error, onResult, future.set_exception)
+    return future
+
+# wait for the results of multiple futures (in the same order), raises CommandError
+def gather(futures, name='gather'):
+    beg = time.monotonic()
+    try:
+        return [future.result() for future in futures]
+    finally:
+        if _tracer is not None:
+            _tracer.add_wait(name, beg, time.monotonic())
+
 '''
 The open terminal threads block our
 program to exit if not finished
 '''
 def stop_all_terminals():
     globalTerminalGroup.stopAllTerminals()
+    netlink.close_readers()
 
 def wait_for_completion():
+    beg = time.monotonic()
     globalTerminalGroup.waitForCompletion()
+    if _tracer is not None:
+        _tracer.add_wait('wait_for_completion', beg, time.monotonic())
 
 # id independent of source/target direction
 def link_id(source, target):
@@ -344,44 +745,244 @@ def link_id(source, target):
     else:
         return f'{target}-{source}'
 
-def get_current_state(remotes):
+'''
+Node namespaces created without "ip netns add" (see network.py
+--namespaces holder) are kept alive by a holder process (sleep)
+that is started with unshare. The PID of the holder is stored in
+a file per namespace in holder_dir. Commands are executed in the
+namespace using nsenter with the PID (network and mount namespace
+with its own /sys, like ip netns exec). No bind mounts are needed.
+'''
+holder_dir = '/run/meshnet-lab/netns'
+
+# (remote, node) => PID of holder process
+_holder_pids = {}
+
+# shell command to list all holders as "<holder_dir>/ns-<node>:<pid>"
+_holder_list_command = f"grep -H '' {holder_dir}/ns-* 2> /dev/null"
+
+def _parse_holders(remote, output):
+    holder_re = re.compile(f'^{re.escape(holder_dir)}/ns-([^:]+):(\\d+)$', re.MULTILINE)
+    for key in [key for key in _holder_pids if key[0] == remote]:
+        del _holder_pids[key]
+    for node, pid in holder_re.findall(output):
+        _holder_pids[(remote, node)] = int(pid)
+    return holder_re
+
+def get_holder_pid(remote, node):
+    return _holder_pids.get((remote, str(node)))
+
+def set_holder_pid(remote, node, pid):
+    if pid is None:
+        _holder_pids.pop((remote, str(node)), None)
+    else:
+        _holder_pids[(remote, str(node))] = pid
+
+# argv prefix to execute a command in the namespace of a node
+def netns_exec_args(remote, node):
+    pid = get_holder_pid(remote, node)
+    if pid is not None:
+        return ['nsenter', '-t', str(pid), '-n', '-m']
+    return ['ip', 'netns', 'exec', f'ns-{node}']
+
+# shell command prefix to execute a command in the namespace of a node
+def netns_exec(remote, node):
+    return shlex.join(netns_exec_args(remote, node))
+
+# file of the network namespace of a node (e.g. for setns)
+def netns_path(remote, node):
+    pid = get_holder_pid(remote, node)
+    if pid is not None:
+        return f'/proc/{pid}/ns/net'
+    return f'/run/netns/ns-{node}'
+
+'''
+Namespace of a node for in-process netlink queries (e.g.
+netlink.get_link_stats), or None if not available (remote
+node or not root). Callers fall back to netns_exec then.
+'''
+def local_netns(remote, node):
+    if remote.address is not None or os.geteuid() != 0:
+        return None
+    pid = get_holder_pid(remote, node)
+    return f'ns-{node}' if pid is None else str(pid)
+
+'''
+Addresses of the node namespaces, node => {ifname: addr_info}
+(addr_info as in "ip -j addr list"). Nodes that are not in the
+table are read by get_addresses with a single query per remote
+(netlink for local nodes). network.py removes the entries of
+changed nodes and software.py clears the table when software
+is started or stopped (it adds interfaces and addresses).
+'''
+_address_table = {}
+
+# ip -n only switches the network namespace (faster than ip netns exec)
+def _addr_list_command(remote, node):
+    if get_holder_pid(remote, node) is None:
+        return f'ip -n ns-{node} -j addr list'
+    return f'{netns_exec(remote, node)} ip -j addr list'
+
+def get_addresses(rmap, nodes):
+    nodes = [str(node) for node in nodes]
+
+    queries = {} # remote => [node]
+    for node in nodes:
+        if node in _address_table:
+            continue
+
+        remote = rmap[node]
+        nsname = local_netns(remote, node)
+        if nsname is not None:
+            try:
+                _address_table[node] = netlink.get_all_addresses(nsname)
+            except OSError:
+                # namespace does not exist
+                _address_table[node] = {}
+            continue
+
+        queries.setdefault(remote, []).append(node)
+
+    # one JSON line per node
+    futures = []
+    for remote, remote_nodes in queries.items():
+        command = '; '.join(
+            f'{_addr_list_command(remote, node)} 2> /dev/null || echo "[]"'
+            for node in remote_nodes
+        )
+        futures.append(exec_async(get_thread_id(), remote, command, ignore_error=True))
+
+    for remote_nodes, (stdout, _, _) in zip(queries.values(), gather(futures, 'get_addresses')):
+        lines = stdout.splitlines()
+        for i, node in enumerate(remote_nodes):
+            entries = json.loads(lines[i]) if i < len(lines) else []
+            _address_table[node] = {entry['ifname']: entry.get('addr_info', []) for entry in entries}
+
+    return {node: _address_table[node] for node in nodes}
+
+# remove nodes from the address table (all if None)
+def clear_addresses(nodes=None):
+    if nodes is None:
+        _address_table.clear()
+    else:
+        for node in nodes:
+            _address_table.pop(str(node), None)
+
+'''
+Parse the entries of "tc -j qdisc show" into the link emulation
+settings of each ve-* interface. A netem qdisc sets delay, jitter
+and loss and a tbf qdisc limits the rate.
+ifname => {'root': kind, 'netem': (delay_ms, jitter_ms, loss_pc), 'rate': rate_mbit}
+'''
+def parse_qdiscs(entries):
+    qdiscs = {}
+    for entry in entries:
+        ifname = entry.get('dev', '')
+        if not ifname.startswith('ve-'):
+            continue
+
+        kind = entry.get('kind')
+        options = entry.get('options', {})
+        qdisc = qdiscs.setdefault(ifname, {'root': None, 'netem': None, 'rate': None})
+        if entry.get('root', False):
+            qdisc['root'] = kind
+
+        if kind == 'netem':
+            delay = options.get('delay', {})
+            loss = options.get('loss-random', {})
+            # seconds and fraction
+            qdisc['netem'] = (delay.get('delay', 0) * 1000, delay.get('jitter', 0) * 1000, loss.get('loss', 0) * 100)
+        elif kind == 'tbf':
+            # bytes per second
+            qdisc['rate'] = options.get('rate', 0) * 8 / 1000000
+    return qdiscs
+
+# add the link attributes of the emulation settings of a link
+def _add_emulation(link, qdisc):
+    if qdisc['netem'] is not None:
+        (delay_ms, jitter_ms, loss_pc) = qdisc['netem']
+        link['latency_ms'] = round(delay_ms, 3)
+        if jitter_ms > 0:
+            link['jitter_ms'] = round(jitter_ms, 3)
+        if loss_pc > 0:
+            link['loss_pc'] = round(loss_pc, 3)
+    if qdisc['rate'] is not None:
+        link['rate_mbit'] = round(qdisc['rate'], 3)
+
+'''
+Discover nodes and links from the "switch" namespace with
+a single query per remote (interfaces, qdiscs and holders).
+Links get the attributes of their emulation settings (e.g.
+latency_ms). If a set is given as down_links, the ids of
+links that are set down (on either end) are added to it.
+If a dict is given as qdiscs, the emulation settings are
+stored in it as (remote, ifname) => settings (see parse_qdiscs).
+'''
+def get_current_state(remotes, down_links=None, qdiscs=None):
     links = {}
     nodes = []
     rmap = {}
-
-    node_re = re.compile(r'\d+: br-([^:]+)')
-    link_re = re.compile(r'\d+: ve-([^@:]+).*(?<= master )br-([^ ]+)')
-
-    for remote in remotes:
-        tid = get_thread_id()
-        stdout, stderr, rcode = exec(tid, remote, f'ip netns exec "switch" ip a l || true', get_output=True)
-
-        for line in stdout.splitlines():
-            m = link_re.search(line)
-            if m:
-                ifname = m.group(1) # without ve-
-                master = m.group(2) # without br-
-                source = ifname[:len(master)]
-                target = ifname[len(master) + 1:]
-
-                lid = link_id(source, target)
-                if lid not in links:
-                    links[lid] = {'source': source, 'target': target}
-            m = node_re.search(line)
-            if m:
-                ifname = m.group(1) # without br-
-                nodes.append({'id': ifname})
-                rmap[ifname] = remote
+    settings = {}
+
+    # one JSON line each, followed by the holders of node namespaces
+    command = (
+        'ip -j -n switch link show 2> /dev/null || echo "[]"; '
+        + 'tc -j -n switch qdisc show 2> /dev/null || echo "[]"; '
+        + f'{_holder_list_command}; true'
+    )
+    futures = [exec_async(get_thread_id(), remote, command) for remote in remotes]
+
+    for remote, (stdout, stderr, rcode) in zip(remotes, gather(futures)):
+        _parse_holders(remote, stdout)
+        (interfaces, qdisc_entries, _) = (stdout + '\n\n').split('\n', 2)
+
+        for ifname, qdisc in parse_qdiscs(json.loads(qdisc_entries or '[]')).items():
+            settings[(remote, ifname)] = qdisc
+
+        for entry in json.loads(interfaces or '[]'):
+            ifname = entry['ifname']
+            if ifname.startswith('br-'):
+                nodes.append({'id': ifname[3:]})
+                rmap[ifname[3:]] = remote
+                continue
+
+            # ve-<source>-<target> in bridge br-<source>
+            master = entry.get('master', '')
+            if not ifname.startswith('ve-') or not master.startswith('br-'):
+                continue
+            source = master[3:]
+            if not ifname.startswith(f've-{source}-'):
+                continue
+            target = ifname[len(source) + 4:]
+
+            lid = link_id(source, target)
+            if lid not in links:
+                links[lid] = {'source': source, 'target': target}
+
+            if down_links is not None and 'UP' not in entry.get('flags', []):
+                down_links.add(lid)
+
+    for link in links.values():
+        source = link['source']
+        qdisc = settings.get((rmap.get(source), f've-{source}-{link["target"]}'))
+        if qdisc is not None:
+            _add_emulation(link, qdisc)
+
+    if qdiscs is not None:
+        qdiscs.update(settings)
 
     return ({'nodes': nodes, 'links': list(links.values())}, rmap)
 
 def get_remote_mapping(remotes):
     rmap = {}
 
-    for remote in remotes:
-        tid = get_thread_id()
-        (stdout, _, _) = exec(tid, remote, 'ip netns list', get_output=True)
-        for line in stdout.split():
+    futures = [exec_async(get_thread_id(), remote, f'ip netns list; {_holder_list_command}; true') for remote in remotes]
+
+    for remote, (stdout, _, _) in zip(remotes, gather(futures)):
+        holder_re = _parse_holders(remote, stdout)
+        for node, _ in holder_re.findall(stdout):
+            rmap[node] = remote
+        for line in holder_re.sub('', stdout).split():
             if line.startswith('ns-'):
                 rmap[line.strip()[3:]] = remote
 
@@ -424,15 +1025,14 @@ def check_access(remotes):
             exit(1)
 
     for remote in remotes:
-        tid = get_thread_id()
-
         if remote.address is None:
             eprint('Need external address for all remotes.')
             stop_all_terminals()
             exit(1)
 
-        # check if we can execute something
-        (stdout, stderr, rcode) = exec(tid, remote, 'true', get_output=True, ignore_error=True)
+    # check if we can execute something (all remotes at once)
+    futures = [exec_async(get_thread_id(), remote, 'true', ignore_error=True) for remote in remotes]
+    for (stdout, stderr, rcode) in gather(futures):
         if rcode != 0:
             eprint(stdout)
             eprint(stderr)
@@ -15,11 +15,12 @@ import re
 from shared import (
     eprint, wait_for_completion, exec, default_remotes, check_access,
     millis, get_remote_mapping, stop_all_terminals, wait_for_completion,
-    format_duration, get_current_state, Remote, get_thread_id
+    format_duration, get_current_state, Remote, get_thread_id, start_trace,
+    netns_exec, clear_addresses
 )
 
 from ping import (
-    _get_ip_address, _get_interface
+    _get_ip_addresses, _get_interface
 )
 
 verbosity = 'normal'
@@ -76,7 +77,7 @@ def _stop_protocol(protocol, rmap, ids, duration_ms=0):
                 time.sleep((sheduled - now) / 1000.0)
 
         label = remote.address or 'local'
-        command = f'ip netns exec ns-{id} sh -s {label} {id} < {path}'
+        command = f'{netns_exec(remote, id)} sh -s {label} {id} < {path}'
 
         tid = get_thread_id()
         exec(tid, remote, command, ignore_error=False, onResultCallBack=onResultCallBack)
@@ -84,6 +85,9 @@ def _stop_protocol(protocol, rmap, ids, duration_ms=0):
 
     wait_for_completion()
 
+    # interfaces and addresses have changed
+    clear_addresses()
+
     if duration_ms > 0:
         # delay until we meet sheduled duration
         sheduled = count * (duration_ms / len(ids))
@@ -120,7 +124,7 @@ def _start_protocol(protocol, rmap, ids, duration_ms=0):
                 time.sleep((sheduled - now) / 1000.0)
 
         label = remote.address or 'local'
-        command = f'ip netns exec ns-{id} sh -s {label} {id} < {path}'
+        command = f'{netns_exec(remote, id)} sh -s {label} {id} < {path}'
 
         tid = get_thread_id()
         exec(tid, remote, command, ignore_error=False, onResultCallBack=onResultCallBack)
@@ -128,6 +132,9 @@ def _start_protocol(protocol, rmap, ids, duration_ms=0):
 
     wait_for_completion()
 
+    # interfaces and addresses have changed
+    clear_addresses()
+
     if duration_ms > 0:
         # delay until we meet sheduled duration
         sheduled = count * (duration_ms / len(ids))
@@ -146,20 +153,23 @@ def _wait_till_ready(rmap):
     started_ms = millis()
     interface = None
     iteration = 0
+    # nodes without an address so far
+    nodes = list(rmap.keys())
 
     while True:
         # the node that we have to wait for in this iteration
         wait_for_node = None
-        for node, remote in rmap.items():
-            if interface:
-                address = _get_ip_address(remote, node, interface)
-                if address is None:
-                    wait_for_node = node
-                    break
-            else:
-                wait_for_node = node
-                interface = _get_interface(remote, node)
-                break
+        if interface:
+            # check all remaining nodes at once (one query per remote)
+            clear_addresses(nodes)
+            addresses = _get_ip_addresses([(rmap[node], node, interface) for node in nodes])
+            nodes = [node for node, address in zip(nodes, addresses) if address is None]
+            if len(nodes) > 0:
+                wait_for_node = nodes[0]
+        elif len(rmap) > 0:
+            (node, remote) = next(iter(rmap.items()))
+            wait_for_node = node
+            interface = _get_interface(remote, node)
 
         if wait_for_node is None:
             # all good
@@ -193,18 +203,21 @@ def clear(remotes):
             i += 1
 
     wait_for_completion()
+    clear_addresses()
 
     end_ms = millis()
     if verbosity != 'quiet':
         print('cleared on {} remotes in {}'.format(len(remotes), format_duration(end_ms - beg_ms)))
 
-def stop(protocol, remotes=default_remotes):
-    rmap = get_remote_mapping(remotes)
+def stop(protocol, remotes=default_remotes, rmap=None):
+    if rmap is None:
+        rmap = get_remote_mapping(remotes)
     ids = list(rmap.keys())
     _stop_protocol(protocol, rmap, ids)
 
-def start(protocol, remotes=default_remotes):
-    rmap = get_remote_mapping(remotes)
+def start(protocol, remotes=default_remotes, rmap=None):
+    if rmap is None:
+        rmap = get_remote_mapping(remotes)
     ids = list(rmap.keys())
     _start_protocol(protocol, rmap, ids)
     _wait_till_ready(rmap)
@@ -214,6 +227,7 @@ def main():
     parser.add_argument('--verbosity', choices=['verbose', 'normal', 'quiet'], default='normal', help='Set verbosity.')
     parser.add_argument('--remotes', help='Distribute nodes and links on remotes described in the JSON file.')
     parser.add_argument('--duration',  type=int, default=0, help='Start/Stop software over a duration [ms].')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace (JSON) of all executed commands to FILE.')
     parser.set_defaults(ids=None)
 
     subparsers = parser.add_subparsers(dest='action', required=True, help='Action')
@@ -261,6 +275,9 @@ def main():
     global verbosity
     verbosity = args.verbosity
 
+    if args.trace:
+        start_trace(args.trace)
+
     rmap = get_remote_mapping(args.remotes)
     ids = args.ids if args.ids else list(rmap.keys())
 
@@ -281,7 +298,7 @@ def main():
         for i, id in enumerate(ids):
             remote = rmap[id]
             label = remote.address or 'local'
-            command = f'ip netns exec ns-{id} {" ".join(args.command)} {label} {id}'
+            command = f'{netns_exec(remote, id)} {" ".join(args.command)} {label} {id}'
             tid = get_thread_id()
             exec(tid, remote, command, ignore_error=False)
             wait_for_completion()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import sys
+import threading
+
+sys.path.append('../../')
+from shared import Remote
+import network
+
+'''
+Check the order of the batch files of network.py without executing
+them: the root namespace batch that creates a l2tp session or VXLAN
+device has to run before the "switch" batch that configures it, even
+if a link within a remote comes first. Removals run in reverse order.
+As dependency graph, the links of a remote are created while another
+remote is still busy creating its nodes.
+'''
+
+remote1 = Remote('192.168.44.133')
+remote2 = Remote('192.168.44.137')
+rmap = {'a': remote1, 'b': remote1, 'c': remote2}
+
+# batch files in execution order as (remote address, namespace, lines)
+executed = []
+# completion of commands on remote2 is held back until released (slow remote)
+held = []
+# indexes of executed batch files before the release
+early = []
+released = threading.Event()
+released.set()
+lock = threading.Lock()
+
+def record(tid, remote, command, onResultCallBack=None, **kwargs):
+	if onResultCallBack is not None:
+		# marker of the dependency graph
+		with lock:
+			if remote == remote2 and not released.is_set():
+				held.append(onResultCallBack)
+				return
+		onResultCallBack(0, '', '')
+		return
+
+	lines = command.split('\n')
+	nsname = lines[0].split('"')[1] if ' -n "' in lines[0] else None
+	executed.append((remote.address, nsname, lines[1:-1]))
+	if not released.is_set():
+		early.append(len(executed) - 1)
+
+def release():
+	with lock:
+		released.set()
+	for callback in held:
+		callback(0, '', '')
+
+network.exec = record
+network.wait_for_completion = lambda: None
+
+def run_phase(phase, func, items):
+	network._commands = network._Commands(batched=True)
+	network._commands.phase = phase
+	for item in items:
+		func(item, None, rmap)
+	network._commands.flush()
+	return list(executed)
+
+def check(name, condition):
+	print(f'{name}: {"ok" if condition else "FAILED"}')
+	if not condition:
+		print('\n'.join(str(entry) for entry in executed))
+		exit(1)
+
+# intra-remote link (a-b) first, then a link between remotes (b-c)
+links = [{'source': 'a', 'target': 'b'}, {'source': 'b', 'target': 'c'}]
+
+for interconnect in ['l2tp', 'vxlan']:
+	network.interconnect = interconnect
+	network._l2tp = network._L2tpRegistry()
+	network._vxlan = network._VxlanRegistry()
+
+	executed.clear()
+	run_phase('create links', network.create_link, links)
+	for address in [remote1.address, remote2.address]:
+		kinds = [nsname for addr, nsname, _ in executed if addr == address]
+		check(f'{interconnect} create root before switch on {address}', kinds.index(None) < kinds.index('switch'))
+
+	if interconnect == 'vxlan':
+		# VLAN interfaces are added on the VXLAN device after it was moved to "switch"
+		for address in [remote1.address, remote2.address]:
+			batches = [(nsname, '\n'.join(lines)) for addr, nsname, lines in executed if addr == address]
+			moved = next(i for i, (nsname, content) in enumerate(batches) if nsname is None and 'netns switch' in content)
+			vlan = next(i for i, (nsname, content) in enumerate(batches) if nsname == 'switch' and 'type vlan' in content)
+			check(f'vxlan device before VLAN interface on {address}', moved < vlan)
+
+	executed.clear()
+	run_phase('remove nodes', network.remove_node, [{'id': 'a'}])
+	kinds = [nsname for _, nsname, _ in executed]
+	check(f'{interconnect} remove switch before root', kinds.index('switch') < kinds.index(None))
+
+# dependency graph (default), remote2 is slow
+network.interconnect = 'l2tp'
+network._l2tp = network._L2tpRegistry()
+network._commands = network._Commands(batched=True)
+data = network._Task()
+data.nodes_create = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+data.links_create = links
+
+executed.clear()
+released.clear()
+threading.Timer(0.5, release).start()
+network._run_batch_graph(data, None, None, rmap)
+
+# phase of each batch file by its commands
+def get_phase(lines):
+	return 'create links' if any(line.startswith('l2tp') or 've-' in line for line in lines) else 'create nodes'
+
+for address in [remote1.address, remote2.address]:
+	batches = [(nsname, get_phase(lines)) for addr, nsname, lines in executed if addr == address]
+	phases = [phase for _, phase in batches]
+	check(f'graph create nodes before links on {address}', phases == sorted(phases, key=['create nodes', 'create links'].index))
+	kinds = ['node' if nsname not in [None, 'switch'] else nsname for nsname, phase in batches if phase == 'create nodes']
+	check(f'graph create root, switch, node namespaces on {address}', kinds == sorted(kinds, key=[None, 'switch', 'node'].index))
+
+# remote1 creates its links while remote2 is still busy
+early_links = [executed[i][0] for i in early if get_phase(executed[i][2]) == 'create links']
+check('graph slow remote does not stall other remotes', remote1.address in early_links and remote2.address not in early_links)
@@ -0,0 +1,38 @@
+#!/bin/sh
+
+# to distinguish multiple runs (if needed)
+prefix="$1"
+
+gnuplot -e "
+	set title \"Time to create links between two remotes.\"; \
+	set terminal pngcairo size 1280,960; \
+	set output '${prefix}interconnect1-create.png'; \
+	set grid back lc rgb '#808080' lt 0 lw 1; \
+	set border 3 back lc rgb '#808080' lt 1; \
+	set key left top spacing 1 font 'sans, 18'; \
+	set xlabel '# number of links'; \
+	set ylabel 'time [s]'; \
+	set termoption lw 3; \
+	plot \
+	'${prefix}interconnect1-l2tp.csv' using (column('link_count')):(column('create_ms') / 1000) with linespoints linetype rgb 'dark-violet' title 'l2tp create', \
+	'${prefix}interconnect1-l2tp.csv' using (column('link_count')):(column('remove_ms') / 1000) with linespoints dashtype 2 linecolor rgb 'dark-violet' title 'l2tp remove', \
+	'${prefix}interconnect1-vxlan.csv' using (column('link_count')):(column('create_ms') / 1000) with linespoints linetype rgb 'skyblue' title 'vxlan create', \
+	'${prefix}interconnect1-vxlan.csv' using (column('link_count')):(column('remove_ms') / 1000) with linespoints dashtype 2 linecolor rgb 'skyblue' title 'vxlan remove', \
+	;
+"
+
+gnuplot -e "
+	set title \"Throughput over a link between two remotes.\"; \
+	set terminal pngcairo size 1280,960; \
+	set output '${prefix}interconnect1-throughput.png'; \
+	set grid back lc rgb '#808080' lt 0 lw 1; \
+	set border 3 back lc rgb '#808080' lt 1; \
+	set key left top spacing 1 font 'sans, 18'; \
+	set xlabel '# number of links'; \
+	set ylabel 'throughput [Mbit/s]'; \
+	set termoption lw 3; \
+	plot \
+	'${prefix}interconnect1-l2tp.csv' using (column('link_count')):(column('throughput_mbit')) with linespoints linetype rgb 'dark-violet' title 'l2tp', \
+	'${prefix}interconnect1-vxlan.csv' using (column('link_count')):(column('throughput_mbit')) with linespoints linetype rgb 'skyblue' title 'vxlan', \
+	;
+"
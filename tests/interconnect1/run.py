@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import json
+import sys
+import re
+
+sys.path.append('../../')
+from shared import Remote
+import shared
+import network
+
+'''
+Compare the l2tp and VXLAN interconnect of links between two
+remotes: time to create/remove the links and throughput over a link.
+'''
+
+remotes = [Remote('192.168.44.133'), Remote('192.168.44.137')]
+
+shared.check_access(remotes)
+network.clear(remotes)
+
+def get_nodes_state(count):
+	return {'nodes': [{'id': str(i)} for i in range(count)], 'links': []}
+
+# IPv6 link local address of a node
+def get_address(remote, node):
+	tid = shared.get_thread_id()
+	(stdout, _, _) = shared.exec(tid, remote, f'ip netns exec "ns-{node}" ip -6 addr show dev uplink scope link', get_output=True)
+	return re.search(r'inet6 ([^/]+)', stdout).group(1)
+
+# iperf3 throughput in Mbit/s from source to target
+def get_throughput(source, target, rmap):
+	tid = shared.get_thread_id()
+	address = get_address(rmap[target], target)
+	shared.exec(tid, rmap[target], f'ip netns exec "ns-{target}" iperf3 --server --one-off --daemon')
+	shared.sleep(1)
+	(stdout, _, _) = shared.exec(tid, rmap[source], f'ip netns exec "ns-{source}" iperf3 --json --time 10 --client "{address}%uplink"', get_output=True)
+	return json.loads(stdout)['end']['sum_received']['bits_per_second'] / 1000000
+
+def run(interconnect, link_count, csvfile):
+	network.interconnect = interconnect
+	print(f'run {interconnect} with {link_count} links')
+
+	# place nodes first, then link nodes on different remotes
+	state = get_nodes_state(2 * link_count)
+	network.apply(state=state, remotes=remotes)
+	shared.sleep(5)
+
+	rmap = shared.get_remote_mapping(remotes)
+	nodes1 = [node for node, remote in rmap.items() if remote == remotes[0]]
+	nodes2 = [node for node, remote in rmap.items() if remote == remotes[1]]
+	links = [{'source': a, 'target': b} for a, b in zip(nodes1, nodes2)]
+
+	create_beg_ms = shared.millis()
+	network.apply(state={'nodes': state['nodes'], 'links': links}, remotes=remotes)
+	create_ms = shared.millis() - create_beg_ms
+
+	shared.sleep(5)
+	throughput_mbit = get_throughput(links[0]['source'], links[0]['target'], rmap)
+
+	remove_beg_ms = shared.millis()
+	network.apply(state=state, remotes=remotes)
+	remove_ms = shared.millis() - remove_beg_ms
+
+	network.clear(remotes)
+
+	titles = ['interconnect', 'link_count', 'create_ms', 'remove_ms', 'throughput_mbit']
+	values = [interconnect, len(links), create_ms, remove_ms, throughput_mbit]
+	shared.csv_update(csvfile, '\t', (titles, values))
+
+for interconnect in ['l2tp', 'vxlan']:
+	with open(f'interconnect1-{interconnect}.csv', 'w+') as csvfile:
+		for link_count in [100, 250, 500, 1000, 2000]:
+			run(interconnect, link_count, csvfile)
+
+shared.stop_all_terminals()
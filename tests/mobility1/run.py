@@ -13,6 +13,7 @@ import network
 import topology
 import mobility
 import ping
+from session import NetworkSession
 from shared import Remote
 import shared
 
@@ -23,6 +24,9 @@ shared.check_access(remotes)
 software.clear(remotes)
 network.clear(remotes)
 
+# only set links down/up on each step instead of removing and creating them again
+network.toggle_links = True
+
 prefix = os.environ.get('PREFIX', '')
 
 # 100MBit LAN cable
@@ -37,9 +41,12 @@ def run(protocol, csvfile, step_duration, step_distance):
 	mobility.randomize_positions(state, xy_range=1000)
 	mobility.connect_range(state, max_links=150)
 
+	# keeps state, node mapping and addresses between the steps
+	session = NetworkSession(remotes)
+
 	# create network and start routing software
-	network.apply(state, link_command=get_tc_command, remotes=remotes)
-	software.start(protocol)
+	session.apply(state, link_command=get_tc_command)
+	session.start(protocol)
 
 	test_beg_ms = shared.millis()
 	for n in range(0, 30):
@@ -57,7 +64,7 @@ def run(protocol, csvfile, step_duration, step_distance):
 
 		# update network
 		tmp_ms = shared.millis()
-		network.apply(state=state, link_command=get_tc_command, remotes=remotes)
+		session.apply(state=state, link_command=get_tc_command)
 		#software.apply(protocol=protocol, state=state) # we do not change the node count
 		network_ms = shared.millis() - tmp_ms
 
@@ -66,7 +73,7 @@ def run(protocol, csvfile, step_duration, step_distance):
 			break
 
 		paths = ping.get_random_paths_filtered(state, min_hops=2, path_count=200)
-		ping_result = ping.ping(paths=paths, duration_ms=2000, verbosity='verbose', remotes=remotes)
+		ping_result = session.ping(paths=paths, duration_ms=2000, verbosity='verbose')
 
 		# add data to csv file
 		extra = (['node_count', 'time_ms'], [node_count, shared.millis() - test_beg_ms])
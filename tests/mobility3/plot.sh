@@ -0,0 +1,31 @@
+#!/bin/sh
+
+# to distinguish multiple runs (if needed)
+prefix="$1"
+
+title='Mobility3 Test for 50 randomly placed nodes in a 1x1km square.\nMove in random directions of 50-400m in 50m increments every 15s.\nContinuous pings (200/s), packet arrival per 250ms.\n100MBit/s - 1ms latency links.'
+
+# progress of packet arrival rate
+gnuplot -e "
+	set title \"$title\" noenhanced; \
+	set terminal pngcairo size 1280,960; \
+	set output '${prefix}mobility3_arrival_progress.png'; \
+	set grid back lc rgb '#808080' lt 0 lw 1; \
+	set border 3 back lc rgb '#808080' lt 1; \
+	set tics nomirror; \
+	set key spacing 2 font 'sans, 18' top right; \
+	set datafile separator '\t'; \
+	set ylabel 'packet arrival [%]'; \
+	set xlabel 'time [s]'; \
+	set termoption lw 1; \
+	plot \
+	'${prefix}mobility3-babel.csv' using (column('time_ms') / 1000):(column('packets_arrived_pc')) with lines linetype rgb 'dark-violet' title 'babel [%]' axis x1y1, \
+	'${prefix}mobility3-batman-adv.csv' using (column('time_ms') / 1000):(column('packets_arrived_pc')) with lines linetype rgb 'skyblue' title 'batman-adv [%]' axis x1y1, \
+	'${prefix}mobility3-bmx6.csv' using (column('time_ms') / 1000):(column('packets_arrived_pc')) with lines linetype rgb 'dark-yellow' title 'bmx6 [%]' axis x1y1, \
+	'${prefix}mobility3-bmx7.csv' using (column('time_ms') / 1000):(column('packets_arrived_pc')) with lines linetype rgb 'gold' title 'bmx7 [%]' axis x1y1, \
+	'${prefix}mobility3-cjdns.csv' using (column('time_ms') / 1000):(column('packets_arrived_pc')) with lines linetype rgb 'dark-red' title 'cjdns [%]' axis x1y1, \
+	'${prefix}mobility3-olsr1.csv' using (column('time_ms') / 1000):(column('packets_arrived_pc')) with lines linetype rgb 'coral' title 'olsr1 [%]' axis x1y1, \
+	'${prefix}mobility3-olsr2.csv' using (column('time_ms') / 1000):(column('packets_arrived_pc')) with lines linetype rgb 'green' title 'olsr2 [%]' axis x1y1, \
+	'${prefix}mobility3-yggdrasil.csv' using (column('time_ms') / 1000):(column('packets_arrived_pc')) with lines linetype rgb 'purple' title 'yggdrasil [%]' axis x1y1 \
+	;\
+"
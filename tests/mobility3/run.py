@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.append('../../')
+import software
+import network
+import mobility
+import topology
+from shared import Remote
+import shared
+import ping
+
+remotes= [Remote()]
+
+shared.check_access(remotes)
+
+software.clear(remotes)
+network.clear(remotes)
+
+# only set links down/up on each step instead of removing and creating them again
+network.toggle_links = True
+
+prefix = os.environ.get('PREFIX', '')
+
+# 100MBit LAN cable
+def get_tc_command(link, extra):
+	return f'tc qdisc replace dev "{extra.ifname}" root tbf rate 100mbit burst 8192 latency 1ms'
+
+def run(protocol, csvfile):
+	shared.seed_random(23)
+
+	node_count = 50
+	state = topology.create_nodes(node_count)
+	mobility.randomize_positions(state, xy_range=1000)
+	mobility.connect_range(state, max_links=150)
+
+	# create network and start routing software
+	network.apply(state=state, link_command=get_tc_command, remotes=remotes)
+	software.start(protocol)
+	shared.sleep(30)
+
+	# the same random pairs of nodes for the whole test
+	paths = ping.get_random_paths(nodes=[str(node['id']) for node in state['nodes']], count=200)
+
+	# 200 pings per second, statistics for every 250ms
+	measurement = ping.ContinuousPing(paths, rate=200, interval_ms=250, remotes=remotes, csvfile=csvfile)
+	measurement.start()
+
+	for step_distance in [50, 100, 150, 200, 250, 300, 350, 400]:
+		print(f'{protocol}: step_distance {step_distance}')
+
+		for n in range(0, 6):
+			wait_beg_ms = shared.millis()
+
+			# update network representation
+			mobility.move_random(state, distance=step_distance)
+			mobility.connect_range(state, max_links=150)
+
+			# update network while pings are sent
+			measurement.mark(f'{step_distance}m/{n}')
+			network.apply(state=state, link_command=get_tc_command, remotes=remotes)
+
+			# Wait until wait seconds are over, else error
+			if not shared.wait(wait_beg_ms, 15):
+				break
+
+	measurement.stop()
+
+	software.clear(remotes)
+	network.clear(remotes)
+
+for protocol in ['babel', 'batman-adv', 'bmx6', 'bmx7', 'cjdns', 'olsr1', 'olsr2', 'yggdrasil']:
+	with open(f"{prefix}mobility3-{protocol}.csv", 'w+') as csvfile:
+		run(protocol, csvfile)
+
+ping.stop_probers()
+shared.stop_all_terminals()
@@ -0,0 +1,38 @@
+#!/bin/sh
+
+# to distinguish multiple runs (if needed)
+prefix="$1"
+
+gnuplot -e "
+	set title \"Time to create and remove nodes.\"; \
+	set terminal pngcairo size 1280,960; \
+	set output '${prefix}namespaces1_setup.png'; \
+	set grid back lc rgb '#808080' lt 0 lw 1; \
+	set border 3 back lc rgb '#808080' lt 1; \
+	set key left top spacing 1 font 'sans, 18'; \
+	set xlabel '# number of nodes'; \
+	set ylabel 'seconds'; \
+	set termoption lw 3; \
+	plot \
+	'${prefix}namespaces1.csv' using (column('node_count')):(column('netns_create_ms') / 1000) with linespoints linetype rgb 'dark-violet' title 'create (netns)', \
+	'${prefix}namespaces1.csv' using (column('node_count')):(column('holder_create_ms') / 1000) with linespoints linetype rgb 'skyblue' title 'create (holder)', \
+	'${prefix}namespaces1.csv' using (column('node_count')):(column('netns_remove_ms') / 1000) with linespoints linetype rgb 'dark-red' title 'remove (netns)', \
+	'${prefix}namespaces1.csv' using (column('node_count')):(column('holder_remove_ms') / 1000) with linespoints linetype rgb 'dark-green' title 'remove (holder)', \
+	;
+"
+
+gnuplot -e "
+	set title \"Latency to execute a command in a node namespace.\"; \
+	set terminal pngcairo size 1280,960; \
+	set output '${prefix}namespaces1_exec.png'; \
+	set grid back lc rgb '#808080' lt 0 lw 1; \
+	set border 3 back lc rgb '#808080' lt 1; \
+	set key left top spacing 1 font 'sans, 18'; \
+	set xlabel '# number of nodes'; \
+	set ylabel 'milliseconds'; \
+	set termoption lw 3; \
+	plot \
+	'${prefix}namespaces1.csv' using (column('node_count')):(column('netns_exec_ms')) with linespoints linetype rgb 'dark-violet' title 'ip netns exec', \
+	'${prefix}namespaces1.csv' using (column('node_count')):(column('holder_exec_ms')) with linespoints linetype rgb 'skyblue' title 'nsenter (holder)', \
+	;
+"
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import random
+import sys
+import os
+
+sys.path.append('../../')
+from shared import Remote
+import shared
+import network
+
+'''
+Compare named network namespaces (ip netns add, a bind mount each)
+with namespaces held by a process (unshare, no mounts). Measures the
+time to create and remove nodes and the latency to execute a command
+in a node namespace.
+'''
+
+remotes = [Remote()]
+
+shared.check_access(remotes)
+network.clear(remotes)
+
+prefix = os.environ.get('PREFIX', '')
+
+# execute a command in count random nodes, returns milliseconds per command
+def exec_latency(ids, count):
+	beg_ms = shared.millis()
+	for id in random.sample(ids, count):
+		process = shared.create_process(remotes[0], shared.netns_exec_args(remotes[0], id) + ['true'])
+		process.communicate()
+		if process.returncode != 0:
+			shared.eprint(f'command failed in ns-{id}')
+			shared.stop_all_terminals()
+			exit(1)
+	return (shared.millis() - beg_ms) / count
+
+random.seed(42)
+
+with open(f'{prefix}namespaces1.csv', 'w+') as csvfile:
+	for node_count in [1000, 5000, 10000]:
+		state = {'nodes': [{'id': str(i)} for i in range(node_count)]}
+		ids = [str(i) for i in range(node_count)]
+
+		titles = ['node_count']
+		values = [node_count]
+		for namespaces in ['netns', 'holder']:
+			network.namespaces = namespaces
+
+			beg_ms = shared.millis()
+			network.apply(state, remotes=remotes)
+			create_ms = shared.millis() - beg_ms
+
+			# nodes are found again (e.g. by ping.py/software.py)
+			shared.get_remote_mapping(remotes)
+			exec_ms = exec_latency(ids, 200)
+
+			beg_ms = shared.millis()
+			network.apply('none', remotes=remotes)
+			remove_ms = shared.millis() - beg_ms
+
+			print(f'{node_count} nodes ({namespaces}): create {create_ms}ms, remove {remove_ms}ms, exec {exec_ms:.2f}ms')
+
+			titles += [f'{namespaces}_create_ms', f'{namespaces}_remove_ms', f'{namespaces}_exec_ms']
+			values += [create_ms, remove_ms, exec_ms]
+
+		shared.csv_update(csvfile, '\t', (titles, values))
+
+shared.stop_all_terminals()
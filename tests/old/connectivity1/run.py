@@ -12,6 +12,7 @@ import topology
 import mobility
 import shared
 import ping
+import distances
 
 
 prefix = os.environ.get('PREFIX', '')
@@ -33,13 +34,13 @@ def get_mean_geo_distance(state, paths):
 	return distance / len(paths)
 
 def get_connectivity(state, paths):
-	dijkstra = ping.Dijkstra(state)
+	dists = distances.get_distances(state)
 	path_count = 0
 	hop_count = 0
 	max_hop_count = 0
 
 	for path in paths:
-		d = dijkstra.find_shortest_distance(path[0], path[1])
+		d = dists.get_distance(path[0], path[1])
 		if d is not math.inf:
 			path_count += 1
 			hop_count += d
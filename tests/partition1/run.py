@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append('../../')
+from partition import partition, get_cut
+
+'''
+Check the partitioning of nodes on remotes (partition.py)
+without creating a network.
+'''
+
+def check(name, condition):
+	print(f'{name}: {"ok" if condition else "FAILED"}')
+	if not condition:
+		exit(1)
+
+# grid of width x height nodes, each node is linked to its right and lower neighbor
+def grid(width, height):
+	neighbors = {}
+	for x in range(width):
+		for y in range(height):
+			node = f'{x}-{y}'
+			neighbors.setdefault(node, [])
+			for (nx, ny) in [(x + 1, y), (x, y + 1)]:
+				if nx < width and ny < height:
+					neigh = f'{nx}-{ny}'
+					neighbors[node].append(neigh)
+					neighbors.setdefault(neigh, []).append(node)
+	return neighbors
+
+def part_sizes(mapping, parts):
+	sizes = [0] * parts
+	for part in mapping.values():
+		sizes[part] += 1
+	return sizes
+
+check('empty graph', partition({}, [1, 1]) == {})
+check('single node', partition({'a': []}, [1, 1]) in [{'a': 0}, {'a': 1}])
+
+neighbors = grid(40, 40)
+mapping = partition(neighbors, [1, 1, 1])
+sizes = part_sizes(mapping, 3)
+check('all nodes assigned', sorted(mapping.keys()) == sorted(neighbors.keys()))
+check('balanced', max(sizes) <= 1.03 * len(neighbors) / 3 + 1)
+# three horizontal stripes would cut 80 links
+check('small cut', get_cut(neighbors, mapping) <= 120)
+
+mapping = partition(neighbors, [1, 3])
+sizes = part_sizes(mapping, 2)
+check('proportional to capacities', abs(sizes[1] - 3 * sizes[0]) <= 0.1 * len(neighbors))
+
+fixed = {'0-0': 1, '39-39': 0}
+mapping = partition(neighbors, [1, 1], fixed)
+check('fixed nodes keep their part', all(mapping[node] == part for node, part in fixed.items()))
@@ -272,6 +272,9 @@ shared.check_access(remotes)
 software.clear(remotes)
 network.clear(remotes)
 
+# only set links down/up on each step instead of removing and creating them again
+network.toggle_links = True
+
 prefix = os.environ.get('PREFIX', '')
 
 def print_stations():
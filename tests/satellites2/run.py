@@ -287,6 +287,9 @@ shared.check_access(remotes)
 software.clear(remotes)
 network.clear(remotes)
 
+# only set links down/up on each step instead of removing and creating them again
+network.toggle_links = True
+
 prefix = os.environ.get('PREFIX', '')
 
 def print_stations():
@@ -294,22 +297,17 @@ def print_stations():
     for s in stations:
         print(f'{s.id} => {s.name}')
 
-# calculate median
+# calculate the average of each column
 # input: [([...], [...]), ([...], [...]), ...]
-# output: [(...), (...)]
+# output: ([...], [...])
 def merge_results(results):
     if len(results) == 0:
         return None
 
-    ret = copy.copy(results[0])
-    for result in results[1:]:
-        for i, value in enumerate(result[1]):
-            ret[1][i] += value
-
-    for i, value in enumerate(ret[1]):
-        ret[1][i] /= len(ret[0])
+    titles = results[0][0]
+    values = [sum(result[1][i] for result in results) / len(results) for i in range(len(titles))]
 
-    return ret
+    return (titles, values)
 
 def run(protocol, csvfile):
     # informal, data does not change
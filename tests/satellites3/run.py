@@ -273,6 +273,12 @@ shared.check_access(remotes)
 software.clear(remotes)
 network.clear(remotes)
 
+# only set links down/up on each step instead of removing and creating them again
+network.toggle_links = True
+
+# do not re-run the tc command for small changes (~1ms delay, 0.5% loss)
+network.update_thresholds = {'distance': 300, 'tq': 0.05}
+
 prefix = os.environ.get('PREFIX', '')
 
 def print_stations():
@@ -282,7 +288,7 @@ def print_stations():
 
 # set packet loss on links
 def get_tc_command(link, extra):
-    ifname = extra.ifname
+    ifname = extra['ifname']
     # map transfer quality to 0-10%
     loss = int(10 * (1.0 - link.get("tq")))
     # calculate based on the speed of light through vacuum
@@ -0,0 +1,20 @@
+#!/bin/sh
+
+# to distinguish multiple runs (if needed)
+prefix="$1"
+
+gnuplot -e "
+	set title \"Processes started per second (ip netns exec).\"; \
+	set terminal pngcairo size 1280,960; \
+	set output '${prefix}spawn1.png'; \
+	set grid back lc rgb '#808080' lt 0 lw 1; \
+	set border 3 back lc rgb '#808080' lt 1; \
+	set key left top spacing 1 font 'sans, 18'; \
+	set xlabel '# number of processes'; \
+	set ylabel 'processes/s'; \
+	set termoption lw 3; \
+	plot \
+	'${prefix}spawn1.csv' using (column('count')):(column('shell_per_sec')) with linespoints linetype rgb 'dark-violet' title 'shell', \
+	'${prefix}spawn1.csv' using (column('count')):(column('argv_per_sec')) with linespoints linetype rgb 'skyblue' title 'argv (no shell)', \
+	;
+"
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+
+sys.path.append('../../')
+from shared import Remote
+import shared
+import network
+
+'''
+Micro-benchmark of shared.create_process: compare the spawn rate
+of commands started via a shell (command string) and without
+shell (argv list). Every command enters a node namespace.
+'''
+
+remotes = [Remote()]
+
+shared.check_access(remotes)
+network.clear(remotes)
+
+prefix = os.environ.get('PREFIX', '')
+
+# start count processes, then wait for all of them, returns processes per second
+def spawn(command, count):
+	beg_ms = shared.millis()
+	processes = [shared.create_process(remotes[0], command) for _ in range(count)]
+	for process in processes:
+		process.communicate()
+		if process.returncode != 0:
+			shared.eprint(f'command failed: {command}')
+			shared.stop_all_terminals()
+			exit(1)
+	return 1000 * count / max(1, shared.millis() - beg_ms)
+
+network.apply({'nodes': [{'id': '0'}]}, remotes=remotes)
+
+with open(f'{prefix}spawn1.csv', 'w+') as csvfile:
+	for count in [100, 200, 500, 1000, 2000]:
+		shell_rate = spawn('ip netns exec ns-0 true', count)
+		argv_rate = spawn(['ip', 'netns', 'exec', 'ns-0', 'true'], count)
+		print(f'{count} processes: shell {shell_rate:.0f}/s, argv {argv_rate:.0f}/s ({argv_rate / shell_rate:.2f}x)')
+
+		shared.csv_update(csvfile, '\t', (['count', 'shell_per_sec', 'argv_per_sec'], [count, shell_rate, argv_rate]))
+
+network.apply('none', remotes=remotes)
+shared.stop_all_terminals()
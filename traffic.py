@@ -9,11 +9,13 @@ import sys
 import os
 import re
 
+import netlink
 import shared
 from shared import (
     eprint, create_process, exec, get_remote_mapping, millis,
     default_remotes, convert_to_neighbors, stop_all_terminals,
-    wait_for_completion, format_size, Remote, get_thread_id
+    wait_for_completion, format_size, Remote, get_thread_id, start_trace,
+    netns_exec, local_netns
 )
 
 class _Traffic:
@@ -73,31 +75,58 @@ def traffic(remotes=default_remotes, ids=None, interface=None, rmap=None):
     ts = _Traffic()
     ts_lock = threading.Lock()
 
+    # stats as in /sys/class/net/<interface>/statistics/
+    def addStats(stats):
+        ts_lock.acquire()
+        ts.rx_bytes += stats['rx_bytes']
+        ts.rx_packets += stats['rx_packets']
+        ts.rx_errors += stats['rx_errors']
+        ts.rx_dropped += stats['rx_dropped']
+        ts.rx_overrun += stats['rx_over_errors']
+        ts.rx_mcast += stats['multicast']
+        ts.tx_bytes += stats['tx_bytes']
+        ts.tx_packets += stats['tx_packets']
+        ts.tx_errors += stats['tx_errors']
+        ts.tx_dropped += stats['tx_dropped']
+        ts.tx_carrier += stats['tx_carrier_errors']
+        ts.tx_collsns += stats['collisions']
+        ts_lock.release()
+
     def collectResults(returncode, stdout, errout):
         js = json.loads(stdout)
         stats64 = js[0]['stats64']
         rx = stats64['rx']
         tx = stats64['tx']
 
-        ts_lock.acquire()
-        ts.rx_bytes += rx['bytes']
-        ts.rx_packets += rx['packets']
-        ts.rx_errors += rx['errors']
-        ts.rx_dropped += rx['dropped']
-        ts.rx_overrun += rx['over_errors']
-        ts.rx_mcast += rx['multicast']
-        ts.tx_bytes += tx['bytes']
-        ts.tx_packets += tx['packets']
-        ts.tx_errors += tx['errors']
-        ts.tx_dropped += tx['dropped']
-        ts.tx_carrier += tx['carrier_errors']
-        ts.tx_collsns += tx['collisions']
-        ts_lock.release()
+        addStats({
+            'rx_bytes': rx['bytes'],
+            'rx_packets': rx['packets'],
+            'rx_errors': rx['errors'],
+            'rx_dropped': rx['dropped'],
+            'rx_over_errors': rx['over_errors'],
+            'multicast': rx['multicast'],
+            'tx_bytes': tx['bytes'],
+            'tx_packets': tx['packets'],
+            'tx_errors': tx['errors'],
+            'tx_dropped': tx['dropped'],
+            'tx_carrier_errors': tx['carrier_errors'],
+            'collisions': tx['collisions'],
+        })
 
     for i, id in enumerate(ids):
         remote = rmap[id]
 
-        command = f'ip netns exec ns-{id} ip -j -statistics link show dev {interface}'
+        # read local stats via netlink without starting a process
+        nsname = local_netns(remote, id)
+        if nsname is not None:
+            try:
+                addStats(netlink.get_link_stats(nsname, interface))
+                continue
+            except OSError:
+                # let ip report the error
+                pass
+
+        command = f'{netns_exec(remote, id)} ip -j -statistics link show dev {interface}'
         tid = get_thread_id()
         exec(tid, remote, command, ignore_error=False, onResultCallBack=collectResults)
 
@@ -110,6 +139,7 @@ def main():
     parser.add_argument('--remotes', help='Measure across remotes described in the provided JSON file.')
     parser.add_argument('--interface', help='Interface to measure traffic on.')
     parser.add_argument('--duration', type=int, help='Measurement duration [ms].')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace (JSON) of all executed commands to FILE.')
 
     args = parser.parse_args()
 
@@ -131,6 +161,9 @@ def main():
                 eprint('Need to run as root.')
                 exit(1)
 
+    if args.trace:
+        start_trace(args.trace)
+
     rmap = get_remote_mapping(args.remotes)
     if args.duration:
         ds = args.duration / 1000